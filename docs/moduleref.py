@@ -35,7 +35,9 @@ tree_exists = [
 tree_not_exists = [
     "base",
     "errors",
+    "jobs",
     "objects",
+    "policymatch",
     "updater",
     "userid",
 ]
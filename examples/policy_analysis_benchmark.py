@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2014, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+"""
+policy_analysis_benchmark.py
+============================
+
+Time the offline policy tools of :mod:`panos.policymatch` on a synthetic
+rulebase.  No device is needed.
+
+**Usage**::
+
+    policy_analysis_benchmark.py [-h] [-r RULES] [-f FLOWS] [-s SEED]
+
+**Examples**:
+
+Analyze 10,000 rules and match 100,000 flows against them::
+
+    $ python policy_analysis_benchmark.py -r 10000 -f 100000
+
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+curpath = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [os.path.join(curpath, os.pardir)]
+
+from panos import objects, policies
+from panos.firewall import Firewall
+from panos.policymatch import RuleAnalyzer, SecurityPolicyEngine
+
+ZONES = ["trust", "untrust", "dmz", "guest", "vpn", "lab"]
+APPLICATIONS = ["ssl", "web-browsing", "dns", "ssh", "smtp", "ldap", "ntp"]
+
+
+def build_rulebase(count, rand):
+    """A firewall with a rulebase of synthetic security rules"""
+    fw = Firewall("127.0.0.1", "admin", "admin")
+    services = []
+    for port in range(1000, 1100):
+        name = "tcp-{0}".format(port)
+        fw.add(objects.ServiceObject(name, protocol="tcp", destination_port=port))
+        services.append(name)
+    rulebase = fw.add(policies.Rulebase())
+    for num in range(count):
+        network = "10.{0}.{1}.0/{2}".format(
+            rand.randint(0, 15), rand.randint(0, 255), rand.choice([16, 24, 28, 32])
+        )
+        rulebase.add(
+            policies.SecurityRule(
+                "rule{0}".format(num),
+                fromzone=rand.sample(ZONES, rand.randint(1, 2)),
+                tozone=rand.sample(ZONES, rand.randint(1, 2)),
+                source=rand.choice([["any"], ["172.16.0.0/12"], ["192.168.1.0/24"]]),
+                destination=[network],
+                application=rand.choice([["any"], rand.sample(APPLICATIONS, 2)]),
+                service=rand.choice([["any"], rand.sample(services, 3)]),
+                action=rand.choice(["allow", "allow", "deny"]),
+            )
+        )
+    rulebase.add(policies.SecurityRule("deny-all", service=["any"], action="deny"))
+    return rulebase
+
+
+def build_flows(count, rand):
+    """Synthetic flows to match"""
+    return [
+        {
+            "source": rand.choice(["172.16.1.1", "192.168.1.5", "8.8.8.8"]),
+            "destination": "10.{0}.{1}.{2}".format(
+                rand.randint(0, 15), rand.randint(0, 255), rand.randint(1, 254)
+            ),
+            "protocol": 6,
+            "port": rand.randint(1000, 1099),
+            "application": rand.choice(APPLICATIONS),
+            "from_zone": rand.choice(ZONES),
+            "to_zone": rand.choice(ZONES),
+        }
+        for _ in range(count)
+    ]
+
+
+def timed(label, func, *args):
+    start = time.time()
+    ans = func(*args)
+    print("{0}: {1:.2f}s".format(label, time.time() - start))
+    return ans
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark policy analysis on synthetic rules"
+    )
+    parser.add_argument("-r", "--rules", type=int, default=10000, help="Rule count")
+    parser.add_argument("-f", "--flows", type=int, default=100000, help="Flow count")
+    parser.add_argument("-s", "--seed", type=int, default=1, help="Random seed")
+    args = parser.parse_args()
+
+    rand = random.Random(args.seed)
+    rulebase = build_rulebase(args.rules, rand)
+    flows = build_flows(args.flows, rand)
+
+    engine = timed(
+        "Compile {0} rules".format(args.rules + 1),
+        SecurityPolicyEngine.from_rulebases,
+        rulebase,
+    )
+    found = timed("Analyze", RuleAnalyzer(engine).analyze)
+    for kind in ("shadowed", "redundant", "generalization"):
+        print("  {0}: {1}".format(kind, sum(x["type"] == kind for x in found)))
+    timed("Match {0} flows".format(args.flows), engine.match_indexes, flows)
+
+
+if __name__ == "__main__":
+    main()
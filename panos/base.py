@@ -36,7 +36,7 @@ from pan.config import PanConfig
 
 import panos
 import panos.errors as err
-from panos import isstring, string_or_list, updater, userid, yesno
+from panos import isstring, jobs, string_or_list, updater, userid, yesno
 
 logger = panos.getlogger(__name__)
 
@@ -261,8 +261,9 @@ class PanObject(object):
             return
         if cls is not None:
             children = [child for child in self.children if isinstance(child, cls)]
-            for child in children:
-                self.children.remove(child)
+            self.children[:] = [
+                child for child in self.children if not isinstance(child, cls)
+            ]
             return children
         else:
             children = self.children
@@ -3378,6 +3379,11 @@ class PanDevice(PanObject):
 
     Attributes:
         ha_peer (PanDevice): The HA peer device of this PanDevice
+        wait_strategy (panos.jobs.WaitStrategy): The default strategy used by
+            :meth:`syncjob`, :meth:`syncreboot` and :meth:`watch_op` to decide
+            the time between polls.  None polls at the interval given to
+            each method.
+        poll_stats (panos.jobs.PollStats): Polls issued per completed wait
 
     """
 
@@ -3409,6 +3415,8 @@ class PanDevice(PanObject):
         self.is_virtual = is_virtual
         self.timeout = timeout
         self.interval = interval
+        self.wait_strategy = None
+        self.poll_stats = jobs.PollStats()
         self.serial = None
         self._xapi_private = None
         self.config_locked = False
@@ -3918,6 +3926,7 @@ class PanDevice(PanObject):
         - version
         - platform
         - serial
+        - content_version
         - multi_vsys (if this is a :class:`panos.firewall.Firewall`)
 
         Returns:
@@ -3978,6 +3987,9 @@ class PanDevice(PanObject):
         self._set_version_and_version_info(system_info["system"]["sw-version"])
         self.platform = system_info["system"]["model"]
         self.serial = system_info["system"]["serial"]
+        self.content_version = system_info["system"].get(
+            "app-version", self.content_version
+        )
 
     def _set_version_and_version_info(self, version):
         """Sets the version and the specially formatted versioning version."""
@@ -4624,37 +4636,25 @@ class PanDevice(PanObject):
                     )
                 return result
 
-    def syncjob(self, job_id, sync_all=False, interval=0.5):
+    def syncjob(self, job_id, sync_all=False, interval=0.5, wait=None):
         """Block until job completes and return result
 
         Args:
             job_id (int): job ID, or response XML from job creation
             sync_all (bool): Wait for all devices to complete if commit all operation
             interval (float): Interval in seconds to check if job is complete
+            wait (panos.jobs.WaitStrategy): Decides the time between checks
+                instead of ``interval``.  Defaults to :attr:`wait_strategy`
 
         Returns:
             dict: Job result
 
         """
-        try:
-            import http.client as httplib
-        except ImportError:
-            import httplib
-        if interval is not None:
-            try:
-                interval = float(interval)
-                if interval < 0:
-                    raise ValueError
-            except ValueError:
-                raise err.PanDeviceError("Invalid interval: %s" % interval)
+        wait = self._get_wait_strategy(wait, interval)
 
-        try:
-            job = job_id.find("./result/job")
-            if job is None:
-                return False
-            job = job.text
-        except AttributeError:
-            job = job_id
+        job = jobs.job_id_from(job_id)
+        if job is None:
+            return False
 
         cmd = 'show jobs id "%s"' % job
         start_time = time.time()
@@ -4662,80 +4662,79 @@ class PanDevice(PanObject):
         self._logger.debug("Waiting for job to finish...")
 
         attempts = 0
+        progress = None
         while True:
             try:
                 attempts += 1
                 job_xml = self.xapi.op(cmd=cmd, cmd_xml=True, retry_on_peer=True)
-            except (pan.xapi.PanXapiError, err.PanDeviceError) as e:
-                # Connection errors (URLError) are ok, this can happen in PAN-OS 7.0.1 and 7.0.2
-                # if the hostname is changed
-                # Invalid cred errors are ok because FW auth system takes longer to start up in these cases
-                # Other errors should be raised
-                if not str(e).startswith("URLError:") and not str(e).startswith(
-                    "Invalid credentials."
+            except Exception as e:
+                # Connection issues happen while the firewall restarts the API
+                # service or reboots.  Other errors should be raised.
+                if not jobs.is_connection_error(e):
+                    raise
+            else:
+                status = job_xml.find("./result/job/status")
+                if status is None:
+                    raise pan.xapi.PanXapiError(
+                        "No status element in " + "'%s' response" % cmd
+                    )
+                result = self._finished_job_results(job_xml, sync_all)
+                if result is not None:
+                    self.poll_stats.record(
+                        "syncjob", attempts, time.time() - start_time
+                    )
+                    return result
+
+                progress = jobs.job_progress(job_xml)
+                logger.debug("Job %s status %s" % (job, status.text))
+
+                if (
+                    self.timeout is not None
+                    and self.timeout != 0
+                    and time.time() > start_time + self.timeout
                 ):
-                    # Error not related to connection issue.  Raise it.
-                    raise e
-                else:
-                    # self._logger.debug2("Sleep %.2f seconds" % interval)
-                    time.sleep(interval)
-                    continue
-            except httplib.BadStatusLine as e:
-                # Connection issue.  The firewall is currently restarting the API service or rebooting
-                # self._logger.debug2("Sleep %.2f seconds" % interval)
-                time.sleep(interval)
-                continue
+                    raise pan.xapi.PanXapiError(
+                        "Timeout waiting for " + "job %s completion" % job
+                    )
 
-            status = job_xml.find("./result/job/status")
-            if status is None:
-                raise pan.xapi.PanXapiError(
-                    "No status element in " + "'%s' response" % cmd
-                )
-            if status.text == "FIN" and sync_all:
-                # Check the status of each device commit
-                device_commits_finished = True
-                device_results = job_xml.findall("./result/job/devices/entry/result")
-                for device_result in device_results:
-                    if device_result.text == "PEND":
-                        device_commits_finished = False
-                        break  # One device isn't finished, so stop checking others
-                if device_results and device_commits_finished:
-                    return self._parse_job_results(job_xml, get_devices=True)
-                elif not device_results:
-                    return self._parse_job_results(job_xml, get_devices=False)
-            elif status.text == "FIN":
-                # Job completed, parse the results
-                return self._parse_job_results(job_xml, get_devices=False)
-
-            logger.debug("Job %s status %s" % (job, status.text))
+            time.sleep(wait.next_interval(attempts, time.time() - start_time, progress))
 
-            if (
-                self.timeout is not None
-                and self.timeout != 0
-                and time.time() > start_time + self.timeout
-            ):
-                raise pan.xapi.PanXapiError(
-                    "Timeout waiting for " + "job %s completion" % job
-                )
+    def _get_wait_strategy(self, wait, interval):
+        """The wait strategy for a sync method
 
-            # self._logger.debug2("Sleep %.2f seconds" % interval)
-            time.sleep(interval)
+        Args:
+            wait (panos.jobs.WaitStrategy): The strategy given to the method
+            interval (float): The fixed interval given to the method, used
+                when there is no strategy
 
-    def syncreboot(self, interval=5.0, timeout=600):
-        """Block until reboot completes and return version of device"""
+        Returns:
+            panos.jobs.WaitStrategy
+
+        """
+        if wait is None:
+            wait = self.wait_strategy
+        if wait is not None:
+            return wait
+        if interval is None:
+            interval = self.interval
         try:
-            import http.client as httplib
-        except ImportError:
-            import httplib
+            interval = float(interval)
+            if interval < 0:
+                raise ValueError
+        except (TypeError, ValueError):
+            raise err.PanDeviceError("Invalid interval: %s" % interval)
+        return jobs.WaitStrategy(interval)
 
-        # Validate interval and convert it to float
-        if interval is not None:
-            try:
-                interval = float(interval)
-                if interval < 0:
-                    raise ValueError
-            except ValueError:
-                raise err.PanDeviceError("Invalid interval: %s" % interval)
+    def syncreboot(self, interval=5.0, timeout=600, wait=None):
+        """Block until reboot completes and return version of device
+
+        Args:
+            interval (float): Interval in seconds to check if the device is up
+            wait (panos.jobs.WaitStrategy): Decides the time between checks
+                instead of ``interval``.  Defaults to :attr:`wait_strategy`
+
+        """
+        wait = self._get_wait_strategy(wait, interval)
 
         self._logger.debug("Syncing reboot...")
 
@@ -4744,30 +4743,18 @@ class PanDevice(PanObject):
         attempts = 0
         is_rebooting = False
 
-        time.sleep(interval)
+        time.sleep(wait.next_interval(0, 0))
         while True:
             try:
                 # Try to get the device version (ie. test to see if firewall is up)
                 attempts += 1
                 version = self.refresh_version()
-            except (pan.xapi.PanXapiError, err.PanDeviceXapiError) as e:
+            except Exception as e:
                 # Connection errors (URLError) are ok
                 # Invalid cred errors are ok because FW auth system takes longer to start up
                 # Other errors should be raised
-                if not str(e).startswith("URLError:") and not str(e).startswith(
-                    "Invalid credentials."
-                ):
-                    # Error not related to connection issue.  Raise it.
-                    raise e
-                else:
-                    # Connection issue.  The firewall is currently rebooting.
-                    is_rebooting = True
-                    self._logger.debug("Connection attempted: %s" % str(e))
-                    self._logger.debug(
-                        "Device is not available yet. Connection attempts: %s"
-                        % str(attempts)
-                    )
-            except httplib.BadStatusLine as e:
+                if not jobs.is_connection_error(e):
+                    raise
                 # Connection issue.  The firewall is currently rebooting.
                 is_rebooting = True
                 self._logger.debug("Connection attempted: %s" % str(e))
@@ -4781,6 +4768,9 @@ class PanDevice(PanObject):
                 # a connection error prior to this success.
                 if is_rebooting:
                     self._logger.debug("Device is up! Running version %s" % version)
+                    self.poll_stats.record(
+                        "syncreboot", attempts, time.time() - start_time
+                    )
                     return version
                 else:
                     self._logger.debug(
@@ -4796,9 +4786,37 @@ class PanDevice(PanObject):
                 raise err.PanDeviceError("Timeout waiting for device to reboot")
 
             # Sleep and try again
+            interval = wait.next_interval(attempts, time.time() - start_time)
             self._logger.debug("Sleep %.2f seconds" % interval)
             time.sleep(interval)
 
+    def _finished_job_results(self, show_job_xml, sync_all=False):
+        """Parse the results of a 'show jobs id' response if the job is done.
+
+        Args:
+            show_job_xml (xml.etree.ElementTree): The 'show jobs id' response
+            sync_all (bool): Also wait for all devices of a commit all job
+
+        Returns:
+            dict: Job result, or None if the job is still running
+
+        """
+        status = show_job_xml.findtext("./result/job/status")
+        if status != "FIN":
+            return None
+        if not sync_all:
+            # Job completed, parse the results
+            return self._parse_job_results(show_job_xml, get_devices=False)
+        # Check the status of each device commit
+        device_results = show_job_xml.findall("./result/job/devices/entry/result")
+        if not device_results:
+            return self._parse_job_results(show_job_xml, get_devices=False)
+        for device_result in device_results:
+            if device_result.text == "PEND":
+                # One device isn't finished, so stop checking others
+                return None
+        return self._parse_job_results(show_job_xml, get_devices=True)
+
     def _parse_job_results(self, show_job_xml, get_devices=True):
         # Parse the final results
         pconf = PanConfig(show_job_xml)
@@ -4873,7 +4891,9 @@ class PanDevice(PanObject):
         }
         return result
 
-    def watch_op(self, cmd, path, value, vsys=None, cmd_xml=True, interval=1.0):
+    def watch_op(
+        self, cmd, path, value, vsys=None, cmd_xml=True, interval=1.0, wait=None
+    ):
         """Watch an operational command for an expected value
 
         Blocks script execution until the value exists or timeout expires
@@ -4885,15 +4905,11 @@ class PanDevice(PanObject):
             vsys (str): Vsys id for the operational command
             cmd_xml (bool): True: cmd is not XML, False: cmd is XML (Default: True)
             interval (float): Interval in seconds to check if the value exists
+            wait (panos.jobs.WaitStrategy): Decides the time between checks
+                instead of ``interval``.  Defaults to :attr:`wait_strategy`
 
         """
-        if interval is not None:
-            try:
-                interval = float(interval)
-                if interval < 0:
-                    raise ValueError
-            except ValueError:
-                raise err.PanDeviceError("Invalid interval: %s" % interval)
+        wait = self._get_wait_strategy(wait, interval)
 
         if vsys is None:
             vsys = self.vsys
@@ -4912,6 +4928,7 @@ class PanDevice(PanObject):
             logger.debug("Current value %s" % current_value)
 
             if current_value == value:
+                self.poll_stats.record("watch_op", attempts, time.time() - start_time)
                 return True
 
             if (
@@ -4921,6 +4938,7 @@ class PanDevice(PanObject):
             ):
                 raise err.PanJobTimeout("Timeout waiting for value: %s" % value)
 
+            interval = wait.next_interval(attempts, time.time() - start_time)
             logger.debug("Sleep %.2f seconds" % interval)
             time.sleep(interval)
 
@@ -354,9 +354,10 @@ class Firewall(PanDevice):
             firewall_instances = super(Firewall, self).refreshall_from_xml(
                 xml, refresh_children=False, variables=op_vars
             )
-            # Add system settings to firewall instances
-            for fw in firewall_instances:
-                entry = xml.find("entry[@name='%s']" % fw.serial)
+            # Add system settings to firewall instances.  Each instance was
+            # created from the entry at the same position in the xml, so pair
+            # them up directly instead of searching the xml for every serial.
+            for fw, entry in zip(firewall_instances, xml.findall("entry")):
                 system = fw.find_or_create(None, device.SystemSettings)
                 system.hostname = entry.findtext("hostname")
                 system.ip_address = entry.findtext("ip-address")
@@ -0,0 +1,700 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2014, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+"""Waiting on asynchronous jobs across many devices at once
+
+:meth:`panos.base.PanDevice.syncjob` blocks on a single job.  When many jobs
+are in flight, such as commits on hundreds of firewalls, use a
+:class:`JobWatcher` instead.  It polls each device once per cycle with
+``show jobs all``, no matter how many of that device's jobs are watched::
+
+    watcher = JobWatcher()
+    futures = [watcher.watch(fw, fw.commit()) for fw in firewalls]
+    watcher.wait()
+    for future in futures:
+        print(future.device.id, future.result()["success"])
+
+"""
+
+import random
+import threading
+import time
+
+import pan.xapi
+
+import panos.errors as err
+from panos import getlogger, isstring
+
+try:
+    import http.client as httplib
+except ImportError:
+    import httplib
+
+logger = getlogger(__name__)
+
+
+def is_connection_error(e):
+    """Check if an exception means the device is unreachable or restarting
+
+    Connection errors are expected while a device restarts its management
+    plane, so callers waiting on a device retry instead of raising them.
+
+    Args:
+        e (Exception): The exception raised by an API call
+
+    Returns:
+        bool
+
+    """
+    if isinstance(e, httplib.BadStatusLine):
+        return True
+    if isinstance(e, (pan.xapi.PanXapiError, err.PanDeviceError)):
+        # Connection errors (URLError) are ok, this can happen in PAN-OS 7.0.1
+        # and 7.0.2 if the hostname is changed.  Invalid cred errors are ok
+        # because FW auth system takes longer to start up in these cases.
+        return str(e).startswith("URLError:") or str(e).startswith(
+            "Invalid credentials."
+        )
+    return False
+
+
+def job_id_from(job_id):
+    """Get the job id from either a job id or the xml response creating a job
+
+    Args:
+        job_id: job ID, or response XML from job creation
+
+    Returns:
+        str: The job id, or None if the response has no job
+
+    """
+    if job_id is None or isstring(job_id) or isinstance(job_id, int):
+        return None if job_id is None else str(job_id)
+    job = job_id.find("./result/job")
+    if job is None:
+        return None
+    return job.text
+
+
+def job_progress(show_job_xml):
+    """Get the progress percentage of a job from a 'show jobs' response
+
+    Args:
+        show_job_xml (xml.etree.ElementTree): A 'show jobs id' response, or a
+            single job element from 'show jobs all'
+
+    Returns:
+        int: The progress from 0 to 100, or None if it is not known
+
+    """
+    progress = show_job_xml.findtext("progress")
+    if progress is None:
+        progress = show_job_xml.findtext("./result/job/progress")
+    try:
+        return int(progress)
+    except (TypeError, ValueError):
+        return None
+
+
+class WaitStrategy(object):
+    """Decides how long to wait between polls of a device
+
+    Strategies are used by :meth:`panos.base.PanDevice.syncjob`,
+    :meth:`panos.base.PanDevice.syncreboot`, :meth:`panos.base.PanDevice.watch_op`
+    and :class:`JobWatcher`.  They keep no state between polls, so one
+    instance can be shared by any number of waits.
+
+    This base class waits the same interval between every poll, which is the
+    classic behavior of the sync methods.
+
+    Args:
+        interval (float): Seconds to wait between polls
+        max_interval (float): Never wait longer than this many seconds
+
+    """
+
+    def __init__(self, interval=0.5, max_interval=None):
+        self.interval = interval
+        self.max_interval = max_interval
+
+    def __repr__(self):
+        return "<%s interval=%s max_interval=%s>" % (
+            type(self).__name__,
+            self.interval,
+            self.max_interval,
+        )
+
+    def next_interval(self, attempt, elapsed, progress=None):
+        """Seconds to wait before the next poll
+
+        Args:
+            attempt (int): The number of polls made so far, starting at 1
+            elapsed (float): Seconds since the wait started
+            progress (int): The percentage complete reported by the job, if
+                known
+
+        Returns:
+            float
+
+        """
+        return self._clamp(self._interval(attempt, elapsed, progress))
+
+    def _interval(self, attempt, elapsed, progress):
+        return self.interval
+
+    def _clamp(self, value):
+        if self.max_interval is not None:
+            value = min(value, self.max_interval)
+        return max(0.0, value)
+
+
+class ExponentialWait(WaitStrategy):
+    """Wait exponentially longer after every poll, with random jitter
+
+    The wait before poll ``n + 1`` is ``interval * multiplier ** (n - 1)``,
+    capped at ``max_interval``.  Jitter spreads polls from many waiters so
+    they don't hit a device in lock step.
+
+    Args:
+        interval (float): Seconds to wait after the first poll
+        max_interval (float): Never wait longer than this many seconds
+        multiplier (float): Growth of the wait after each poll
+        jitter (float): Fraction of each wait that is randomized, from 0
+            (no jitter) to 1 (anywhere between zero and the full wait)
+
+    """
+
+    def __init__(self, interval=0.5, max_interval=30.0, multiplier=2.0, jitter=0.5):
+        super(ExponentialWait, self).__init__(interval, max_interval)
+        self.multiplier = multiplier
+        self.jitter = jitter
+
+    def _interval(self, attempt, elapsed, progress):
+        # Cap the exponent so huge attempt counts don't overflow
+        exponent = min(max(attempt - 1, 0), 64)
+        value = self._clamp(self.interval * self.multiplier ** exponent)
+        if self.jitter:
+            value -= random.uniform(0, value * self.jitter)
+        return value
+
+
+class ElapsedWait(WaitStrategy):
+    """Wait longer the longer the wait has been going on
+
+    The wait between polls follows a curve of the time since the wait
+    started, given as steps of ``(elapsed, interval)``.  The interval of the
+    last step whose elapsed time has passed is used.  The default curve
+    polls every second for the first 30 seconds, every 5 seconds until 2
+    minutes, then every 15 seconds.
+
+    Args:
+        steps (list): ``(elapsed, interval)`` tuples
+        max_interval (float): Never wait longer than this many seconds
+
+    """
+
+    STEPS = ((0, 1.0), (30, 5.0), (120, 15.0))
+
+    def __init__(self, steps=None, max_interval=None):
+        steps = sorted(self.STEPS if steps is None else steps)
+        if not steps:
+            raise ValueError("At least one step is required")
+        super(ElapsedWait, self).__init__(steps[0][1], max_interval)
+        self.steps = steps
+
+    def _interval(self, attempt, elapsed, progress):
+        value = self.interval
+        for start, interval in self.steps:
+            if elapsed < start:
+                break
+            value = interval
+        return value
+
+
+class ProgressWait(WaitStrategy):
+    """Wait based on the progress the job reports
+
+    The rate of progress so far is used to estimate when the job will
+    finish, and the next poll is scheduled for a fraction of that remaining
+    time.  Until the job reports progress, ``interval`` is used.
+
+    Args:
+        interval (float): Shortest wait, and the wait when progress is unknown
+        max_interval (float): Never wait longer than this many seconds
+        fraction (float): Fraction of the estimated remaining time to wait
+
+    """
+
+    def __init__(self, interval=0.5, max_interval=30.0, fraction=0.5):
+        super(ProgressWait, self).__init__(interval, max_interval)
+        self.fraction = fraction
+
+    def _interval(self, attempt, elapsed, progress):
+        if not progress or progress >= 100 or elapsed <= 0:
+            return self.interval
+        remaining = elapsed * (100.0 - progress) / progress
+        return max(self.interval, remaining * self.fraction)
+
+
+class PollStats(object):
+    """Counts the polls it takes to finish waiting on a device
+
+    Every :class:`panos.base.PanDevice` has one of these as ``poll_stats``.
+    The sync methods and :class:`JobWatcher` record each finished wait, so
+    the cost of a wait strategy can be measured.  Stats are kept per
+    operation, such as "syncjob" or "syncreboot".
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {}
+
+    def record(self, operation, polls, elapsed):
+        """Record a finished wait
+
+        Args:
+            operation (str): The kind of wait, eg. "syncjob"
+            polls (int): The number of polls made during the wait
+            elapsed (float): Seconds spent waiting
+
+        """
+        with self._lock:
+            stats = self.stats.setdefault(
+                operation, {"completed": 0, "polls": 0, "elapsed": 0.0}
+            )
+            stats["completed"] += 1
+            stats["polls"] += polls
+            stats["elapsed"] += elapsed
+
+    def polls_per_completion(self, operation=None):
+        """The average number of polls per finished wait
+
+        Args:
+            operation (str): Only consider this operation, instead of all
+
+        Returns:
+            float: Average polls, or None if nothing has finished
+
+        """
+        with self._lock:
+            if operation is None:
+                values = list(self.stats.values())
+            else:
+                values = [self.stats[operation]] if operation in self.stats else []
+        completed = sum(x["completed"] for x in values)
+        if not completed:
+            return None
+        return float(sum(x["polls"] for x in values)) / completed
+
+    def reset(self):
+        """Forget all recorded waits"""
+        with self._lock:
+            self.stats = {}
+
+
+class JobFuture(object):
+    """The eventual result of a job watched by a :class:`JobWatcher`
+
+    Args:
+        device (PanDevice): The device running the job
+        job_id (str): The job id
+
+    """
+
+    def __init__(self, device, job_id):
+        self.device = device
+        self.job_id = job_id
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def __repr__(self):
+        return "<%s %s job %s %s>" % (
+            type(self).__name__,
+            self.device.id,
+            self.job_id,
+            "done" if self.done() else "pending",
+        )
+
+    def done(self):
+        """True if the job finished or failed"""
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Block until the job is done and return its result
+
+        Args:
+            timeout (float): Seconds to wait, or None to wait forever
+
+        Returns:
+            dict: Job result, as returned by :meth:`panos.base.PanDevice.syncjob`
+
+        Raises:
+            PanJobTimeout: The job did not finish within the timeout
+
+        """
+        if not self._done.wait(timeout):
+            raise err.PanJobTimeout(
+                "Timeout waiting for job %s" % self.job_id, pan_device=self.device
+            )
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        """Block until the job is done and return its exception, if any"""
+        if not self._done.wait(timeout):
+            raise err.PanJobTimeout(
+                "Timeout waiting for job %s" % self.job_id, pan_device=self.device
+            )
+        return self._exception
+
+    def add_done_callback(self, fn):
+        """Call ``fn(future)`` once the job is done
+
+        If the job is already done, ``fn`` is called immediately.
+
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        self._invoke(fn)
+
+    def _set_result(self, result):
+        self._finish(result, None)
+
+    def _set_exception(self, exception):
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            self._invoke(fn)
+
+    def _invoke(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            logger.exception("Exception in callback for job %s" % self.job_id)
+
+
+class _WatchedJob(object):
+    def __init__(self, device, job_id, sync_all, timeout, future):
+        self.device = device
+        self.job_id = job_id
+        self.sync_all = sync_all
+        self.timeout = timeout
+        self.future = future
+        self.type = None
+        self.progress = None
+        self.start = time.time()
+        self.next_poll = self.start
+        self.polls = 0
+        # Set once the job itself finished, but its devices may not have
+        self.fin = False
+
+
+class JobWatcher(object):
+    """Wait on many jobs across many devices
+
+    Each poll cycle sends one ``show jobs all`` to every device that has a
+    job due to be checked, and updates all of the watched jobs on that device
+    from the one response.  Only finished jobs are fetched with ``show jobs
+    id`` to get their full results.
+
+    The time between polls of a job grows with the age of the job, so short
+    commits are noticed quickly while long running installs don't keep the
+    management plane busy.  Pass a :class:`WaitStrategy` as ``wait`` to use
+    a different curve.  Either way, the per job type minimums apply.
+
+    The watcher can be driven from the calling thread with :meth:`wait`, or
+    in a background thread with :meth:`start` and :meth:`stop`.
+
+    Args:
+        interval (float): Shortest time in seconds between polls of a job
+        max_interval (float): Longest time in seconds between polls of a job
+        age_factor (float): Fraction of a job's age to wait between polls
+        type_intervals (dict): Shortest time between polls per job type (eg.
+            "Commit" or "Install"), overriding ``interval``
+        timeout (float): Seconds to wait on each job. Defaults to the timeout
+            of the device running the job.
+        wait (WaitStrategy): Decides the time between polls of a job instead
+            of ``age_factor``
+
+    """
+
+    TYPE_INTERVALS = {
+        "Commit": 0.5,
+        "Validate": 0.5,
+        "CommitAll": 1.0,
+        "Downld": 2.0,
+        "Install": 5.0,
+    }
+
+    def __init__(
+        self,
+        interval=0.5,
+        max_interval=30.0,
+        age_factor=0.1,
+        type_intervals=None,
+        timeout=None,
+        wait=None,
+    ):
+        self._logger = getlogger(__name__ + "." + self.__class__.__name__)
+        self.interval = interval
+        self.max_interval = max_interval
+        self.age_factor = age_factor
+        self.type_intervals = dict(self.TYPE_INTERVALS)
+        if type_intervals is not None:
+            self.type_intervals.update(type_intervals)
+        self.timeout = timeout
+        self.wait_strategy = wait
+
+        self._lock = threading.RLock()
+        self._wakeup = threading.Condition(self._lock)
+        self._devices = {}
+        self._thread = None
+        self._stopping = False
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(jobs) for device, jobs in self._devices.values())
+
+    def watch(self, device, job_id, sync_all=False, callback=None, timeout=None):
+        """Start watching a job
+
+        Args:
+            device (PanDevice): The device running the job
+            job_id: job ID, or response XML from job creation
+            sync_all (bool): Wait for all devices to complete if commit all
+                operation
+            callback (callable): Called as ``callback(future)`` when the job
+                is done
+            timeout (float): Seconds to wait on this job, overriding the
+                watcher's timeout
+
+        Returns:
+            JobFuture: The eventual result of the job
+
+        """
+        job_id = job_id_from(job_id)
+        if job_id is None:
+            raise ValueError("No job to watch")
+        if timeout is None:
+            timeout = self.timeout if self.timeout is not None else device.timeout
+        future = JobFuture(device, job_id)
+        if callback is not None:
+            future.add_done_callback(callback)
+        job = _WatchedJob(device, job_id, sync_all, timeout, future)
+        with self._lock:
+            jobs = self._devices.setdefault(id(device), (device, {}))[1]
+            jobs[job_id] = job
+            self._wakeup.notify_all()
+        return future
+
+    def poll(self):
+        """Check every job that is due to be checked
+
+        Returns:
+            float: Seconds until the next job is due, or None if no jobs are
+            being watched
+
+        """
+        now = time.time()
+        with self._lock:
+            due = [
+                (device, list(jobs.values()))
+                for device, jobs in self._devices.values()
+                if any(job.next_poll <= now for job in jobs.values())
+            ]
+        for device, jobs in due:
+            self._poll_device(device, jobs)
+        return self._time_to_next_poll()
+
+    def wait(self, timeout=None):
+        """Block until every watched job is done
+
+        Args:
+            timeout (float): Seconds to wait, or None to wait until each job
+                finishes or hits its own timeout
+
+        Returns:
+            bool: True if all jobs are done, False if the timeout expired
+
+        """
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            delay = self.poll()
+            if delay is None:
+                return True
+            if end is not None:
+                remaining = end - time.time()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            time.sleep(delay)
+
+    def start(self):
+        """Poll the watched jobs in a background thread"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name="panos-job-watcher")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        """Stop the background thread started by :meth:`start`
+
+        Jobs still being watched are left as they are, and are picked up
+        again by :meth:`wait` or another :meth:`start`.
+
+        """
+        with self._lock:
+            thread = self._thread
+            self._stopping = True
+            self._wakeup.notify_all()
+        if thread is not None:
+            thread.join(timeout)
+        with self._lock:
+            self._thread = None
+
+    def _run(self):
+        while True:
+            delay = self.poll()
+            with self._lock:
+                if self._stopping:
+                    return
+                # Sleep until the next job is due or a new job is watched
+                self._wakeup.wait(self.max_interval if delay is None else delay)
+                if self._stopping:
+                    return
+
+    def _time_to_next_poll(self):
+        with self._lock:
+            next_polls = [
+                job.next_poll
+                for device, jobs in self._devices.values()
+                for job in jobs.values()
+            ]
+        if not next_polls:
+            return None
+        return max(0, min(next_polls) - time.time())
+
+    def _next_interval(self, job, now):
+        interval = self.type_intervals.get(job.type, self.interval)
+        age = now - job.start
+        if self.wait_strategy is not None:
+            waited = self.wait_strategy.next_interval(job.polls, age, job.progress)
+        else:
+            waited = age * self.age_factor
+        return min(max(interval, waited), self.max_interval)
+
+    def _poll_device(self, device, jobs):
+        # Jobs that finished but still wait on their devices need the full
+        # job details anyway, so only ask for the summary if something else
+        # is running.
+        summary = {}
+        if any(not job.fin for job in jobs):
+            try:
+                response = device.xapi.op(
+                    cmd="show jobs all", cmd_xml=True, retry_on_peer=True
+                )
+            except Exception as e:
+                if not is_connection_error(e):
+                    for job in jobs:
+                        self._done(job, exception=e)
+                    return
+                self._logger.debug(
+                    "Device %s not reachable to check jobs: %s" % (device.id, e)
+                )
+                self._reschedule(jobs)
+                return
+            for elm in response.findall("./result/job"):
+                summary[elm.findtext("id")] = elm
+
+        for job in jobs:
+            job.polls += 1
+            elm = summary.get(job.job_id)
+            if elm is not None:
+                job.type = elm.findtext("type")
+                job.fin = elm.findtext("status") == "FIN"
+                job.progress = job_progress(elm)
+            if job.fin or elm is None:
+                # Finished, or no longer listed in the summary, so get the
+                # full results of this one job.
+                try:
+                    job_xml = device.xapi.op(
+                        cmd='show jobs id "%s"' % job.job_id,
+                        cmd_xml=True,
+                        retry_on_peer=True,
+                    )
+                    result = device._finished_job_results(job_xml, job.sync_all)
+                except Exception as e:
+                    if not is_connection_error(e):
+                        self._done(job, exception=e)
+                        continue
+                else:
+                    job.fin = job_xml.findtext("./result/job/status") == "FIN"
+                    if result is not None:
+                        self._done(job, result=result)
+                        continue
+            self._reschedule([job])
+
+    def _reschedule(self, jobs):
+        now = time.time()
+        for job in jobs:
+            if job.timeout and now > job.start + job.timeout:
+                self._done(
+                    job,
+                    exception=err.PanJobTimeout(
+                        "Timeout waiting for job %s completion" % job.job_id,
+                        pan_device=job.device,
+                    ),
+                )
+                continue
+            job.next_poll = now + self._next_interval(job, now)
+            self._logger.debug(
+                "Device %s job %s (%s) next check in %.2f seconds"
+                % (job.device.id, job.job_id, job.type, job.next_poll - now)
+            )
+
+    def _done(self, job, result=None, exception=None):
+        with self._lock:
+            device, jobs = self._devices.get(id(job.device), (None, {}))
+            if jobs.get(job.job_id) is job:
+                del jobs[job.job_id]
+                if not jobs:
+                    del self._devices[id(job.device)]
+        self._logger.debug(
+            "Device %s job %s done after %d polls"
+            % (job.device.id, job.job_id, job.polls)
+        )
+        if exception is not None:
+            job.future._set_exception(exception)
+        else:
+            job.device.poll_stats.record("watcher", job.polls, time.time() - job.start)
+            job.future._set_result(result)
@@ -17,15 +17,20 @@
 
 """Panorama and all Panorama related objects"""
 
+import collections
+import copy
+import hashlib
 import logging
+import time
 import xml.etree.ElementTree as ET
 from copy import deepcopy
 
 import pan.commit
+import pan.xapi
 
 import panos
 import panos.errors as err
-from panos import base, firewall, getlogger, policies, yesno
+from panos import base, firewall, getlogger, jobs, objects, policies
 from panos.base import ENTRY, MEMBER, PanObject, Root
 from panos.base import VarPath as Var
 from panos.base import VersionedPanObject, VersionedParamPath
@@ -500,14 +505,20 @@ class Panorama(base.PanDevice):
         devices_xml = self.op(cmd)
         devices_xml = devices_xml.find("result/devices")
 
+        # Index the managed devices by serial number
+        devices_by_serial = {}
+        for entry in devices_xml.findall("entry"):
+            devices_by_serial.setdefault(entry.get("name"), entry)
+
         # Filter to only requested devices
         if devices:
             filtered_devices_xml = ET.Element("devices")
+            filtered_by_serial = {}
             for device in devices:
                 serial = str(device)
                 if serial is None:
                     continue
-                entry = devices_xml.find("entry[@name='%s']" % serial)
+                entry = devices_by_serial.get(serial)
                 if entry is None:
                     if only_connected:
                         raise err.PanNotConnectedOnPanorama(
@@ -519,19 +530,19 @@ class Panorama(base.PanDevice):
                             "Can't find device with serial %s attached to Panorama at %s"
                             % (serial, self.id)
                         )
-                multi_vsys = yesno(entry.findtext("multi-vsys"))
                 try:
                     vsys = device.vsys
                 except AttributeError:
                     continue
                 # Create entry if needed
-                if filtered_devices_xml.find("entry[@name='%s']" % serial) is None:
+                if serial not in filtered_by_serial:
                     entry_copy = deepcopy(entry)
                     # If looking for specific vsys, erase all vsys in filtered entry
                     if vsys != "shared" and vsys is not None:
                         entry_copy.remove(entry_copy.find("vsys"))
                         ET.SubElement(entry_copy, "vsys")
                     filtered_devices_xml.append(entry_copy)
+                    filtered_by_serial[serial] = entry_copy
                 # Get specific vsys
                 if vsys != "shared" and vsys is not None:
                     vsys_entry = entry.find("vsys/entry[@name='%s']" % vsys)
@@ -541,15 +552,12 @@ class Panorama(base.PanDevice):
                             " vsys %s attached to Panorama at %s"
                             % (serial, vsys, self.id)
                         )
-                    vsys_section = filtered_devices_xml.find(
-                        "entry[@name='%s']/vsys" % serial
-                    )
-                    vsys_section.append(vsys_entry)
+                    filtered_by_serial[serial].find("vsys").append(vsys_entry)
             devices_xml = filtered_devices_xml
 
         # Manipulate devices_xml so each vsys is a separate device
         if expand_vsys:
-            original_devices_xml = deepcopy(devices_xml)
+            original_devices_xml = devices_xml
             devices_xml = ET.Element("devices")
             for entry in original_devices_xml:
                 serial = entry.findtext("serial")
@@ -589,16 +597,24 @@ class Panorama(base.PanDevice):
         devicegroup_opxml = self.op("show devicegroups")
         devicegroup_opxml = devicegroup_opxml.find("result/devicegroups")
 
+        # Index the operational state of each device-group member by serial
+        devicegroup_op_by_serial = {}
+        if devicegroup_opxml is not None:
+            for fw_entry_op in devicegroup_opxml.findall("entry/devices/entry"):
+                devicegroup_op_by_serial.setdefault(
+                    fw_entry_op.get("name"), fw_entry_op
+                )
+
         # Combine the config XML and operational command XML to get a complete picture
         # of the device groups
+        devicegroup_entries = []
         if devicegroup_configxml is not None:
-            for dg_entry in devicegroup_configxml:
+            devicegroup_entries = devicegroup_configxml.findall("entry")
+            for dg_entry in devicegroup_entries:
                 if dg_entry.find("devices") is None:
                     continue
                 for fw_entry in dg_entry.find("devices"):
-                    fw_entry_op = devicegroup_opxml.find(
-                        "entry/devices/entry[@name='%s']" % fw_entry.get("name")
-                    )
+                    fw_entry_op = devicegroup_op_by_serial.get(fw_entry.get("name"))
                     if fw_entry_op is not None:
                         panos.xml_combine(fw_entry, fw_entry_op)
 
@@ -608,56 +624,47 @@ class Panorama(base.PanDevice):
             devicegroup_configxml, refresh_children=False
         )
 
-        for dg in devicegroup_instances:
-            dg_serials = [
-                entry.get("name")
-                for entry in devicegroup_configxml.findall(
-                    "entry[@name='%s']/devices/entry" % dg.name
-                )
-            ]
+        # Work out which serials and vsys were requested, if any
+        requested_serials = None
+        requested_vsys = None
+        if devices:
+            requested_serials = set(str(f) for f in devices)
+            try:
+                requested_vsys = set(f.vsys for f in devices)
+            except AttributeError:
+                # Passed in string serials, no vsys, so get all vsys
+                pass
+            else:
+                if "shared" in requested_vsys or None in requested_vsys:
+                    requested_vsys = None
+
+        # Index the firewall instances by serial and vsys
+        firewalls_by_id = {}
+        for fw in firewall_instances:
+            firewalls_by_id.setdefault((fw.serial, fw.vsys), fw)
+        moved_firewalls = set()
+
+        # Each device-group instance was created from the entry at the same
+        # position in the config xml.
+        for dg, dg_entry in zip(devicegroup_instances, devicegroup_entries):
             # Find firewall with each serial
-            for dg_serial in dg_serials:
+            for fw_entry in dg_entry.findall("devices/entry"):
+                dg_serial = fw_entry.get("name")
                 # Skip devices not requested
-                if devices and dg_serial not in [str(f) for f in devices]:
+                if requested_serials is not None and dg_serial not in requested_serials:
                     continue
                 all_dg_vsys = [
-                    entry.get("name")
-                    for entry in devicegroup_configxml.findall(
-                        "entry[@name='%s']/devices/entry[@name='%s']/vsys/entry"
-                        % (dg.name, dg_serial)
-                    )
+                    entry.get("name") for entry in fw_entry.findall("vsys/entry")
                 ]
-                # Collect the firewall serial entry to get current status information
-                fw_entry = devicegroup_configxml.find(
-                    "entry[@name='%s']/devices/entry[@name='%s']" % (dg.name, dg_serial)
-                )
                 if not all_dg_vsys:
                     # This is a single-context firewall, assume vsys1
                     all_dg_vsys = ["vsys1"]
                 for dg_vsys in all_dg_vsys:
                     # Check if this is a requested vsys in devices argument
-                    if devices:
-                        try:
-                            requested_vsys = [f.vsys for f in devices]
-                        except AttributeError:
-                            # Passed in string serials, no vsys, so get all vsys
-                            pass
-                        else:
-                            if (
-                                "shared" not in requested_vsys
-                                and None not in requested_vsys
-                                and dg_vsys not in requested_vsys
-                            ):
-                                # A specific vsys was requested, and this isn't it, skip
-                                continue
-                    fw = next(
-                        (
-                            x
-                            for x in firewall_instances
-                            if x.serial == dg_serial and x.vsys == dg_vsys
-                        ),
-                        None,
-                    )
+                    if requested_vsys is not None and dg_vsys not in requested_vsys:
+                        # A specific vsys was requested, and this isn't it, skip
+                        continue
+                    fw = firewalls_by_id.pop((dg_serial, dg_vsys), None)
                     if fw is None:
                         # It's possible for device-groups to reference a serial/vsys that doesn't exist
                         # In this case, create the FW instance
@@ -667,7 +674,7 @@ class Panorama(base.PanDevice):
                     else:
                         # Move the firewall to the device-group
                         dg.add(fw)
-                        firewall_instances.remove(fw)
+                        moved_firewalls.add(id(fw))
                         shared_policy_status = fw_entry.findtext("shared-policy-status")
                         if shared_policy_status is None:
                             shared_policy_status = fw_entry.findtext(
@@ -675,9 +682,17 @@ class Panorama(base.PanDevice):
                             )
                         fw.state.set_shared_policy_synced(shared_policy_status)
 
+        # Firewalls that were moved to a device-group are no longer standalone
+        firewall_instances = [
+            fw for fw in firewall_instances if id(fw) not in moved_firewalls
+        ]
+
         if add:
+            existing_devicegroups = {}
+            for found_dg in self.findall(DeviceGroup):
+                existing_devicegroups.setdefault(found_dg.name, found_dg)
             for dg in devicegroup_instances:
-                found_dg = self.find(dg.name, DeviceGroup)
+                found_dg = existing_devicegroups.get(dg.name)
                 if found_dg is not None:
                     # Move the firewalls to the existing devicegroup
                     found_dg.removeall(self.FIREWALL_CLASS)
@@ -1020,3 +1035,887 @@ class PanoramaCommitAll(object):
             root.append(body)
 
         return root
+
+
+class CommitAllScheduler(object):
+    """Push config from Panorama to many devices in waves
+
+    A single commit-all to every device group at once can overwhelm Panorama
+    and the firewalls, while pushing one device group at a time by hand is
+    slow.  This scheduler takes a plan of waves, where each wave is a list of
+    :class:`panos.panorama.PanoramaCommitAll` objects.  The commits of a wave
+    run with at most ``concurrency`` jobs in flight, and the next wave starts
+    only after every device of the current wave finished.
+
+    Devices that fail a push are pushed again on their own, up to
+    ``retries`` times.  Once more than ``failure_budget`` devices have failed
+    for good, no new commits are started and the remaining commits are
+    skipped.
+
+    Per device progress of the running jobs is streamed to ``callback`` as
+    dicts with these keys:
+
+    * event: "submitted", "device", "finished" or "skipped"
+    * commit: The PanoramaCommitAll the event is about
+    * jobid: The commit-all job id, or None for "skipped" events
+    * serial, status, progress, result: For "device" events, the state of
+      one device of the job.  Each change of state is reported once.
+    * job: For "finished" events, the job result as returned by
+      :meth:`panos.base.PanDevice.syncjob`
+
+    Example::
+
+        plan = CommitAllScheduler.device_group_waves(
+            ["branches-east", "branches-west", "datacenter"], per_wave=2)
+        scheduler = CommitAllScheduler(pano, plan, concurrency=2, failure_budget=5)
+        result = scheduler.run()
+
+    Args:
+        panorama (Panorama): The Panorama to push from
+        waves (list): List of waves, each a list of PanoramaCommitAll
+        concurrency (int): Most commit-all jobs in flight at once
+        failure_budget (int): Number of devices allowed to fail before the
+            remaining commits are skipped.  None never stops early.
+        retries (int): Times a failed device is pushed to again
+        stagger (float): Shortest time in seconds between starting two
+            commit-all jobs
+        timeout (float): Seconds to wait on each job.  Defaults to the
+            timeout of the Panorama.  Devices still pending at the timeout
+            count as failed.
+        wait (panos.jobs.WaitStrategy): Decides the time between polls.
+            Defaults to the ``wait_strategy`` of the Panorama, then its
+            ``interval``.
+        callback (callable): Called as ``callback(event)`` with progress
+
+    """
+
+    # Commit-all styles that can be limited to specific devices
+    DEVICE_STYLES = (
+        PanoramaCommitAll.STYLE_DEVICE_GROUP,
+        PanoramaCommitAll.STYLE_TEMPLATE,
+        PanoramaCommitAll.STYLE_TEMPLATE_STACK,
+    )
+
+    def __init__(
+        self,
+        panorama,
+        waves,
+        concurrency=1,
+        failure_budget=None,
+        retries=0,
+        stagger=0,
+        timeout=None,
+        wait=None,
+        callback=None,
+    ):
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self._logger = getlogger(__name__ + "." + self.__class__.__name__)
+        self.panorama = panorama
+        self.waves = [list(wave) for wave in waves]
+        self.concurrency = concurrency
+        self.failure_budget = failure_budget
+        self.retries = retries
+        self.stagger = stagger
+        self.timeout = timeout
+        self.wait = wait
+        self.callback = callback
+
+    @staticmethod
+    def device_group_waves(devicegroups, per_wave=1, batch_size=None, **commit_kwargs):
+        """Build a wave plan of device group pushes
+
+        Args:
+            devicegroups: List of device group names, or a dict of device
+                group name to the list of serials to push to.  With a list,
+                each push goes to every device in the group.
+            per_wave (int): Number of pushes in each wave
+            batch_size (int): With a dict, split the serials of each device
+                group into pushes of at most this many devices
+            **commit_kwargs: Passed to every PanoramaCommitAll, such as
+                ``description`` or ``include_template``
+
+        Returns:
+            list: Waves of PanoramaCommitAll objects
+
+        """
+        commits = []
+        if isinstance(devicegroups, dict):
+            for name, serials in devicegroups.items():
+                serials = list(serials)
+                size = batch_size or len(serials) or 1
+                for start in range(0, max(len(serials), 1), size):
+                    commits.append(
+                        PanoramaCommitAll(
+                            PanoramaCommitAll.STYLE_DEVICE_GROUP,
+                            name,
+                            devices=serials[start : start + size] or None,
+                            **commit_kwargs
+                        )
+                    )
+        else:
+            for name in devicegroups:
+                commits.append(
+                    PanoramaCommitAll(
+                        PanoramaCommitAll.STYLE_DEVICE_GROUP, name, **commit_kwargs
+                    )
+                )
+        return [
+            commits[start : start + per_wave]
+            for start in range(0, len(commits), per_wave)
+        ]
+
+    def run(self):
+        """Push every wave of the plan
+
+        Returns:
+            dict: The results, with these keys:
+
+            * success (bool): True if every device succeeded and nothing
+              was skipped
+            * aborted (bool): True if the failure budget was exceeded
+            * devices (dict): Serial number to the final device result of
+              :meth:`panos.base.PanDevice.syncjob`, plus an "attempts" key
+            * failed (list): Serials that failed after all retries
+            * jobs (list): Every job result
+            * skipped (list): PanoramaCommitAll objects that were not pushed
+
+        """
+        wait = self.panorama._get_wait_strategy(self.wait, None)
+        timeout = self.timeout if self.timeout is not None else self.panorama.timeout
+        self._results = {
+            "success": True,
+            "aborted": False,
+            "devices": {},
+            "failed": [],
+            "jobs": [],
+            "skipped": [],
+        }
+        self._last_submit = None
+
+        for num, wave in enumerate(self.waves):
+            if self._results["aborted"]:
+                for commit in wave:
+                    self._skip(commit)
+                continue
+            self._logger.debug(
+                "Starting wave %d of %d with %d commits"
+                % (num + 1, len(self.waves), len(wave))
+            )
+            self._run_wave(wave, wait, timeout)
+
+        results = self._results
+        results["failed"] = sorted(
+            serial for serial, x in results["devices"].items() if not x["success"]
+        )
+        if results["failed"] or results["skipped"]:
+            results["success"] = False
+        return results
+
+    def _run_wave(self, wave, wait, timeout):
+        queue = collections.deque((commit, 1) for commit in wave)
+        in_flight = []
+        cycles = 0
+        wave_start = time.time()
+        while queue or in_flight:
+            if self._results["aborted"]:
+                while queue:
+                    self._skip(queue.popleft()[0])
+
+            # Start as many jobs as allowed
+            while queue and len(in_flight) < self.concurrency:
+                now = time.time()
+                if (
+                    self.stagger
+                    and self._last_submit is not None
+                    and now < self._last_submit + self.stagger
+                ):
+                    break
+                commit, attempt = queue.popleft()
+                push = self._submit(commit, attempt)
+                self._last_submit = now
+                if push is not None:
+                    in_flight.append(push)
+
+            if not in_flight and not queue:
+                break
+
+            cycles += 1
+            progress = [x.progress for x in in_flight if x.progress is not None]
+            delay = wait.next_interval(
+                cycles, time.time() - wave_start, min(progress) if progress else None
+            )
+            if queue and self.stagger and len(in_flight) < self.concurrency:
+                delay = min(delay, self._last_submit + self.stagger - time.time())
+            time.sleep(max(0, delay))
+
+            for push in list(in_flight):
+                result = self._poll(push, timeout)
+                if result is None:
+                    continue
+                in_flight.remove(push)
+                retry = self._finish(push, result)
+                if retry is not None:
+                    queue.append(retry)
+
+    def _submit(self, commit, attempt):
+        jobid = self.panorama.commit(cmd=commit)
+        if jobid is None:
+            # Nothing to push
+            self._logger.debug("No commit needed for %s" % commit.name)
+            return None
+        self._logger.debug(
+            "Started commit-all job %s to %s (attempt %d)"
+            % (jobid, commit.name, attempt)
+        )
+        self._event("submitted", commit, jobid)
+        return _CommitAllPush(commit, jobid, attempt)
+
+    def _poll(self, push, timeout):
+        try:
+            job_xml = self.panorama.xapi.op(
+                cmd='show jobs id "%s"' % push.jobid, cmd_xml=True, retry_on_peer=True
+            )
+        except Exception as e:
+            if not jobs.is_connection_error(e):
+                raise
+            job_xml = None
+        else:
+            push.progress = jobs.job_progress(job_xml)
+            for entry in job_xml.findall("./result/job/devices/entry"):
+                state = (
+                    entry.findtext("status"),
+                    entry.findtext("progress"),
+                    entry.findtext("result"),
+                )
+                serial = entry.findtext("serial-no")
+                if push.devices.get(serial) != state:
+                    push.devices[serial] = state
+                    self._event(
+                        "device",
+                        push.commit,
+                        push.jobid,
+                        serial=serial,
+                        status=state[0],
+                        progress=state[1],
+                        result=state[2],
+                    )
+            result = self.panorama._finished_job_results(job_xml, sync_all=True)
+            if result is not None:
+                return result
+
+        if timeout and time.time() > push.start + timeout:
+            self._logger.debug("Timeout waiting for commit-all job %s" % push.jobid)
+            devices = {}
+            for serial, state in push.devices.items():
+                done = state[2] not in (None, "PEND")
+                devices[serial] = {
+                    "success": state[2] == "OK",
+                    "serial": serial,
+                    "result": state[2] if done else "TIMEOUT",
+                }
+            return {
+                "success": False,
+                "result": "TIMEOUT",
+                "jobid": push.jobid,
+                "messages": ["Timeout waiting for job %s completion" % push.jobid],
+                "devices": devices,
+                "xml": job_xml,
+            }
+        return None
+
+    def _finish(self, push, result):
+        """Record the result of a job, and return the retry push if needed"""
+        self._results["jobs"].append(result)
+        self._event("finished", push.commit, push.jobid, job=result)
+
+        failed = []
+        for serial, device_result in result["devices"].items():
+            device_result = dict(device_result, attempts=push.attempt)
+            self._results["devices"][serial] = device_result
+            if not device_result["success"]:
+                failed.append(serial)
+        if not result["devices"] and not result["success"]:
+            # The job failed before reaching any devices
+            self._results["success"] = False
+
+        if failed and push.attempt <= self.retries:
+            if push.commit.style in self.DEVICE_STYLES:
+                retry = copy.copy(push.commit)
+                retry.devices = sorted(failed)
+            else:
+                retry = push.commit
+            self._logger.debug(
+                "Retrying %s on %d failed devices" % (push.commit.name, len(failed))
+            )
+            return (retry, push.attempt + 1)
+
+        if self.failure_budget is not None:
+            failures = sum(
+                1 for x in self._results["devices"].values() if not x["success"]
+            )
+            if failures > self.failure_budget:
+                self._logger.debug(
+                    "%d devices failed, over the budget of %d"
+                    % (failures, self.failure_budget)
+                )
+                self._results["aborted"] = True
+
+    def _skip(self, commit):
+        self._results["skipped"].append(commit)
+        self._event("skipped", commit, None)
+
+    def _event(self, event, commit, jobid, **kwargs):
+        if self.callback is None:
+            return
+        kwargs.update({"event": event, "commit": commit, "jobid": jobid})
+        try:
+            self.callback(kwargs)
+        except Exception:
+            self._logger.exception("Exception in commit-all progress callback")
+
+
+class _CommitAllPush(object):
+    def __init__(self, commit, jobid, attempt):
+        self.commit = commit
+        self.jobid = jobid
+        self.attempt = attempt
+        self.start = time.time()
+        self.progress = None
+        # Serial number to (status, progress, result)
+        self.devices = {}
+
+
+class DeviceGroupHierarchy(object):
+    """Device group hierarchy of a Panorama, and the objects each group sees
+
+    Device groups on Panorama are nested: a firewall in a device group sees
+    the objects of its own group, of every ancestor group, and of shared.
+    When more than one of them has an object of the same name, the one
+    closest to the firewall wins.
+
+    :meth:`refresh` loads the hierarchy with the ``show dg-hierarchy`` op
+    command, and :meth:`refresh_objects` loads the objects of shared and of
+    every device group in a single API call.  After that, the merged
+    namespace of each device group is computed once and cached, so lookups
+    with :meth:`resolve` are dictionary lookups.
+
+    Example::
+
+        hierarchy = DeviceGroupHierarchy(pano)
+        hierarchy.refresh()
+        hierarchy.refresh_objects()
+        obj = hierarchy.resolve("branch-42", objects.AddressObject, "web01")
+
+    Args:
+        panorama (Panorama): The Panorama to load from
+
+    Attributes:
+        parents (dict): Device group name to the name of its parent device
+            group, or None if its parent is shared
+
+    """
+
+    OBJECT_CLASSES = (
+        objects.AddressObject,
+        objects.AddressGroup,
+        objects.ServiceObject,
+        objects.ServiceGroup,
+        objects.Tag,
+        objects.ApplicationObject,
+        objects.ApplicationGroup,
+        objects.ApplicationFilter,
+        objects.CustomUrlCategory,
+    )
+
+    def __init__(self, panorama):
+        self.panorama = panorama
+        self.parents = {}
+        self._children = {}
+        self._objects = {}
+        self._cache = {}
+
+    def refresh(self):
+        """Load the device group hierarchy from Panorama
+
+        Returns:
+            dict: Device group name to parent device group name
+
+        """
+        response = self.panorama.op("show dg-hierarchy")
+        return self.parse_hierarchy(response.find("./result/dg-hierarchy"))
+
+    def parse_hierarchy(self, xml):
+        """Load the device group hierarchy from XML
+
+        Args:
+            xml (xml.etree.ElementTree): The ``dg-hierarchy`` element of a
+                ``show dg-hierarchy`` response
+
+        Returns:
+            dict: Device group name to parent device group name
+
+        """
+        parents = {}
+        if xml is not None:
+            stack = [(elm, None) for elm in xml.findall("dg")]
+            while stack:
+                elm, parent = stack.pop()
+                name = elm.get("name")
+                parents[name] = parent
+                stack.extend((x, name) for x in elm.findall("dg"))
+        self.parents = parents
+        self._children = {}
+        for name, parent in parents.items():
+            self._children.setdefault(parent, []).append(name)
+        for names in self._children.values():
+            names.sort()
+        self._cache = {}
+        return parents
+
+    def refresh_objects(self, classes=None, running_config=False):
+        """Load the objects of shared and every device group in one request
+
+        Args:
+            classes (list): The object classes to load.  Defaults to
+                :attr:`OBJECT_CLASSES`.
+            running_config (bool): Load the running config instead of the
+                candidate config
+
+        """
+        xpath = "{0} | {1}/device-group".format(
+            self.panorama.xpath_vsys(), self.panorama.xpath_device()
+        )
+        api_action = (
+            self.panorama.xapi.show if running_config else self.panorama.xapi.get
+        )
+        try:
+            response = api_action(xpath, retry_on_peer=True)
+        except (err.PanNoSuchNode, pan.xapi.PanXapiError) as e:
+            if not str(e).startswith("No such node"):
+                raise
+            response = None
+        result = None if response is None else response.find("result")
+        self.parse_objects(result, classes)
+
+    def parse_objects(self, xml, classes=None):
+        """Load the objects of shared and every device group from XML
+
+        Args:
+            xml (xml.etree.ElementTree): An element containing the ``shared``
+                and ``device-group`` config elements
+            classes (list): The object classes to load.  Defaults to
+                :attr:`OBJECT_CLASSES`.
+
+        """
+        if classes is None:
+            classes = self.OBJECT_CLASSES
+        containers = {}
+        if xml is not None:
+            containers[None] = xml.find("shared")
+            for entry in xml.findall("device-group/entry"):
+                containers[entry.get("name")] = entry
+
+        self._objects = {}
+        self._cache = {}
+        for dg_name, container in containers.items():
+            if container is None:
+                continue
+            if dg_name is None:
+                parent = self.panorama
+            else:
+                parent = DeviceGroup(dg_name)
+                parent.parent = self.panorama
+            for cls in classes:
+                instance = cls()
+                instance.parent = parent
+                elm = container.find(instance.XPATH.lstrip("/"))
+                if elm is None:
+                    continue
+                found = instance.refreshall_from_xml(elm)
+                if found:
+                    self._objects[(dg_name, cls)] = dict((x.uid, x) for x in found)
+
+    def parent(self, devicegroup):
+        """The name of the parent device group, or None for shared"""
+        return self.parents.get(self._name(devicegroup))
+
+    def ancestors(self, devicegroup):
+        """Names of the ancestor device groups, the closest one first"""
+        ans = []
+        name = self.parents.get(self._name(devicegroup))
+        while name is not None and name not in ans:
+            ans.append(name)
+            name = self.parents.get(name)
+        return ans
+
+    def children(self, devicegroup=None):
+        """Names of the child device groups, or the top level groups for None"""
+        return list(self._children.get(self._name(devicegroup), []))
+
+    def descendants(self, devicegroup=None):
+        """Names of every device group below this one"""
+        ans = []
+        stack = self.children(devicegroup)
+        while stack:
+            name = stack.pop(0)
+            ans.append(name)
+            stack.extend(self._children.get(name, []))
+        return ans
+
+    def effective_objects(self, location, cls):
+        """All objects of one type seen at a location
+
+        Args:
+            location: A device group name, a :class:`DeviceGroup`, a
+                :class:`panos.firewall.Firewall` in a device group, or None
+                for shared
+            cls (type): The object class, such as
+                :class:`panos.objects.AddressObject`
+
+        Returns:
+            dict: Object name to the object that wins at this location.  Do
+            not modify it, it is shared by later lookups.
+
+        """
+        return self._effective(self._name(location), cls)
+
+    def resolve(self, location, cls, name):
+        """The object of the given name that a location actually sees
+
+        Args:
+            location: A device group name, a :class:`DeviceGroup`, a
+                :class:`panos.firewall.Firewall` in a device group, or None
+                for shared
+            cls (type): The object class, such as
+                :class:`panos.objects.AddressObject`
+            name (str): The object name
+
+        Returns:
+            The object, or None if it is not visible from the location
+
+        """
+        return self._effective(self._name(location), cls).get(name)
+
+    def location_of(self, location, cls, name):
+        """The device group defining the object a location sees
+
+        Returns:
+            str: Device group name, "shared", or None if the object isn't
+            visible from the location
+
+        """
+        location = self._name(location)
+        for dg_name in [location] + self.ancestors(location) + [None]:
+            if name in self._objects.get((dg_name, cls), {}):
+                return "shared" if dg_name is None else dg_name
+            if dg_name is None:
+                break
+
+    def invalidate(self, devicegroup=None):
+        """Drop the cached namespaces of a device group and its descendants
+
+        Call this after changing the objects of a device group.  For None,
+        every cached namespace is dropped.
+
+        """
+        name = self._name(devicegroup)
+        if name is None:
+            self._cache = {}
+            return
+        names = set([name] + self.descendants(name))
+        for key in [x for x in self._cache if x[0] in names]:
+            del self._cache[key]
+
+    def set_objects(self, location, cls, instances):
+        """Replace the objects of one type at a location
+
+        Args:
+            location: A device group name, a :class:`DeviceGroup`, or None
+                for shared
+            cls (type): The object class
+            instances (list): The objects now at that location
+
+        """
+        name = self._name(location)
+        self._objects[(name, cls)] = dict((x.uid, x) for x in instances)
+        self.invalidate(name)
+
+    def _effective(self, name, cls):
+        key = (name, cls)
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+        if name is None:
+            merged = dict(self._objects.get((None, cls), {}))
+        else:
+            if name not in self.parents and (name, cls) not in self._objects:
+                raise err.PanDeviceError(
+                    "Unknown device group: {0}".format(name), pan_device=self.panorama
+                )
+            parent = self.parents.get(name)
+            if parent == name or name in self.ancestors(parent):
+                raise err.PanDeviceError(
+                    "Device group hierarchy loop at {0}".format(name),
+                    pan_device=self.panorama,
+                )
+            merged = dict(self._effective(parent, cls))
+            merged.update(self._objects.get((name, cls), {}))
+        self._cache[key] = merged
+        return merged
+
+    def _name(self, location):
+        if location is None or location == "shared":
+            return None
+        if isinstance(location, DeviceGroup):
+            return location.name
+        if isinstance(location, firewall.Firewall):
+            if isinstance(location.parent, DeviceGroup):
+                return location.parent.name
+            raise ValueError(
+                "Firewall {0} is not in a device group".format(location.id)
+            )
+        return location
+
+
+class TemplateMerger(object):
+    """Compute the config firewalls receive from templates and template stacks
+
+    A template stack pushes the merge of its templates to its firewalls.
+    The stack's own config has the highest priority, followed by its
+    templates in the order they are listed.  Values of ``$variables`` come
+    from the per device overrides of the stack, then the stack, then its
+    templates in the same order.
+
+    :meth:`refresh` loads every template and template stack in a single API
+    call.  Merges are cached keyed by a hash of the content of the merged
+    templates and the variable values, so a merge is only redone when one of
+    its inputs changed, even across refreshes.
+
+    Example::
+
+        merger = TemplateMerger(pano)
+        merger.refresh()
+        fw = merger.firewall("branch-stack", serial="0123456789")
+        eth1 = fw.find("ethernet1/1", network.EthernetInterface)
+
+    Args:
+        panorama (Panorama): The Panorama to load from
+
+    """
+
+    def __init__(self, panorama):
+        self.panorama = panorama
+        self.templates = {}
+        self.stacks = {}
+        self._cache = {}
+
+    def refresh(self, running_config=False):
+        """Load every template and template stack from Panorama
+
+        Args:
+            running_config (bool): Load the running config instead of the
+                candidate config
+
+        """
+        device = self.panorama.xpath_device()
+        xpath = "{0}/template | {0}/template-stack".format(device)
+        api_action = (
+            self.panorama.xapi.show if running_config else self.panorama.xapi.get
+        )
+        try:
+            response = api_action(xpath, retry_on_peer=True)
+        except (err.PanNoSuchNode, pan.xapi.PanXapiError) as e:
+            if not str(e).startswith("No such node"):
+                raise
+            response = None
+        self.parse(None if response is None else response.find("result"))
+
+    def parse(self, xml):
+        """Load templates and template stacks from XML
+
+        Args:
+            xml (xml.etree.ElementTree): An element containing the
+                ``template`` and ``template-stack`` config elements
+
+        """
+        self.templates = {}
+        self.stacks = {}
+        if xml is None:
+            return
+        for entry in xml.findall("template/entry"):
+            self.templates[entry.get("name")] = self._source(entry)
+        for entry in xml.findall("template-stack/entry"):
+            source = self._source(entry)
+            source["templates"] = [x.text for x in entry.findall("templates/member")]
+            source["overrides"] = dict(
+                (x.get("name"), self._variables(x))
+                for x in entry.findall("devices/entry")
+            )
+            self.stacks[entry.get("name")] = source
+
+    def variables(self, name, serial=None):
+        """The values of the variables for a template stack or template
+
+        Args:
+            name (str): Template stack or template name
+            serial (str): Also apply the overrides for this firewall
+
+        Returns:
+            dict: Variable name (including the ``$``) to value
+
+        """
+        ans = {}
+        for source in reversed(self._sources(name)):
+            ans.update(source["variables"])
+        if serial is not None and name in self.stacks:
+            ans.update(self.stacks[name]["overrides"].get(serial, {}))
+        return ans
+
+    def merged_xml(self, name, serial=None, strict=False):
+        """The merged config of a template stack or template
+
+        Args:
+            name (str): Template stack or template name
+            serial (str): Apply the variable overrides for this firewall
+            strict (bool): Raise an error for variables without a value
+                instead of leaving them as is
+
+        Returns:
+            xml.etree.ElementTree: The merged ``config`` element.  This is
+            cached, so do not modify it.
+
+        """
+        sources = self._sources(name)
+        variables = self.variables(name, serial)
+        key = (
+            tuple(x["hash"] for x in sources),
+            tuple(sorted(variables.items())),
+            strict,
+        )
+        try:
+            return self._cache[key]
+        except KeyError:
+            pass
+
+        configs = [x["config"] for x in sources if x["config"] is not None]
+        if configs:
+            merged = deepcopy(configs[0])
+            for config in configs[1:]:
+                self._merge(merged, config)
+        else:
+            merged = ET.Element("config")
+        self._substitute(merged, variables, name, strict)
+        self._cache[key] = merged
+        return merged
+
+    def firewall(self, name, serial=None, strict=False):
+        """A firewall tree of the merged config of a template stack or template
+
+        Args:
+            name (str): Template stack or template name
+            serial (str): Apply the variable overrides for this firewall, and
+                set it as the serial of the firewall
+            strict (bool): Raise an error for variables without a value
+
+        Returns:
+            panos.firewall.Firewall: A new firewall with the merged config
+            as its children
+
+        """
+        merged = self.merged_xml(name, serial, strict)
+        fw = firewall.Firewall(serial=serial)
+        if self.panorama.version is not None:
+            fw._set_version_and_version_info(self.panorama.version)
+        device = merged.find("devices/entry")
+        if device is not None:
+            fw._refresh_children(xml=device)
+        return fw
+
+    def clear_cache(self):
+        """Forget every cached merge"""
+        self._cache = {}
+
+    def _sources(self, name):
+        """The templates of a stack, highest priority first"""
+        if name in self.stacks:
+            stack = self.stacks[name]
+            sources = [stack]
+            for template in stack["templates"]:
+                if template not in self.templates:
+                    raise err.PanDeviceError(
+                        "Template stack {0} uses unknown template {1}".format(
+                            name, template
+                        ),
+                        pan_device=self.panorama,
+                    )
+                sources.append(self.templates[template])
+            return sources
+        if name in self.templates:
+            return [self.templates[name]]
+        raise err.PanDeviceError(
+            "Unknown template or template stack: {0}".format(name),
+            pan_device=self.panorama,
+        )
+
+    def _source(self, entry):
+        config = entry.find("config")
+        content = b"" if config is None else ET.tostring(config, encoding="utf-8")
+        return {
+            "config": config,
+            "variables": self._variables(entry),
+            "hash": hashlib.sha1(content).hexdigest(),
+        }
+
+    def _variables(self, entry):
+        ans = {}
+        for var in entry.findall("variable/entry"):
+            value = var.find("type/*")
+            if value is not None:
+                ans[var.get("name")] = value.text
+        return ans
+
+    def _merge(self, higher, lower):
+        """Add the config of lower that higher doesn't have, in place"""
+        existing = {}
+        for child in higher:
+            existing.setdefault((child.tag, child.get("name")), child)
+        for child in lower:
+            match = existing.get((child.tag, child.get("name")))
+            if match is None:
+                higher.append(deepcopy(child))
+            elif self._is_container(match) and self._is_container(child):
+                self._merge(match, child)
+
+    def _is_container(self, elm):
+        # Leaf values and member lists are replaced as a whole by the higher
+        # priority template, everything else is merged.
+        if len(elm) == 0:
+            return False
+        return any(x.tag != "member" for x in elm)
+
+    def _substitute(self, xml, variables, name, strict):
+        # Variables are used both as values and as entry names, such as the
+        # IP addresses of an interface.
+        missing = set()
+        for elm in xml.iter():
+            text = elm.text.strip() if elm.text else ""
+            if text.startswith("$"):
+                if text in variables:
+                    elm.text = variables[text]
+                else:
+                    missing.add(text)
+            attr_name = elm.get("name")
+            if attr_name is not None and attr_name.startswith("$"):
+                if attr_name in variables:
+                    elm.set("name", variables[attr_name])
+                else:
+                    missing.add(attr_name)
+        if missing:
+            msg = "{0} has no value for variables: {1}".format(
+                name, ", ".join(sorted(missing))
+            )
+            if strict:
+                raise err.PanDeviceError(msg, pan_device=self.panorama)
+            logger.debug(msg)
@@ -17,11 +17,16 @@
 
 """Policies module contains policies and rules that exist in the 'Policies' tab in the firewall GUI"""
 
+import bisect
+import collections
+import xml.etree.ElementTree as ET
+
 import panos.errors as err
 from panos import getlogger
 from panos.base import ENTRY, MEMBER, PanObject, Root
 from panos.base import VarPath as Var
 from panos.base import VersionedPanObject, VersionedParamPath
+from panos.firewall import Firewall
 
 logger = getlogger(__name__)
 
@@ -44,6 +49,177 @@ class Rulebase(VersionedPanObject):
     def _setup(self):
         self._xpaths.add_profile(value="/rulebase")
 
+    def reorder(self, desired_order, rule_type=None, multi_config=False, update=True):
+        """Put the rules of one type in the desired order with few moves
+
+        **Modifies the live device**
+
+        Moving every rule takes one API call per rule.  Instead, the rules
+        already in the desired relative order (the longest increasing
+        subsequence of their current positions) stay where they are, and
+        only the others are moved, each one after the rule that precedes it
+        in the desired order.
+
+        Args:
+            desired_order (list): Every rule of the type, as rule objects or
+                names, in the desired order
+            rule_type (class): The type of the rules, such as
+                :class:`SecurityRule`.  Defaults to the type of the first
+                rule object in ``desired_order``, or SecurityRule.
+            multi_config (bool): Send all the moves in one multi-config
+                request (PAN-OS 9.0+), which applies all or none of them
+            update (bool): If False, only reorder the pan-os-python object
+                tree
+
+        Returns:
+            dict: ``moved``, the names of the rules moved; ``calls``, the
+            API calls made; and ``saved``, the calls saved compared to
+            moving every rule
+
+        Raises:
+            ValueError: If ``desired_order`` isn't the rules of the type
+
+        """
+        if rule_type is None:
+            rule_type = next(
+                (type(x) for x in desired_order if isinstance(x, PanObject)),
+                SecurityRule,
+            )
+        current = [x for x in self.children if isinstance(x, rule_type)]
+        positions = dict((x.uid, i) for i, x in enumerate(current))
+        names = [str(x) for x in desired_order]
+        if len(set(names)) != len(names) or set(names) != set(positions):
+            raise ValueError(
+                "desired_order must list each {0} of the rulebase once".format(
+                    rule_type.__name__
+                )
+            )
+
+        stay = _longest_increasing_subsequence([positions[x] for x in names])
+        moves = []
+        for i, name in enumerate(names):
+            if i in stay:
+                continue
+            rule = current[positions[name]]
+            if i == 0:
+                moves.append((rule, "top", None))
+            else:
+                moves.append((rule, "after", names[i - 1]))
+
+        calls = 0
+        if multi_config and update and moves:
+            element = ET.Element("multi-config")
+            for num, (rule, location, ref) in enumerate(moves, 1):
+                move = ET.SubElement(element, "move", {"id": str(num)})
+                move.set("xpath", rule.xpath())
+                move.set("where", location)
+                if ref is not None:
+                    move.set("dst", ref)
+            for rule, location, ref in moves:
+                rule.move(location, ref, update=False)
+            device = self.nearest_pandevice()
+            logger.debug(
+                "{0}: reorder moving {1} rules in one request".format(
+                    device.id, len(moves)
+                )
+            )
+            device.set_config_changed()
+            device.xapi.multi_config(
+                element=ET.tostring(element, encoding="utf-8"), strict=True
+            )
+            calls = 1
+        else:
+            for rule, location, ref in moves:
+                rule.move(location, ref, update=update)
+            if update:
+                calls = len(moves)
+
+        return {
+            "moved": [x[0].uid for x in moves],
+            "calls": calls,
+            "saved": len(names) - calls if update else 0,
+        }
+
+    def refresh_hit_counts(self, rule_type=None, page_size=None):
+        """Refresh the hit counts of the rules
+
+        Sets ``hit_count``, ``first_hit`` and ``last_hit`` of each rule in
+        one pass over the results.  A firewall is asked once per rule type
+        for its vsys.
+
+        For the pre and post rulebases of a Panorama device group, every
+        firewall of the device group is asked instead, through Panorama,
+        and the counts are aggregated: hit counts are summed, and the
+        earliest first hit and latest last hit are kept.  Add the
+        firewalls to the device group first, for example with
+        :meth:`panos.panorama.Panorama.refresh_devices`.
+
+        Args:
+            rule_type (class): :class:`SecurityRule`, :class:`NatRule` or
+                :class:`PolicyBasedForwarding`.  Defaults to the types of
+                the rules in the rulebase, or SecurityRule if it is empty.
+            page_size (int): Ask for at most this many rules per request,
+                instead of all of them at once
+
+        Returns:
+            dict: The rule base type, such as ``security``, to a dict of
+            rule names to dicts with ``hit_count``, ``first_hit`` and
+            ``last_hit``, for every rule the devices reported
+
+        """
+        if rule_type is not None:
+            rule_types = [rule_type]
+        else:
+            rule_types = [x for x in HIT_COUNT_RULE_BASES if self.findall(x)]
+            rule_types = rule_types or [SecurityRule]
+        targets = self._hit_count_targets()
+
+        ans = {}
+        for cls in rule_types:
+            rule_base = HIT_COUNT_RULE_BASES[cls]
+            rules = dict((x.uid, x) for x in self.findall(cls))
+            names = [None]
+            if page_size and rules:
+                names = list(rules)
+                names = [
+                    names[i : i + page_size] for i in range(0, len(names), page_size)
+                ]
+            counts = {}
+            for device, vsys in targets:
+                for page in names:
+                    cmd = _hit_count_cmd(vsys, rule_base, page)
+                    res = device.op(ET.tostring(cmd, encoding="utf-8"), cmd_xml=False)
+                    _add_hit_counts(counts, res)
+            for name, value in counts.items():
+                rule = rules.get(name)
+                if rule is not None:
+                    rule.hit_count = value["hit_count"]
+                    rule.first_hit = value["first_hit"]
+                    rule.last_hit = value["last_hit"]
+            ans[rule_base] = counts
+
+        return ans
+
+    def _hit_count_targets(self):
+        """The (device, vsys) tuples to ask for hit counts"""
+        # panorama imports this module
+        from panos import panorama
+
+        device = self.nearest_pandevice()
+        if isinstance(device, Firewall):
+            return [(device, self.vsys or "vsys1")]
+        scope = self.parent
+        while scope is not None and not isinstance(scope, panorama.DeviceGroup):
+            scope = scope.parent
+        if scope is None:
+            scope = device
+        firewalls = scope.findall(Firewall)
+        if not firewalls:
+            raise err.PanDeviceError(
+                "No firewalls in {0} to get hit counts from".format(scope.uid)
+            )
+        return [(x, x.vsys or "vsys1") for x in firewalls]
+
 
 class PreRulebase(Rulebase):
     """Pre-rulebase for a Panorama
@@ -114,11 +290,18 @@ class SecurityRule(VersionedPanObject):
             (applies to panorama/device groups only)
         uuid (str): (PAN-OS 9.0+) The UUID for this rule.
 
+    After :meth:`Rulebase.refresh_hit_counts`, ``hit_count`` is the number
+    of hits of the rule, and ``first_hit`` and ``last_hit`` the times of its
+    first and last hit, in seconds since the epoch, or None.
+
     """
 
     # TODO: Add QoS variables
     SUFFIX = ENTRY
     ROOT = Root.VSYS
+    hit_count = None
+    first_hit = None
+    last_hit = None
 
     def _setup(self):
         # xpaths
@@ -279,10 +462,16 @@ class NatRule(VersionedPanObject):
         tag (list): Administrative tags
         uuid (str): (PAN-OS 9.0+) The UUID for this rule.
 
+    After :meth:`Rulebase.refresh_hit_counts`, ``hit_count``, ``first_hit``
+    and ``last_hit`` are set as for :class:`SecurityRule`.
+
     """
 
     SUFFIX = ENTRY
     ROOT = Root.VSYS
+    hit_count = None
+    first_hit = None
+    last_hit = None
 
     def _setup(self):
         # xpaths
@@ -609,10 +798,16 @@ class PolicyBasedForwarding(VersionedPanObject):
             (applies to panorama/device groups only)
         uuid (str): (PAN-OS 9.0+) The UUID for this rule.
 
+    After :meth:`Rulebase.refresh_hit_counts`, ``hit_count``, ``first_hit``
+    and ``last_hit`` are set as for :class:`SecurityRule`.
+
     """
 
     SUFFIX = ENTRY
     ROOT = Root.VSYS
+    hit_count = None
+    first_hit = None
+    last_hit = None
 
     def _setup(self):
         # xpaths
@@ -750,3 +945,75 @@ class PolicyBasedForwarding(VersionedPanObject):
         params[-1].add_profile("9.0.0", vartype="attrib", path="uuid")
 
         self._params = tuple(params)
+
+
+def _hit_count_cmd(vsys, rule_base, names=None):
+    """The show rule-hit-count command for some or all rules"""
+    cmd = ET.Element("show")
+    elm = ET.SubElement(cmd, "rule-hit-count")
+    for tag in ("vsys", "vsys-name"):
+        elm = ET.SubElement(elm, tag)
+    elm = ET.SubElement(elm, "entry", {"name": vsys})
+    elm = ET.SubElement(elm, "rule-base")
+    elm = ET.SubElement(elm, "entry", {"name": rule_base})
+    elm = ET.SubElement(elm, "rules")
+    if names is None:
+        ET.SubElement(elm, "all")
+    else:
+        elm = ET.SubElement(elm, "list")
+        for name in names:
+            ET.SubElement(elm, "member").text = name
+    return cmd
+
+
+def _add_hit_counts(counts, res):
+    """Add the rules of a show rule-hit-count response to counts"""
+    for entry in res.findall(
+        "./result/rule-hit-count/vsys/entry/rule-base/entry/rules/entry"
+    ):
+        hit_count = int(entry.findtext("hit-count") or 0)
+        first_hit = int(entry.findtext("first-hit-timestamp") or 0) or None
+        last_hit = int(entry.findtext("last-hit-timestamp") or 0) or None
+        value = counts.get(entry.attrib["name"])
+        if value is None:
+            counts[entry.attrib["name"]] = {
+                "hit_count": hit_count,
+                "first_hit": first_hit,
+                "last_hit": last_hit,
+            }
+            continue
+        value["hit_count"] += hit_count
+        if first_hit is not None:
+            value["first_hit"] = min(value["first_hit"] or first_hit, first_hit)
+        if last_hit is not None:
+            value["last_hit"] = max(value["last_hit"] or last_hit, last_hit)
+
+
+def _longest_increasing_subsequence(values):
+    """The indexes of a longest increasing subsequence of values"""
+    # tails[k] is the index ending the best subsequence of length k + 1
+    tails = []
+    tail_values = []
+    previous = [None] * len(values)
+    for i, value in enumerate(values):
+        k = bisect.bisect_left(tail_values, value)
+        if k > 0:
+            previous[i] = tails[k - 1]
+        if k == len(tails):
+            tails.append(i)
+            tail_values.append(value)
+        else:
+            tails[k] = i
+            tail_values[k] = value
+    ans = set()
+    i = tails[-1] if tails else None
+    while i is not None:
+        ans.add(i)
+        i = previous[i]
+    return ans
+
+
+# The rule-base of each rule type in show rule-hit-count
+HIT_COUNT_RULE_BASES = collections.OrderedDict(
+    ((SecurityRule, "security"), (NatRule, "nat"), (PolicyBasedForwarding, "pbf"),)
+)
@@ -0,0 +1,2787 @@
+#!/usr/bin/env python
+
+# Copyright (c) 2014, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+
+
+"""Matching traffic against policy without asking the device
+
+:meth:`panos.base.PanDevice.test_security_policy_match` costs an API call
+per flow.  A :class:`SecurityPolicyEngine` answers the same question from
+rules and objects that were already refreshed, so large batches of flows
+can be checked locally::
+
+    rulebase = fw.add(Rulebase())
+    SecurityRule.refreshall(rulebase)
+    for cls in (AddressObject, AddressGroup, ServiceObject, ServiceGroup):
+        cls.refreshall(fw)
+
+    engine = SecurityPolicyEngine.from_rulebases(rulebase)
+    engine.match("10.1.1.1", "8.8.8.8", 17, port=53,
+                 from_zone="trust", to_zone="untrust")
+
+Addresses are handled as integer intervals on one line, with the IPv4
+space first and the IPv6 space after it, so IPv4 and IPv6 objects can be
+mixed freely.
+
+Batches of flows are matched with :meth:`SecurityPolicyEngine.match_indexes`,
+which uses NumPy when it is installed and pure Python otherwise.
+
+:class:`NatPolicyEngine` does the same for NAT rules, returning the
+translated addresses and port of packets.
+
+:class:`RuleAnalyzer` uses the same compiled rules to find rules that are
+shadowed by or redundant with earlier rules.
+
+:class:`AddressIndex` finds the address objects and groups that contain or
+overlap an address, or that duplicate each other.  :class:`GroupResolver`
+flattens nested and dynamic address groups and service groups, and
+:class:`DynamicUserGroupEvaluator` works out dynamic user group members.
+
+:class:`UrlCategoryMatcher` finds the custom URL categories of URLs, which
+lets the security engine match rules by category for a ``url``.
+
+"""
+
+import bisect
+
+import panos.errors as err
+from panos import getlogger, objects, policies, string_or_list
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+logger = getlogger(__name__)
+
+
+IPV4_BITS = 32
+IPV6_BITS = 128
+# IPv6 addresses are placed after the IPv4 space
+IPV6_OFFSET = 1 << IPV4_BITS
+IPV4_SPACE = (0, IPV6_OFFSET - 1)
+IPV6_SPACE = (IPV6_OFFSET, IPV6_OFFSET + (1 << IPV6_BITS) - 1)
+
+# Largest address key that fits in a NumPy int64
+_INT64_MAX = (1 << 63) - 1
+
+PROTOCOLS = {
+    "tcp": 6,
+    "udp": 17,
+    "sctp": 132,
+}
+
+
+def _ipv4(text):
+    parts = text.split(".")
+    if len(parts) != 4:
+        raise ValueError("Invalid IPv4 address: {0}".format(text))
+    value = 0
+    for part in parts:
+        if not part.isdigit() or int(part) > 255:
+            raise ValueError("Invalid IPv4 address: {0}".format(text))
+        value = (value << 8) | int(part)
+    return value
+
+
+def _ipv6(text):
+    original = text
+    if "." in text:
+        # Embedded IPv4 address, like ::ffff:10.1.1.1
+        head, _, tail = text.rpartition(":")
+        value = _ipv4(tail)
+        text = "{0}:{1:x}:{2:x}".format(head, value >> 16, value & 0xFFFF)
+    if text.count("::") > 1:
+        raise ValueError("Invalid IPv6 address: {0}".format(original))
+    if "::" in text:
+        left, right = text.split("::")
+        left = left.split(":") if left else []
+        right = right.split(":") if right else []
+        missing = 8 - len(left) - len(right)
+        if missing < 1:
+            raise ValueError("Invalid IPv6 address: {0}".format(original))
+        groups = left + ["0"] * missing + right
+    else:
+        groups = text.split(":")
+    if len(groups) != 8:
+        raise ValueError("Invalid IPv6 address: {0}".format(original))
+    value = 0
+    for group in groups:
+        if not 1 <= len(group) <= 4:
+            raise ValueError("Invalid IPv6 address: {0}".format(original))
+        value = (value << 16) | int(group, 16)
+    return value
+
+
+def address_key(address):
+    """The position of an IP address on the address line
+
+    Args:
+        address (str): An IPv4 or IPv6 address
+
+    Returns:
+        int
+
+    Raises:
+        ValueError: Not an IP address
+
+    """
+    address = address.strip()
+    if ":" in address:
+        return IPV6_OFFSET + _ipv6(address.split("%")[0])
+    return _ipv4(address)
+
+
+def format_address(key):
+    """The IP address at a position on the address line
+
+    Args:
+        key (int): As returned by :func:`address_key`
+
+    Returns:
+        str
+
+    """
+    if key < IPV6_OFFSET:
+        return ".".join(str((key >> x) & 0xFF) for x in (24, 16, 8, 0))
+    value = key - IPV6_OFFSET
+    groups = [(value >> (x * 16)) & 0xFFFF for x in range(7, -1, -1)]
+    # Compress the longest run of zero groups
+    best, best_len, start = None, 1, None
+    for i, group in enumerate(groups + [1]):
+        if group == 0 and start is None:
+            start = i
+        elif group != 0 and start is not None:
+            if i - start > best_len:
+                best, best_len = start, i - start
+            start = None
+    text = ["{0:x}".format(x) for x in groups]
+    if best is None:
+        return ":".join(text)
+    return ":".join(text[:best]) + "::" + ":".join(text[best + best_len :])
+
+
+def _network(address, length):
+    key = address_key(address)
+    if key < IPV6_OFFSET:
+        offset, bits = 0, IPV4_BITS
+    else:
+        offset, bits = IPV6_OFFSET, IPV6_BITS
+    length = int(length)
+    if not 0 <= length <= bits:
+        raise ValueError("Invalid prefix length: {0}".format(length))
+    host = bits - length
+    start = offset + (((key - offset) >> host) << host)
+    return start, start + (1 << host) - 1
+
+
+def parse_address(value, type="ip-netmask"):
+    """Parse the value of an address object into intervals
+
+    Args:
+        value (str): The value, like ``10.1.0.0/16``, ``10.1.1.1-10.1.1.9``
+            or ``10.0.1.0/0.0.254.255``
+        type (str): The type of the address object.  An ``fqdn`` has no
+            intervals, as it isn't resolved here.
+
+    Returns:
+        list: (first, last) tuples of :func:`address_key` values
+
+    Raises:
+        ValueError: The value can't be parsed
+
+    """
+    if value is None:
+        raise ValueError("No address value")
+    value = value.strip()
+    if type == "fqdn":
+        return []
+    elif type == "ip-range":
+        first, _, last = value.partition("-")
+        first, last = address_key(first), address_key(last)
+        if first > last:
+            raise ValueError("Invalid address range: {0}".format(value))
+        return [(first, last)]
+    elif type == "ip-wildcard":
+        address, _, mask = value.partition("/")
+        key, mask = address_key(address), address_key(mask)
+        offset = 0 if key < IPV6_OFFSET else IPV6_OFFSET
+        key, mask = key - offset, mask - offset
+        # The trailing wildcard bits form one interval, the others are
+        # enumerated.
+        low = 0
+        while mask & (1 << low):
+            low += 1
+        spread = [x for x in range(low, 128) if mask & (1 << x)]
+        if len(spread) > 16:
+            raise ValueError("Too many wildcard bits: {0}".format(value))
+        base = key & ~mask
+        ans = []
+        for combination in range(1 << len(spread)):
+            start = base
+            for i, bit in enumerate(spread):
+                if combination & (1 << i):
+                    start |= 1 << bit
+            ans.append((offset + start, offset + start + (1 << low) - 1))
+        return sorted(ans)
+    elif "-" in value:
+        return parse_address(value, "ip-range")
+    elif "/" in value:
+        address, _, length = value.partition("/")
+        return [_network(address, length)]
+    key = address_key(value)
+    return [(key, key)]
+
+
+def parse_ports(value):
+    """Parse a port list, like ``80,443,8000-8080``, into intervals
+
+    Args:
+        value (str): The ports, or a single port as an int
+
+    Returns:
+        list: (first, last) tuples
+
+    """
+    ans = []
+    for part in str(value).split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, _, last = part.partition("-")
+        first = int(first)
+        last = int(last) if last else first
+        if not 0 <= first <= last <= 65535:
+            raise ValueError("Invalid port range: {0}".format(part))
+        ans.append((first, last))
+    return ans
+
+
+class IntervalSet(object):
+    """A set of integers, stored as sorted, non overlapping intervals
+
+    Lookups bisect the interval starts, so they take logarithmic time in
+    the number of intervals.  The set shouldn't be changed once built.
+
+    Args:
+        intervals (list): (first, last) tuples, inclusive, in any order
+
+    """
+
+    __slots__ = ("starts", "ends", "_arrays")
+
+    def __init__(self, intervals=()):
+        self.starts = []
+        self.ends = []
+        self._arrays = None
+        for first, last in sorted(intervals):
+            if self.ends and first <= self.ends[-1] + 1:
+                if last > self.ends[-1]:
+                    self.ends[-1] = last
+            else:
+                self.starts.append(first)
+                self.ends.append(last)
+
+    def __contains__(self, point):
+        i = bisect.bisect_right(self.starts, point) - 1
+        return i >= 0 and point <= self.ends[i]
+
+    def __iter__(self):
+        return iter(zip(self.starts, self.ends))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, IntervalSet)
+            and self.starts == other.starts
+            and self.ends == other.ends
+        )
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "<IntervalSet {0}>".format(list(self))
+
+    def union(self, *others):
+        """The union of this set and others"""
+        intervals = list(self)
+        for other in others:
+            intervals.extend(other)
+        return IntervalSet(intervals)
+
+    def contains_many(self, points):
+        """Check many integers at once
+
+        A NumPy array is searched with ``numpy.searchsorted`` over the
+        interval starts, so the whole array is checked without a Python
+        loop.  Values above the int64 range, such as IPv6 address keys,
+        can't be in an array and are checked one at a time by the caller.
+
+        Args:
+            points: A list of integers, or a NumPy int64 array
+
+        Returns:
+            A list of bools, or a NumPy bool array for an array
+
+        """
+        if numpy is None or not isinstance(points, numpy.ndarray):
+            return [x in self for x in points]
+        if not self.starts or self.starts[0] > _INT64_MAX:
+            return numpy.zeros(len(points), dtype=bool)
+        if self._arrays is None:
+            # Intervals past the int64 range can't hold any array value
+            count = bisect.bisect_right(self.starts, _INT64_MAX)
+            starts = numpy.array(self.starts[:count], dtype=numpy.int64)
+            ends = numpy.array(
+                [min(x, _INT64_MAX) for x in self.ends[:count]], dtype=numpy.int64
+            )
+            self._arrays = (starts, ends)
+        starts, ends = self._arrays
+        i = numpy.searchsorted(starts, points, side="right") - 1
+        return (i >= 0) & (points <= ends[numpy.maximum(i, 0)])
+
+    def covers(self, first, last):
+        """True if every integer from first to last is in the set"""
+        i = bisect.bisect_right(self.starts, first) - 1
+        return i >= 0 and last <= self.ends[i]
+
+    def overlaps(self, first, last):
+        """True if any integer from first to last is in the set"""
+        i = bisect.bisect_right(self.starts, last) - 1
+        return i >= 0 and first <= self.ends[i]
+
+
+class ServiceSet(object):
+    """The protocols and destination ports of services
+
+    Args:
+        ports (dict): IP protocol number to an :class:`IntervalSet` of
+            destination ports
+        any_protocol (bool): Match every protocol and port
+
+    """
+
+    def __init__(self, ports=None, any_protocol=False):
+        self.ports = ports or {}
+        self.any_protocol = any_protocol
+
+    def matches(self, protocol, port=None):
+        """True if traffic of the protocol to the port is in the set"""
+        if self.any_protocol:
+            return True
+        ports = self.ports.get(protocol)
+        if ports is None:
+            return False
+        return port is None or port in ports
+
+    def matches_many(self, protocols, ports):
+        """Check many flows at once
+
+        Args:
+            protocols: IP protocol numbers, as a list or NumPy array
+            ports: Destination ports, with None (or -1 in an array) for
+                flows without a port
+
+        Returns:
+            A list of bools, or a NumPy bool array for arrays
+
+        """
+        if numpy is None or not isinstance(protocols, numpy.ndarray):
+            return [self.matches(x, y) for x, y in zip(protocols, ports)]
+        if self.any_protocol:
+            return numpy.ones(len(protocols), dtype=bool)
+        ans = numpy.zeros(len(protocols), dtype=bool)
+        for protocol, values in self.ports.items():
+            selected = protocols == protocol
+            if selected.any():
+                ans |= selected & ((ports < 0) | values.contains_many(ports))
+        return ans
+
+    def union(self, *others):
+        """The union of this set and others"""
+        if self.any_protocol or any(x.any_protocol for x in others):
+            return ServiceSet(any_protocol=True)
+        ports = dict(self.ports)
+        for other in others:
+            for protocol, values in other.ports.items():
+                if protocol in ports:
+                    ports[protocol] = ports[protocol].union(values)
+                else:
+                    ports[protocol] = values
+        return ServiceSet(ports)
+
+    @classmethod
+    def from_ports(cls, protocol, ports):
+        """A set of one protocol and a port list like ``80,443``"""
+        number = PROTOCOLS.get(protocol, protocol)
+        return cls({number: IntervalSet(parse_ports(ports))})
+
+
+ANY_SERVICE = ServiceSet(any_protocol=True)
+
+
+class ObjectResolver(object):
+    """Resolve the names used in rules to what they contain
+
+    Objects are looked up in the ``scopes`` in order, so list the most
+    specific scope first, such as a vsys and then its firewall, or a device
+    group, its parent device groups and then the Panorama.  The objects must
+    have been refreshed into the scopes.
+
+    Names that are not objects are parsed as literal addresses, like
+    ``10.1.1.1``, ``10.0.0.0/8`` or ``10.1.1.1-10.1.1.9``.  Names that can't
+    be resolved, such as regions, external dynamic lists, services with a
+    source port, or application filters without ``predefined``, never match
+    and are listed in :attr:`unresolved`.
+
+    Resolved names are cached.  Create a new resolver after the objects
+    change.
+
+    Args:
+        scopes (list): Containers of objects, most specific first
+        predefined (panos.predefined.Predefined): Predefined services and
+            applications, which are only looked up, never retrieved
+        fqdn (dict): Addresses to use for each fqdn address object value
+
+    Attributes:
+        unresolved (set): Names that could not be resolved
+
+    """
+
+    CLASSES = (
+        objects.AddressObject,
+        objects.AddressGroup,
+        objects.ServiceObject,
+        objects.ServiceGroup,
+        objects.ApplicationGroup,
+        objects.ApplicationFilter,
+        objects.CustomUrlCategory,
+    )
+
+    def __init__(self, scopes=(), predefined=None, fqdn=None):
+        self.predefined = predefined
+        self.fqdn = fqdn or {}
+        self.unresolved = set()
+        self._objects = dict((cls, {}) for cls in self.CLASSES)
+        for scope in scopes:
+            for cls in self.CLASSES:
+                table = self._objects[cls]
+                for obj in scope.findall(cls):
+                    table.setdefault(obj.name, obj)
+        self._addresses = {}
+        self._services = {}
+        self._applications = {}
+        self._defaults = {}
+        self._resolving = set()
+        self._catalog = None
+        self._url_categories = None
+
+    def object(self, name, cls):
+        """The object of a class with a name, or None"""
+        return self._objects[cls].get(name)
+
+    def _unresolved(self, kind, name):
+        if name not in self.unresolved:
+            logger.warning("Unable to resolve {0} {1}".format(kind, name))
+            self.unresolved.add(name)
+
+    def _enter(self, kind, name):
+        key = (kind, name)
+        if key in self._resolving:
+            raise err.PanDeviceError("{0} group loop at {1}".format(kind, name))
+        self._resolving.add(key)
+
+    def address(self, name):
+        """The addresses of an address, address group or literal
+
+        Args:
+            name (str): The name used in a rule
+
+        Returns:
+            IntervalSet
+
+        """
+        ans = self._addresses.get(name)
+        if ans is not None:
+            return ans
+        self._enter("Address", name)
+        try:
+            ans = self._address(name)
+        finally:
+            self._resolving.discard(("Address", name))
+        self._addresses[name] = ans
+        return ans
+
+    def _address(self, name):
+        if name == "any":
+            return IntervalSet([IPV4_SPACE, IPV6_SPACE])
+        obj = self.object(name, objects.AddressObject)
+        if obj is not None:
+            return self._address_object(obj)
+        group = self.object(name, objects.AddressGroup)
+        if group is not None:
+            return self._address_group(group)
+        try:
+            return IntervalSet(parse_address(name))
+        except ValueError:
+            self._unresolved("address", name)
+            return IntervalSet()
+
+    def _address_object(self, obj):
+        try:
+            if obj.type == "fqdn":
+                intervals = []
+                for address in string_or_list(self.fqdn.get(obj.value, [])):
+                    intervals.extend(parse_address(address))
+                if not intervals:
+                    self._unresolved("fqdn", obj.value)
+                return IntervalSet(intervals)
+            return IntervalSet(parse_address(obj.value, obj.type or "ip-netmask"))
+        except ValueError:
+            self._unresolved("address", obj.name)
+            return IntervalSet()
+
+    def _address_group(self, group):
+        if group.static_value is None:
+            self._unresolved("address group", group.name)
+            return IntervalSet()
+        members = [self.address(x) for x in string_or_list(group.static_value)]
+        return IntervalSet().union(*members)
+
+    def service(self, name):
+        """The protocols and ports of a service or service group
+
+        Args:
+            name (str): The name used in a rule
+
+        Returns:
+            ServiceSet
+
+        """
+        ans = self._services.get(name)
+        if ans is not None:
+            return ans
+        self._enter("Service", name)
+        try:
+            ans = self._service(name)
+        finally:
+            self._resolving.discard(("Service", name))
+        self._services[name] = ans
+        return ans
+
+    def _service(self, name):
+        if name == "any":
+            return ANY_SERVICE
+        obj = self.object(name, objects.ServiceObject)
+        if obj is None and self.predefined is not None:
+            obj = self.predefined.service(name, refresh_if_none=False)
+        if obj is not None:
+            if getattr(obj, "source_port", None):
+                # Queries have no source port, so the service can't be checked
+                self._unresolved("service", name)
+                return ServiceSet()
+            try:
+                return ServiceSet.from_ports(obj.protocol, obj.destination_port)
+            except (TypeError, ValueError):
+                self._unresolved("service", name)
+                return ServiceSet()
+        group = self.object(name, objects.ServiceGroup)
+        if group is not None:
+            members = [self.service(x) for x in string_or_list(group.value or [])]
+            return ServiceSet().union(*members)
+        self._unresolved("service", name)
+        return ServiceSet()
+
+    def application_default(self, application):
+        """The default ports of a predefined application
+
+        Returns:
+            ServiceSet: The ports, or None if they are unknown
+
+        """
+        if application in self._defaults:
+            return self._defaults[application]
+        ans = self._defaults[application] = self._application_default(application)
+        return ans
+
+    def _application_default(self, application):
+        if self.predefined is None:
+            return None
+        app = self.predefined.application(
+            application, refresh_if_none=False, include_containers=False
+        )
+        if app is None or not app.default_port:
+            return None
+        ans = ServiceSet()
+        for value in string_or_list(app.default_port):
+            protocol, _, ports = value.partition("/")
+            try:
+                ans = ans.union(ServiceSet.from_ports(protocol, ports))
+            except ValueError:
+                pass
+        return ans
+
+    def application(self, name):
+        """The applications named by an application, group or filter
+
+        Application containers are expanded to their applications when the
+        predefined applications are known.  Application filters are resolved
+        with :class:`panos.predefined.ApplicationCatalog`.
+
+        Args:
+            name (str): The name used in a rule
+
+        Returns:
+            frozenset: Application names
+
+        """
+        ans = self._applications.get(name)
+        if ans is not None:
+            return ans
+        self._enter("Application", name)
+        try:
+            ans = self._application(name)
+        finally:
+            self._resolving.discard(("Application", name))
+        self._applications[name] = ans
+        return ans
+
+    def _application(self, name):
+        group = self.object(name, objects.ApplicationGroup)
+        if group is not None:
+            ans = set()
+            for member in string_or_list(group.value or []):
+                ans.update(self.application(member))
+            return frozenset(ans)
+        app_filter = self.object(name, objects.ApplicationFilter)
+        if app_filter is not None:
+            if self.predefined is None:
+                # The applications a filter selects are only known from
+                # the predefined applications
+                self._unresolved("application filter", name)
+                return frozenset()
+            if self._catalog is None:
+                self._catalog = self.predefined.application_catalog()
+            return self._catalog.match(app_filter)
+        if self.predefined is not None:
+            container = self.predefined.application_container_objects.get(name)
+            if container is not None and container.applications:
+                return frozenset([name] + list(container.applications))
+        return frozenset([name])
+
+    def url_categories(self):
+        """The custom URL categories of the scopes, compiled
+
+        Returns:
+            UrlCategoryMatcher
+
+        """
+        if self._url_categories is None:
+            self._url_categories = UrlCategoryMatcher(
+                self._objects[objects.CustomUrlCategory].values()
+            )
+        return self._url_categories
+
+
+def parse_tag_filter(text):
+    """Parse the tag filter of a dynamic group
+
+    Filters name tags in quotes, joined with ``and`` and ``or`` and grouped
+    with parentheses, like ``'web' and ('prod' or 'staging')``.  As usual,
+    ``and`` binds tighter than ``or``.
+
+    Args:
+        text (str): The filter
+
+    Returns:
+        tuple: ``("tag", name)``, or ``("and", operands)`` or
+        ``("or", operands)`` with a tuple of operands of the same form
+
+    Raises:
+        ValueError: The filter can't be parsed
+
+    """
+    tokens = _tag_filter_tokens(text)
+    expr, pos = _tag_filter_or(tokens, 0, text)
+    if pos != len(tokens):
+        raise ValueError("Invalid tag filter: {0}".format(text))
+    return expr
+
+
+def _tag_filter_tokens(text):
+    tokens = []
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char.isspace():
+            i += 1
+        elif char in "()":
+            tokens.append(char)
+            i += 1
+        elif char in "'\"":
+            end = text.find(char, i + 1)
+            if end == -1:
+                raise ValueError("Invalid tag filter: {0}".format(text))
+            tokens.append(("tag", text[i + 1 : end]))
+            i = end + 1
+        else:
+            end = i
+            while end < len(text) and not text[end].isspace() and text[end] not in "()":
+                end += 1
+            word = text[i:end]
+            tokens.append(
+                word.lower() if word.lower() in ("and", "or") else ("tag", word)
+            )
+            i = end
+    return tokens
+
+
+def _tag_filter_or(tokens, pos, text):
+    return _tag_filter_join(tokens, pos, text, "or", _tag_filter_and)
+
+
+def _tag_filter_and(tokens, pos, text):
+    return _tag_filter_join(tokens, pos, text, "and", _tag_filter_operand)
+
+
+def _tag_filter_join(tokens, pos, text, op, operand):
+    operands = []
+    while True:
+        expr, pos = operand(tokens, pos, text)
+        operands.append(expr)
+        if pos == len(tokens) or tokens[pos] != op:
+            break
+        pos += 1
+    if len(operands) == 1:
+        return operands[0], pos
+    return (op, tuple(operands)), pos
+
+
+def _tag_filter_operand(tokens, pos, text):
+    if pos == len(tokens):
+        raise ValueError("Invalid tag filter: {0}".format(text))
+    token = tokens[pos]
+    if token == "(":
+        expr, pos = _tag_filter_or(tokens, pos + 1, text)
+        if pos == len(tokens) or tokens[pos] != ")":
+            raise ValueError("Invalid tag filter: {0}".format(text))
+        return expr, pos + 1
+    if isinstance(token, tuple):
+        return token, pos + 1
+    raise ValueError("Invalid tag filter: {0}".format(text))
+
+
+def tag_filter_tags(expr):
+    """The tags named in a parsed tag filter"""
+    if expr[0] == "tag":
+        return set([expr[1]])
+    ans = set()
+    for operand in expr[1]:
+        ans.update(tag_filter_tags(operand))
+    return ans
+
+
+def evaluate_tag_filter(expr, members):
+    """The members selected by a parsed tag filter
+
+    Args:
+        expr (tuple): As returned by :func:`parse_tag_filter`
+        members: A function returning the set of members with a tag
+
+    Returns:
+        set
+
+    """
+    if expr[0] == "tag":
+        return set(members(expr[1]))
+    if expr[0] == "or":
+        ans = set()
+        for operand in expr[1]:
+            ans.update(evaluate_tag_filter(operand, members))
+        return ans
+    # Intersect the smallest sets first
+    sets = sorted((evaluate_tag_filter(x, members) for x in expr[1]), key=len)
+    ans = sets[0]
+    for other in sets[1:]:
+        if not ans:
+            break
+        ans &= other
+    return ans
+
+
+class GroupResolver(object):
+    """Flatten the membership of address and service groups
+
+    Each group is expanded once, and nested groups that are shared by many
+    groups are only expanded once too.  The members of a group are the
+    names of the objects it holds through any depth of nested groups, along
+    with the registered IPs of dynamic address groups.
+
+    Dynamic address groups select the address objects and registered IPs
+    with the tags in their filter.  Both are indexed by tag, so a filter
+    costs a few set operations.  Registered IPs are given as returned by
+    :meth:`panos.userid.UserId.get_registered_ip`, and kept up to date with
+    :meth:`register` and :meth:`unregister`.
+
+    Cached groups are dropped when something they depend on changes: a
+    member object or group given to :meth:`update` or :meth:`remove`, or a
+    tag in their filter gaining or losing an object or IP.  Only the groups
+    containing the change are expanded again.
+
+    Args:
+        scopes (list): Containers of objects, most specific first
+        registered_ip (dict): Registered IPs, mapping each IP to its tags
+
+    """
+
+    CLASSES = {
+        objects.AddressObject: "address",
+        objects.AddressGroup: "address",
+        objects.ServiceObject: "service",
+        objects.ServiceGroup: "service",
+    }
+
+    def __init__(self, scopes=(), registered_ip=None):
+        self._objects = dict((cls, {}) for cls in self.CLASSES)
+        self._tag_objects = {}
+        # The tags indexed for each address object, as objects are often
+        # changed in place before being updated
+        self._indexed_tags = {}
+        self._tag_ips = {}
+        self._members = {}
+        self._parents = {}
+        self._children = {}
+        self._tag_groups = {}
+        self._resolving = set()
+        for scope in scopes:
+            for cls in self.CLASSES:
+                for obj in scope.findall(cls):
+                    if obj.name not in self._objects[cls]:
+                        self._add(obj)
+        for ip, tags in (registered_ip or {}).items():
+            self.register(ip, tags)
+
+    def object(self, name, cls):
+        """The object of a class with a name, or None"""
+        return self._objects[cls].get(name)
+
+    def _add(self, obj):
+        self._objects[type(obj)][obj.name] = obj
+        if isinstance(obj, objects.AddressObject):
+            tags = frozenset(string_or_list(obj.tag) or ())
+            self._indexed_tags[obj.name] = tags
+            for tag in tags:
+                self._tag_objects.setdefault(tag, set()).add(obj.name)
+
+    def _tags_changed(self, tags):
+        for tag in tags:
+            for name in list(self._tag_groups.get(tag, ())):
+                self._invalidate(("address", name))
+
+    def update(self, obj):
+        """Add or replace an address or service object or group"""
+        cls = type(obj)
+        if cls is not objects.AddressObject:
+            self._objects[cls][obj.name] = obj
+            self._invalidate((self.CLASSES[cls], obj.name))
+            return
+        # Only the groups selecting the object by a tag it gained or lost
+        # can change
+        old_tags = self._indexed_tags.get(obj.name, frozenset())
+        for tag in old_tags:
+            self._discard(self._tag_objects, tag, obj.name)
+        self._add(obj)
+        self._tags_changed(old_tags ^ self._indexed_tags[obj.name])
+
+    def remove(self, name, cls):
+        """Remove an address or service object or group by name"""
+        obj = self._objects[cls].pop(name, None)
+        if obj is None:
+            return
+        if cls is objects.AddressObject:
+            tags = self._indexed_tags.pop(name)
+            for tag in tags:
+                self._discard(self._tag_objects, tag, name)
+            self._tags_changed(tags)
+        else:
+            self._invalidate((self.CLASSES[cls], name))
+
+    def register(self, ip, tags):
+        """Add tags to a registered IP
+
+        Args:
+            ip (str): The IP
+            tags (list): The tags, as on the device
+
+        """
+        changed = []
+        for tag in string_or_list(tags):
+            ips = self._tag_ips.setdefault(tag, set())
+            if ip not in ips:
+                ips.add(ip)
+                changed.append(tag)
+        self._tags_changed(changed)
+
+    def unregister(self, ip, tags):
+        """Remove tags from a registered IP"""
+        changed = []
+        for tag in string_or_list(tags):
+            if ip in self._tag_ips.get(tag, ()):
+                self._discard(self._tag_ips, tag, ip)
+                changed.append(tag)
+        self._tags_changed(changed)
+
+    @staticmethod
+    def _discard(index, key, value):
+        values = index.get(key)
+        if values is not None:
+            values.discard(value)
+            if not values:
+                del index[key]
+
+    def _invalidate(self, key):
+        """Drop a cached group and every group containing it"""
+        stack = [key]
+        while stack:
+            key = stack.pop()
+            self._members.pop(key, None)
+            for parent in self._parents.pop(key, ()):
+                if parent in self._members:
+                    stack.append(parent)
+            self._forget(key)
+
+    def _forget(self, key):
+        """Drop the dependencies of a group that isn't cached"""
+        for child in self._children.pop(key, ()):
+            if isinstance(child, tuple):
+                self._discard(self._parents, child, key)
+            else:
+                self._discard(self._tag_groups, child, key[1])
+
+    def address_members(self, name):
+        """The members of an address group, with nested groups expanded
+
+        Args:
+            name (str): The address group
+
+        Returns:
+            frozenset: Address object names and registered IPs.  Members
+            that aren't groups are returned as named, found or not.
+
+        """
+        return self._resolve(("address", name))
+
+    def service_members(self, name):
+        """The members of a service group, with nested groups expanded
+
+        Args:
+            name (str): The service group
+
+        Returns:
+            frozenset: Service names, including predefined services
+
+        """
+        return self._resolve(("service", name))
+
+    def _resolve(self, key):
+        ans = self._members.get(key)
+        if ans is not None:
+            return ans
+        if key in self._resolving:
+            raise err.PanDeviceError(
+                "{0} group loop at {1}".format(key[0].capitalize(), key[1])
+            )
+        self._resolving.add(key)
+        try:
+            kind, name = key
+            if kind == "address":
+                ans = self._address_group(name)
+            else:
+                ans = self._service_group(name)
+        finally:
+            self._resolving.discard(key)
+        self._members[key] = ans
+        return ans
+
+    def _depend(self, key, child):
+        self._children.setdefault(key, set()).add(child)
+        if isinstance(child, tuple):
+            self._parents.setdefault(child, set()).add(key)
+        else:
+            self._tag_groups.setdefault(child, set()).add(key[1])
+
+    def _expand(self, key, cls, names):
+        ans = set()
+        for member in names:
+            child = (key[0], member)
+            self._depend(key, child)
+            if member in self._objects[cls]:
+                ans.update(self._resolve(child))
+            else:
+                ans.add(member)
+        return ans
+
+    def _address_group(self, name):
+        key = ("address", name)
+        self._forget(key)
+        group = self._objects[objects.AddressGroup].get(name)
+        if group is None:
+            return frozenset()
+        ans = self._expand(
+            key, objects.AddressGroup, string_or_list(group.static_value) or ()
+        )
+        if group.dynamic_value:
+            try:
+                expr = parse_tag_filter(group.dynamic_value)
+            except ValueError:
+                logger.warning("Unable to parse the filter of {0}".format(name))
+            else:
+                for tag in tag_filter_tags(expr):
+                    self._depend(key, tag)
+                ans.update(evaluate_tag_filter(expr, self._tagged))
+        return frozenset(ans)
+
+    def _tagged(self, tag):
+        return self._tag_objects.get(tag, set()) | self._tag_ips.get(tag, set())
+
+    def _service_group(self, name):
+        key = ("service", name)
+        self._forget(key)
+        group = self._objects[objects.ServiceGroup].get(name)
+        if group is None:
+            return frozenset()
+        return frozenset(
+            self._expand(key, objects.ServiceGroup, string_or_list(group.value) or ())
+        )
+
+
+def _tag_filter_holds(expr, tags):
+    """True if a parsed tag filter selects something with a set of tags"""
+    if expr[0] == "tag":
+        return expr[1] in tags
+    if expr[0] == "or":
+        return any(_tag_filter_holds(x, tags) for x in expr[1])
+    return all(_tag_filter_holds(x, tags) for x in expr[1])
+
+
+class DynamicUserGroupEvaluator(object):
+    """Work out the members of dynamic user groups from user tags
+
+    The filter of each :class:`panos.objects.DynamicUserGroup` is parsed
+    once.  Users are indexed by tag, so the members of every group are
+    found with set operations over the index instead of checking each user
+    against each filter.  Membership is then kept up to date as users are
+    tagged and untagged: only the groups whose filter names a changed tag
+    are checked, and only for that user.
+
+    To follow the tags sent through a :class:`panos.userid.UserId`, start
+    from its current tags and :meth:`watch` it::
+
+        evaluator = DynamicUserGroupEvaluator.from_scopes(
+            fw, user_tags=fw.userid.get_user_tags()
+        )
+        evaluator.watch(fw.userid)
+        fw.userid.tag_user("alice", ["quarantine"])
+        evaluator.groups_for_user("alice")
+
+    Tags are given as on the device, including any :class:`UserId` prefix.
+
+    Args:
+        groups (list): DynamicUserGroup objects
+        user_tags (dict): The tags of each user, as returned by
+            :meth:`panos.userid.UserId.get_user_tags`
+
+    """
+
+    def __init__(self, groups=(), user_tags=None):
+        self._filters = {}
+        self._tag_groups = {}
+        self._user_tags = {}
+        self._tag_users = {}
+        self._members = {}
+        for user, tags in (user_tags or {}).items():
+            for tag in tags:
+                self._link(user, tag)
+        for group in groups:
+            self.add(group)
+
+    @classmethod
+    def from_scopes(cls, *scopes, **kwargs):
+        """Evaluate the dynamic user groups refreshed into scopes
+
+        Args:
+            *scopes: Containers of objects, most specific first.  A group
+                hides groups of the same name in later scopes.
+            **kwargs: Passed to :class:`DynamicUserGroupEvaluator`
+
+        Returns:
+            DynamicUserGroupEvaluator
+
+        """
+        found = {}
+        for scope in scopes:
+            for group in scope.findall(objects.DynamicUserGroup):
+                found.setdefault(group.name, group)
+        return cls(found.values(), **kwargs)
+
+    def _link(self, user, tag):
+        self._user_tags.setdefault(user, set()).add(tag)
+        self._tag_users.setdefault(tag, set()).add(user)
+
+    def _unlink(self, user, tag):
+        for index, a, b in ((self._user_tags, user, tag), (self._tag_users, tag, user)):
+            values = index.get(a)
+            if values is not None:
+                values.discard(b)
+                if not values:
+                    del index[a]
+
+    def add(self, group):
+        """Add or replace a dynamic user group, and find its members
+
+        Returns:
+            bool: False if the filter can't be parsed, so the group is empty
+
+        """
+        self.remove(group.name)
+        try:
+            expr = parse_tag_filter(group.filter or "")
+        except ValueError:
+            logger.warning("Unable to parse the filter of {0}".format(group.name))
+            self._members[group.name] = set()
+            return False
+        self._filters[group.name] = expr
+        for tag in tag_filter_tags(expr):
+            self._tag_groups.setdefault(tag, set()).add(group.name)
+        self._members[group.name] = evaluate_tag_filter(
+            expr, lambda x: self._tag_users.get(x, ())
+        )
+        return True
+
+    def remove(self, name):
+        """Remove a dynamic user group by name"""
+        self._members.pop(name, None)
+        expr = self._filters.pop(name, None)
+        if expr is None:
+            return
+        for tag in tag_filter_tags(expr):
+            groups = self._tag_groups[tag]
+            groups.discard(name)
+            if not groups:
+                del self._tag_groups[tag]
+
+    def members(self, name):
+        """The users in a dynamic user group
+
+        Returns:
+            frozenset: User names
+
+        """
+        return frozenset(self._members.get(name, ()))
+
+    def membership(self):
+        """The users in every dynamic user group
+
+        Returns:
+            dict: Group names as keys with frozensets of users as values
+
+        """
+        return dict((k, frozenset(v)) for k, v in self._members.items())
+
+    def groups_for_user(self, user):
+        """The dynamic user groups a user is in
+
+        Returns:
+            set: Group names
+
+        """
+        tags = self._user_tags.get(user, ())
+        names = set()
+        for tag in tags:
+            names.update(self._tag_groups.get(tag, ()))
+        return set(x for x in names if _tag_filter_holds(self._filters[x], tags))
+
+    def _recheck(self, user, tags):
+        """Update the groups naming changed tags for one user"""
+        groups = set()
+        for tag in tags:
+            groups.update(self._tag_groups.get(tag, ()))
+        current = self._user_tags.get(user, ())
+        for name in groups:
+            if _tag_filter_holds(self._filters[name], current):
+                self._members[name].add(user)
+            else:
+                self._members[name].discard(user)
+
+    def tag_user(self, user, tags):
+        """Add tags to a user
+
+        Args:
+            user (str): The user
+            tags (list): The tags, as on the device
+
+        """
+        tags = [
+            x for x in string_or_list(tags) if x not in self._user_tags.get(user, ())
+        ]
+        for tag in tags:
+            self._link(user, tag)
+        self._recheck(user, tags)
+
+    def untag_user(self, user, tags=None):
+        """Remove tags from a user, or all of the user's tags if tags is None"""
+        current = self._user_tags.get(user, set())
+        if tags is None:
+            tags = list(current)
+        tags = [x for x in string_or_list(tags) if x in current]
+        for tag in tags:
+            self._unlink(user, tag)
+        self._recheck(user, tags)
+
+    def apply(self, message):
+        """Apply the user tag operations of a message
+
+        Args:
+            message (panos.userid.UidMessage): The operations being sent
+
+        """
+        for name, section in message.operations():
+            if name == "register-user":
+                for user, tags in section.items():
+                    self.tag_user(user, list(tags))
+            elif name == "unregister-user":
+                for user, tags in section.items():
+                    self.untag_user(user, None if tags is None else list(tags))
+
+    def watch(self, userid):
+        """Apply the messages sent through a UserId from now on
+
+        Args:
+            userid (panos.userid.UserId): The User-ID subsystem to follow
+
+        """
+        if self not in userid.listeners:
+            userid.listeners.append(self)
+
+    def unwatch(self, userid):
+        """Stop applying the messages sent through a UserId"""
+        if self in userid.listeners:
+            userid.listeners.remove(self)
+
+
+class AddressIndex(object):
+    """Find address objects by the addresses they contain
+
+    Each address object is parsed once into intervals, which are split
+    into aligned CIDR blocks.  The blocks are kept in a dict by family,
+    prefix length and network, so the objects containing an address are
+    found with one lookup per prefix length in use, and the objects
+    overlapping it with a bisect of the sorted interval starts on top.
+    Objects with the same intervals are grouped for duplicate lookups.
+
+    The index is updated in place by :meth:`add` and :meth:`remove`, so
+    call them as objects change.  Address groups, including dynamic ones,
+    are expanded by a :class:`GroupResolver` for :meth:`groups_containing`.
+
+    FQDN objects have no addresses unless ``fqdn`` has addresses for their
+    value; they can also be found by FQDN with :meth:`fqdn_objects`.
+
+    Args:
+        objects (list): AddressObjects and AddressGroups
+        fqdn (dict): Resolved FQDNs, mapping each FQDN to a list of addresses
+
+    """
+
+    def __init__(self, objects=(), fqdn=None):
+        self.fqdn = fqdn or {}
+        self.addresses = {}
+        self.groups = {}
+        self._intervals = {}
+        self._blocks = {}
+        self._lengths = {IPV4_BITS: {}, IPV6_BITS: {}}
+        self._starts = []
+        self._duplicates = {}
+        self._fqdns = {}
+        # What was indexed for each object, which can be changed in place
+        # before being added again
+        self._indexed_fqdn = {}
+        self._resolver = GroupResolver()
+        self._member_of = None
+        for obj in objects:
+            self.add(obj)
+
+    @classmethod
+    def from_scopes(cls, *scopes, **kwargs):
+        """Index the address objects and groups refreshed into scopes
+
+        Args:
+            *scopes: Containers of objects, most specific first.  An
+                object hides objects of the same name in later scopes.
+            **kwargs: Passed to :class:`AddressIndex`
+
+        Returns:
+            AddressIndex
+
+        """
+        seen = set()
+        found = []
+        for scope in scopes:
+            for obj_cls in (objects.AddressObject, objects.AddressGroup):
+                for obj in scope.findall(obj_cls):
+                    if (obj_cls, obj.name) not in seen:
+                        seen.add((obj_cls, obj.name))
+                        found.append(obj)
+        return cls(found, **kwargs)
+
+    def add(self, obj):
+        """Add or update an AddressObject or AddressGroup
+
+        Returns:
+            bool: False if an address object's value can't be parsed, so it
+            contains no addresses
+
+        """
+        self._member_of = None
+        self._resolver.update(obj)
+        if isinstance(obj, objects.AddressGroup):
+            self.groups[obj.name] = obj
+            return True
+        self._unindex(obj.name)
+        self.addresses[obj.name] = obj
+        if obj.type == "fqdn" and obj.value:
+            fqdn = self._indexed_fqdn[obj.name] = obj.value.lower()
+            self._fqdns.setdefault(fqdn, set()).add(obj.name)
+        try:
+            intervals = self._parse(obj)
+        except ValueError:
+            logger.warning("Unable to parse address object {0}".format(obj.name))
+            intervals = ()
+        self._intervals[obj.name] = intervals
+        self._duplicates.setdefault(intervals, set()).add(obj.name)
+        for first, last in intervals:
+            bisect.insort(self._starts, (first, last, obj.name))
+            for block in _blocks(first, last):
+                self._blocks.setdefault(block, set()).add(obj.name)
+                lengths = self._lengths[block[0]]
+                lengths[block[1]] = lengths.get(block[1], 0) + 1
+        return bool(intervals)
+
+    def remove(self, name, group=False):
+        """Remove an address object, or an address group, by name"""
+        self._member_of = None
+        if group:
+            self._resolver.remove(name, objects.AddressGroup)
+            self.groups.pop(name, None)
+            return
+        self._resolver.remove(name, objects.AddressObject)
+        self._unindex(name)
+
+    def _unindex(self, name):
+        if self.addresses.pop(name, None) is None:
+            return
+        fqdn = self._indexed_fqdn.pop(name, None)
+        if fqdn is not None:
+            self._discard(self._fqdns, fqdn, name)
+        intervals = self._intervals.pop(name)
+        self._discard(self._duplicates, intervals, name)
+        for first, last in intervals:
+            i = bisect.bisect_left(self._starts, (first, last, name))
+            del self._starts[i]
+            for block in _blocks(first, last):
+                self._discard(self._blocks, block, name)
+                lengths = self._lengths[block[0]]
+                lengths[block[1]] -= 1
+                if not lengths[block[1]]:
+                    del lengths[block[1]]
+
+    @staticmethod
+    def _discard(index, key, name):
+        names = index.get(key)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del index[key]
+
+    def _parse(self, obj):
+        if obj.type == "fqdn":
+            intervals = []
+            for address in string_or_list(self.fqdn.get(obj.value, [])):
+                intervals.extend(parse_address(address))
+        else:
+            intervals = parse_address(obj.value, obj.type or "ip-netmask")
+        return tuple(IntervalSet(intervals))
+
+    def _covering(self, block):
+        """The objects with a block holding a block"""
+        bits, length, network = block
+        ans = set()
+        for prefix in self._lengths[bits]:
+            if prefix <= length:
+                host = bits - prefix
+                names = self._blocks.get((bits, prefix, network >> host << host))
+                if names:
+                    ans.update(names)
+        return ans
+
+    def containing(self, address):
+        """The names of the address objects containing all of an address
+
+        Args:
+            address (str): An IP address, network or range
+
+        Returns:
+            set
+
+        """
+        ans = None
+        for first, last in parse_address(address):
+            for block in _blocks(first, last):
+                names = self._covering(block)
+                ans = names if ans is None else ans & names
+                if not ans:
+                    return set()
+        return ans or set()
+
+    def overlapping(self, address):
+        """The names of the address objects sharing addresses with an address
+
+        Args:
+            address (str): An IP address, network or range
+
+        Returns:
+            set
+
+        """
+        ans = set()
+        for first, last in parse_address(address):
+            # Starting before the address and reaching into it...
+            ans.update(self.containing(format_address(first)))
+            # ...or starting in it
+            i = bisect.bisect_left(self._starts, (first,))
+            while i < len(self._starts) and self._starts[i][0] <= last:
+                ans.add(self._starts[i][2])
+                i += 1
+        return ans
+
+    def duplicates(self, address=None):
+        """Find address objects with the same addresses
+
+        Args:
+            address (str): Find the objects with exactly these addresses.
+                If not given, find every set of duplicate objects.
+
+        Returns:
+            A set of names for an address, otherwise a list of sets of
+            names of objects with the same addresses
+
+        """
+        if address is not None:
+            intervals = tuple(IntervalSet(parse_address(address)))
+            return set(self._duplicates.get(intervals, ()))
+        return [set(x) for k, x in self._duplicates.items() if k and len(x) > 1]
+
+    def fqdn_objects(self, fqdn):
+        """The names of the FQDN address objects for a name"""
+        return set(self._fqdns.get(fqdn.lower(), ()))
+
+    def group_members(self, name):
+        """The members of an address group, with nested groups expanded"""
+        return self._resolver.address_members(name)
+
+    def groups_containing(self, address):
+        """The names of the address groups with a member containing an address
+
+        Args:
+            address (str): An IP address, network or range
+
+        Returns:
+            set
+
+        """
+        if self._member_of is None:
+            self._member_of = {}
+            for group in self.groups:
+                for member in self.group_members(group):
+                    self._member_of.setdefault(member, set()).add(group)
+        ans = set()
+        for name in self.containing(address):
+            ans.update(self._member_of.get(name, ()))
+        return ans
+
+
+def _blocks(first, last):
+    """Split an interval of address keys into aligned CIDR blocks
+
+    Yields:
+        (family bits, prefix length, network) tuples, with the network in
+        the address family's own space
+
+    """
+    if first >= IPV6_OFFSET:
+        bits, offset = IPV6_BITS, IPV6_OFFSET
+    else:
+        bits, offset = IPV4_BITS, 0
+    first -= offset
+    last -= offset
+    while first <= last:
+        size = first & -first if first else 1 << bits
+        while size > last - first + 1:
+            size >>= 1
+        yield bits, bits - size.bit_length() + 1, first
+        first += size
+
+
+class UrlCategoryMatcher(object):
+    """Find the custom URL categories of URLs
+
+    The entries of the URL list categories are compiled into one trie of
+    host names, keyed by label from the top level domain down, so a URL
+    is looked up by walking its host name instead of comparing it to every
+    entry.  Entries follow the PAN-OS rules:
+
+    * ``*`` stands for one or more labels and ``^`` for exactly one, as in
+      ``*.example.com`` or ``www.example.^``.
+    * An entry with a path, like ``example.com/docs``, matches URLs of
+      that host whose path starts with it; ``example.com/`` matches every
+      path of the host.
+    * An entry without a slash also matches host names that continue to
+      the right, so ``example.com`` matches ``example.com.au``.
+
+    Matching ignores case, and the scheme, port and credentials of URLs.
+    Categories of the ``Category Match`` type depend on the predefined
+    categories of the URL, which aren't known offline, so they never match.
+
+    Args:
+        categories (list): CustomUrlCategory objects
+
+    """
+
+    def __init__(self, categories=()):
+        self.categories = {}
+        self._root = None
+        for category in categories:
+            self.add(category)
+
+    @classmethod
+    def from_scopes(cls, *scopes):
+        """Compile the custom URL categories refreshed into scopes
+
+        Args:
+            *scopes: Containers of objects, most specific first.  A
+                category hides categories of the same name in later scopes.
+
+        Returns:
+            UrlCategoryMatcher
+
+        """
+        found = {}
+        for scope in scopes:
+            for category in scope.findall(objects.CustomUrlCategory):
+                found.setdefault(category.name, category)
+        return cls(found.values())
+
+    def add(self, category):
+        """Add or replace a CustomUrlCategory"""
+        self.categories[category.name] = category
+        self._root = None
+
+    def remove(self, name):
+        """Remove a custom URL category by name"""
+        if self.categories.pop(name, None) is not None:
+            self._root = None
+
+    def _compile(self):
+        root = _UrlNode()
+        for name, category in self.categories.items():
+            if category.type and category.type.lower() != "url list":
+                continue
+            for entry in string_or_list(category.url_value) or ():
+                labels, path = _split_url(entry)
+                if not labels:
+                    continue
+                node = root
+                for label in reversed(labels):
+                    node = node.children.setdefault(label, _UrlNode())
+                if path:
+                    node.paths.append((path, name))
+                else:
+                    node.open.add(name)
+        return root
+
+    def categories_for(self, url):
+        """The custom URL categories a URL is in
+
+        Args:
+            url (str): A URL, like ``https://www.example.com/index.html``,
+                or a host name
+
+        Returns:
+            set: Category names
+
+        """
+        if self._root is None:
+            self._root = self._compile()
+        labels, path = _split_url(url)
+        if not labels:
+            return set()
+        path = path or "/"
+        ans = set()
+        for end in range(len(labels), 0, -1):
+            # Entries without a path match the labels up to any point
+            for node in self._root.walk(labels[end - 1 :: -1], 0):
+                ans.update(node.open)
+                if end == len(labels):
+                    for prefix, name in node.paths:
+                        if path.startswith(prefix):
+                            ans.add(name)
+        return ans
+
+
+class _UrlNode(object):
+    """A node of the host name trie of UrlCategoryMatcher"""
+
+    __slots__ = ("children", "open", "paths")
+
+    def __init__(self):
+        self.children = {}
+        self.open = set()
+        self.paths = []
+
+    def walk(self, labels, i):
+        """The nodes reached by the labels from position i"""
+        if i == len(labels):
+            yield self
+            return
+        for key in (labels[i], "^"):
+            child = self.children.get(key)
+            if child is not None:
+                for node in child.walk(labels, i + 1):
+                    yield node
+        child = self.children.get("*")
+        if child is not None:
+            for end in range(i + 1, len(labels) + 1):
+                for node in child.walk(labels, end):
+                    yield node
+
+
+def _split_url(url):
+    """Split a URL into its host name labels and its path"""
+    url = url.strip().lower()
+    if "://" in url:
+        url = url.split("://", 1)[1]
+    end = len(url)
+    for char in "/?#":
+        pos = url.find(char)
+        if pos != -1 and pos < end:
+            end = pos
+    host, path = url[:end], url[end:]
+    if path and path[0] != "/":
+        path = "/" + path
+    host = host.rsplit("@", 1)[-1]
+    if host.startswith("["):
+        host = host[1:].split("]", 1)[0]
+    elif host.count(":") == 1:
+        host = host.split(":", 1)[0]
+    host = host.strip(".")
+    return (host.split(".") if host else []), path
+
+
+class _CompiledSecurityRule(object):
+    """The parts of a security rule, resolved for matching
+
+    Each part is None when it matches anything.
+
+    """
+
+    __slots__ = (
+        "index",
+        "name",
+        "action",
+        "rule",
+        "type",
+        "fromzone",
+        "tozone",
+        "source",
+        "negate_source",
+        "destination",
+        "negate_destination",
+        "source_user",
+        "application",
+        "service",
+        "application_default",
+        "category",
+    )
+
+
+def _members(value):
+    """The members of a rule field, or None if it is any"""
+    value = string_or_list(value)
+    if not value or "any" in value:
+        return None
+    return value
+
+
+class SecurityPolicyEngine(object):
+    """Match traffic against security rules locally
+
+    The rules are compiled once, with every address, service and
+    application name resolved by an :class:`ObjectResolver`.  Matching
+    follows :meth:`panos.base.PanDevice.test_security_policy_match`: the
+    first rule that matches is returned, or with ``show_all`` every rule
+    that matches up to and including the first one that allows the
+    traffic.  Disabled rules are skipped, and negated sources and
+    destinations are honored.
+
+    A criterion that isn't given, such as the application or the zones,
+    isn't checked, so rules are matched on what is known about the flow.
+    When the application is given, ``application-default`` services match
+    the default ports of the predefined application, and any port if those
+    are unknown.  ``user_groups`` maps a user to the groups it belongs to,
+    for rules that list groups as source users.
+
+    The URL categories of a flow are the ``category`` given and, when a
+    ``url`` is given, the custom URL categories it is in, found with the
+    ``url_categories`` of the resolver.  A rule matches if it lists any of
+    them.
+
+    The result of a flow is a list of dicts with the ``name`` of the rule,
+    its 1-based ``index`` in the list of rules, and its ``action``.  Traffic
+    that matches no rule returns an empty list, as the default intrazone
+    and interzone rules aren't modeled.
+
+    Args:
+        rules (list): The SecurityRules, in order
+        resolver (ObjectResolver): Resolves object names.  Defaults to one
+            that only knows literal addresses.
+        user_groups (dict): User name to a list of group names
+        url_categories (UrlCategoryMatcher): Finds the custom URL categories
+            of URLs.  Defaults to the custom URL categories of the resolver.
+
+    """
+
+    def __init__(self, rules, resolver=None, user_groups=None, url_categories=None):
+        self.rules = list(rules)
+        self.resolver = resolver if resolver is not None else ObjectResolver()
+        self.user_groups = user_groups or {}
+        self.url_categories = url_categories
+        self._compiled = [
+            self._compile(i, rule)
+            for i, rule in enumerate(self.rules, 1)
+            if not rule.disabled
+        ]
+        self._candidates = {}
+
+    @classmethod
+    def from_rulebases(cls, *rulebases, **kwargs):
+        """Build an engine from the security rules of rulebases
+
+        The rules of all rulebases are matched in the order given, so pass
+        the pre-rulebases, the local rulebase and the post-rulebases in the
+        order the device evaluates them.  Objects are looked up in the
+        parents of the rulebases, and predefined objects in the Predefined
+        of the device, unless an ``resolver`` is given.
+
+        Args:
+            *rulebases: Rulebases with their security rules refreshed
+            **kwargs: Passed to :class:`SecurityPolicyEngine`
+
+        Returns:
+            SecurityPolicyEngine
+
+        """
+        rules = []
+        for rulebase in rulebases:
+            rules.extend(rulebase.findall(policies.SecurityRule))
+        if kwargs.get("resolver") is None:
+            kwargs["resolver"] = _rulebase_resolver(rulebases)
+        return cls(rules, **kwargs)
+
+    def _compile(self, index, rule):
+        resolver = self.resolver
+        c = _CompiledSecurityRule()
+        c.index = index
+        c.name = rule.name
+        c.action = rule.action
+        c.rule = rule
+        c.type = rule.type or "universal"
+        c.fromzone = _set_or_none(rule.fromzone)
+        c.tozone = _set_or_none(rule.tozone)
+        c.negate_source = bool(rule.negate_source)
+        c.negate_destination = bool(rule.negate_destination)
+
+        values = _members(rule.source)
+        c.source = None
+        if values is not None:
+            c.source = IntervalSet().union(*[resolver.address(x) for x in values])
+        values = _members(rule.destination)
+        c.destination = None
+        if values is not None:
+            c.destination = IntervalSet().union(*[resolver.address(x) for x in values])
+
+        c.source_user = _set_or_none(rule.source_user)
+
+        values = _members(rule.application)
+        c.application = None
+        if values is not None:
+            apps = set()
+            for value in values:
+                apps.update(resolver.application(value))
+            c.application = frozenset(apps)
+
+        values = string_or_list(rule.service) or ["application-default"]
+        c.service = None
+        c.application_default = False
+        if "application-default" in values:
+            c.application_default = True
+        elif "any" not in values:
+            c.service = ServiceSet().union(*[resolver.service(x) for x in values])
+
+        c.category = _set_or_none(rule.category)
+        return c
+
+    def _zone_candidates(self, from_zone, to_zone):
+        """The compiled rules that can match traffic between two zones"""
+        key = (from_zone, to_zone)
+        ans = self._candidates.get(key)
+        if ans is not None:
+            return ans
+        ans = []
+        for c in self._compiled:
+            if from_zone is not None:
+                if c.fromzone is not None and from_zone not in c.fromzone:
+                    continue
+            if to_zone is not None and c.type != "intrazone":
+                if c.tozone is not None and to_zone not in c.tozone:
+                    continue
+            if from_zone is not None and to_zone is not None:
+                if c.type == "intrazone" and from_zone != to_zone:
+                    continue
+                if c.type == "interzone" and from_zone == to_zone:
+                    continue
+            ans.append(c)
+        self._candidates[key] = ans
+        return ans
+
+    def _user_matches(self, c, user):
+        if c.source_user is None:
+            return True
+        if "known-user" in c.source_user and user != "unknown":
+            return True
+        if user in c.source_user:
+            return True
+        for group in self.user_groups.get(user, ()):
+            if group in c.source_user:
+                return True
+        return False
+
+    def _service(self, c, application):
+        """The ServiceSet a rule matches for an application, or None for any"""
+        if c.service is not None:
+            return c.service
+        if c.application_default and application is not None:
+            return self.resolver.application_default(application)
+        return None
+
+    def _matches(self, c, src, dst, protocol, application, categories, port, user):
+        if c.source is not None and (src in c.source) == c.negate_source:
+            return False
+        if c.destination is not None and (
+            (dst in c.destination) == c.negate_destination
+        ):
+            return False
+        service = self._service(c, application)
+        if service is not None and not service.matches(protocol, port):
+            return False
+        return self._flow_matches(c, application, categories, user)
+
+    def _flow_matches(self, c, application, categories, user):
+        """Check the criteria that aren't addresses or services"""
+        if application is not None and c.application is not None:
+            if application not in c.application:
+                return False
+        if categories is not None and c.category is not None:
+            if c.category.isdisjoint(categories):
+                return False
+        if user is not None and not self._user_matches(c, user):
+            return False
+        return True
+
+    def _categories(self, category, url):
+        """The URL categories of a flow, or None if they are unknown"""
+        ans = set()
+        if category is not None:
+            ans.add(category)
+        if url is not None:
+            if self.url_categories is None:
+                self.url_categories = self.resolver.url_categories()
+            ans.update(self.url_categories.categories_for(url))
+        return frozenset(ans) if ans else None
+
+    def match(
+        self,
+        source,
+        destination,
+        protocol,
+        application=None,
+        category=None,
+        port=None,
+        user=None,
+        from_zone=None,
+        to_zone=None,
+        show_all=False,
+        url=None,
+    ):
+        """Find the rules that match a flow
+
+        Takes the same arguments as
+        :meth:`panos.base.PanDevice.test_security_policy_match`, and a URL.
+
+        Args:
+            source (str): Source IP address.
+            destination (str): Destination IP address.
+            protocol (int): IP protocol value (1-255).
+            application (str): Application name.
+            category (str): Category name.
+            port (int): Destination port.
+            user (str): Source user.
+            from_zone (str): Source zone name.
+            to_zone (str): Destination zone name.
+            show_all (bool): Show all potential match rules until first allow.
+            url (str): The URL, matched against the custom URL categories.
+
+        Returns:
+            List of dicts
+
+        """
+        categories = self._categories(category, url)
+        src = address_key(source)
+        dst = address_key(destination)
+        protocol = int(protocol)
+        if port is not None:
+            port = int(port)
+        ans = []
+        for c in self._zone_candidates(from_zone, to_zone):
+            if self._matches(
+                c, src, dst, protocol, application, categories, port, user
+            ):
+                ans.append({"name": c.name, "index": c.index, "action": c.action})
+                if not show_all or c.action == "allow":
+                    break
+        return ans
+
+    def match_many(self, flows, show_all=False):
+        """Find the rules that match each of many flows
+
+        Args:
+            flows (list): Dicts with the arguments of :meth:`match`
+            show_all (bool): Show all potential match rules until first allow.
+
+        Returns:
+            list: The result of :meth:`match` for each flow
+
+        """
+        return [self.match(show_all=show_all, **flow) for flow in flows]
+
+    def match_indexes(self, flows, show_all=False):
+        """Find the indexes of the rules that match each of many flows
+
+        Flows are grouped by their application, URL categories, user and zones,
+        so those are checked once per group.  Within a group each rule is
+        checked against all the flows it can still match at once: the
+        addresses and services are sorted integer intervals, searched for
+        the whole batch with NumPy when it is installed.  Without NumPy
+        each flow is checked in turn.
+
+        Args:
+            flows (list): Dicts with the arguments of :meth:`match`
+            show_all (bool): Show all potential match rules until first allow.
+
+        Returns:
+            list: For each flow, the list of the 1-based indexes of the
+            rules that match it, as in :meth:`match`
+
+        """
+        ans = [[] for _ in flows]
+        groups = {}
+        for position, flow in enumerate(flows):
+            key = (
+                flow.get("application"),
+                self._categories(flow.get("category"), flow.get("url")),
+                flow.get("user"),
+                flow.get("from_zone"),
+                flow.get("to_zone"),
+            )
+            groups.setdefault(key, []).append(position)
+        for key, positions in groups.items():
+            application, categories, user, from_zone, to_zone = key
+            rules = [
+                (c, self._service(c, application))
+                for c in self._zone_candidates(from_zone, to_zone)
+                if self._flow_matches(c, application, categories, user)
+            ]
+            if not rules:
+                continue
+            batch = _FlowBatch([flows[x] for x in positions])
+            for i, c in _match_batch(batch, rules, show_all):
+                ans[positions[i]].append(c.index)
+        return ans
+
+
+class _CompiledNatRule(object):
+    """The parts of a NAT rule, resolved for matching
+
+    Each part is None when it matches anything.  A bi-directional static
+    rule also gets a ``reverse`` entry, which matches the translated
+    address as the destination.
+
+    """
+
+    __slots__ = (
+        "index",
+        "name",
+        "action",
+        "rule",
+        "reverse",
+        "fromzone",
+        "tozone",
+        "to_interface",
+        "source",
+        "negate_source",
+        "destination",
+        "negate_destination",
+        "service",
+        "source_translation",
+        "translated_source",
+        "translated_destination",
+        "translated_port",
+    )
+
+
+class NatPolicyEngine(object):
+    """Match packets against NAT rules locally
+
+    Like :class:`SecurityPolicyEngine`, but for
+    :class:`panos.policies.NatRule` rules: the first matching rule wins,
+    and the result tells what the packet is translated to.
+
+    Source translation follows the rule's ``source_translation_type``:
+
+    * ``static-ip`` maps the source to the translated address.  When the
+      original and translated addresses are ranges of the same size, the
+      offset in the range is kept, so 10.1.1.5 of 10.1.1.0/24 translated
+      to 203.0.113.0/24 becomes 203.0.113.5.  A bi-directional rule also
+      translates packets to the translated address back to the original
+      address, from any zone to the rule's destination zone.
+    * ``dynamic-ip-and-port`` and ``dynamic-ip`` pick an address from a
+      pool, which only the device knows, so the result has the pool and
+      only names the address when the pool is a single address.  Fallback
+      pools aren't modeled.
+
+    Destination translation maps the destination the same way as a static
+    source, and replaces the port when the rule has a translated port.
+
+    The result of a packet is None if no rule matches, or a dict with:
+
+    * ``name``: the name of the rule
+    * ``index``: the 1-based index of the rule
+    * ``reverse``: True for the reverse direction of a bi-directional rule
+    * ``source``: the translated source address, or None if it is picked
+      from a pool of several addresses
+    * ``source_pool``: the addresses the source is picked from, for
+      dynamic translation, as ``first-last`` strings
+    * ``destination``: the translated destination address
+    * ``port``: the translated destination port
+
+    Args:
+        rules (list): The NatRules, in order
+        resolver (ObjectResolver): Resolves object names.  Defaults to one
+            that only knows literal addresses.
+
+    """
+
+    def __init__(self, rules, resolver=None):
+        self.rules = list(rules)
+        self.resolver = resolver if resolver is not None else ObjectResolver()
+        self._compiled = []
+        for index, rule in enumerate(self.rules, 1):
+            if not rule.disabled:
+                self._compiled.extend(self._compile(index, rule))
+        self._candidates = {}
+
+    @classmethod
+    def from_rulebases(cls, *rulebases, **kwargs):
+        """Build an engine from the NAT rules of rulebases
+
+        Args:
+            *rulebases: Rulebases with their NAT rules refreshed, in the
+                order the device evaluates them
+            **kwargs: Passed to :class:`NatPolicyEngine`
+
+        Returns:
+            NatPolicyEngine
+
+        """
+        rules = []
+        for rulebase in rulebases:
+            rules.extend(rulebase.findall(policies.NatRule))
+        if kwargs.get("resolver") is None:
+            kwargs["resolver"] = _rulebase_resolver(rulebases)
+        return cls(rules, **kwargs)
+
+    def _addresses(self, values):
+        values = _members(values)
+        if values is None:
+            return None
+        return IntervalSet().union(*[self.resolver.address(x) for x in values])
+
+    def _interface_address(self, value):
+        """The address of an interface IP, which may have a netmask"""
+        obj = self.resolver.object(value, objects.AddressObject)
+        if obj is not None:
+            value = obj.value
+        try:
+            key = address_key(value.split("/")[0])
+        except ValueError:
+            self.resolver._unresolved("address", value)
+            return IntervalSet()
+        return IntervalSet([(key, key)])
+
+    def _compile(self, index, rule):
+        c = _CompiledNatRule()
+        c.index = index
+        c.name = rule.name
+        c.action = None
+        c.rule = rule
+        c.reverse = False
+        c.fromzone = _set_or_none(rule.fromzone)
+        c.tozone = _set_or_none(rule.tozone)
+        c.to_interface = None
+        if rule.to_interface not in (None, "any"):
+            c.to_interface = rule.to_interface
+        c.source = self._addresses(rule.source)
+        c.negate_source = False
+        c.destination = self._addresses(rule.destination)
+        c.negate_destination = False
+        c.service = None
+        if rule.service not in (None, "any"):
+            c.service = self.resolver.service(rule.service)
+
+        c.source_translation = rule.source_translation_type
+        c.translated_source = None
+        if c.source_translation == "static-ip":
+            c.translated_source = self._addresses(
+                rule.source_translation_static_translated_address
+            )
+        elif c.source_translation is not None:
+            if rule.source_translation_address_type == "interface-address":
+                if rule.source_translation_ip_address:
+                    c.translated_source = self._interface_address(
+                        rule.source_translation_ip_address
+                    )
+                else:
+                    self.resolver._unresolved(
+                        "interface", rule.source_translation_interface
+                    )
+                    c.translated_source = IntervalSet()
+            else:
+                c.translated_source = self._addresses(
+                    rule.source_translation_translated_addresses
+                )
+        c.translated_destination = self._addresses(rule.destination_translated_address)
+        c.translated_port = rule.destination_translated_port
+        if c.translated_port is not None:
+            c.translated_port = int(c.translated_port)
+        ans = [c]
+
+        if (
+            c.source_translation == "static-ip"
+            and rule.source_translation_static_bi_directional
+            and c.translated_source
+        ):
+            r = _CompiledNatRule()
+            r.index = index
+            r.name = rule.name
+            r.action = None
+            r.rule = rule
+            r.reverse = True
+            r.fromzone = None
+            r.tozone = c.tozone
+            r.to_interface = None
+            r.source = None
+            r.negate_source = False
+            r.destination = c.translated_source
+            r.negate_destination = False
+            r.service = None
+            r.source_translation = None
+            r.translated_source = None
+            # Back to the original source
+            r.translated_destination = c.source
+            r.translated_port = None
+            ans.append(r)
+        return ans
+
+    def _candidates_for(self, from_zone, to_zone, to_interface):
+        """The compiled rules that can match packets between two zones"""
+        key = (from_zone, to_zone, to_interface)
+        ans = self._candidates.get(key)
+        if ans is not None:
+            return ans
+        ans = []
+        for c in self._compiled:
+            if from_zone is not None and c.fromzone is not None:
+                if from_zone not in c.fromzone:
+                    continue
+            if to_zone is not None and c.tozone is not None:
+                if to_zone not in c.tozone:
+                    continue
+            if to_interface is not None and c.to_interface is not None:
+                if to_interface != c.to_interface:
+                    continue
+            ans.append((c, c.service))
+        self._candidates[key] = ans
+        return ans
+
+    def _result(self, c, src, dst, port):
+        ans = {
+            "name": c.name,
+            "index": c.index,
+            "reverse": c.reverse,
+            "source": format_address(src),
+            "destination": format_address(dst),
+            "port": port,
+        }
+        if c.translated_source is not None:
+            if c.source_translation == "static-ip":
+                src = _translate(src, c.source, c.translated_source)
+                ans["source"] = format_address(src)
+            else:
+                pool = list(c.translated_source)
+                ans["source_pool"] = [_format_interval(x) for x in pool]
+                single = len(pool) == 1 and pool[0][0] == pool[0][1]
+                ans["source"] = format_address(pool[0][0]) if single else None
+        if c.translated_destination is not None:
+            dst = _translate(dst, c.destination, c.translated_destination)
+            ans["destination"] = format_address(dst)
+        if c.translated_port is not None:
+            ans["port"] = c.translated_port
+        return ans
+
+    def match(
+        self,
+        source,
+        destination,
+        protocol,
+        port=None,
+        from_zone=None,
+        to_zone=None,
+        to_interface=None,
+    ):
+        """Find the NAT rule that matches a packet and its translation
+
+        Args:
+            source (str): Source IP address.
+            destination (str): Destination IP address.
+            protocol (int): IP protocol value (1-255).
+            port (int): Destination port.
+            from_zone (str): Source zone name.
+            to_zone (str): Destination zone name.
+            to_interface (str): Egress interface.
+
+        Returns:
+            dict: The translation, or None if no rule matches
+
+        """
+        src = address_key(source)
+        dst = address_key(destination)
+        protocol = int(protocol)
+        if port is not None:
+            port = int(port)
+        for c, service in self._candidates_for(from_zone, to_zone, to_interface):
+            if c.source is not None and src not in c.source:
+                continue
+            if c.destination is not None and dst not in c.destination:
+                continue
+            if service is not None and not service.matches(protocol, port):
+                continue
+            return self._result(c, src, dst, port)
+        return None
+
+    def _match_batch(self, flows):
+        """(flow position, compiled rule, batch, batch position) for matches"""
+        groups = {}
+        for position, flow in enumerate(flows):
+            key = (flow.get("from_zone"), flow.get("to_zone"), flow.get("to_interface"))
+            groups.setdefault(key, []).append(position)
+        for key, positions in groups.items():
+            rules = self._candidates_for(*key)
+            if not rules:
+                continue
+            batch = _FlowBatch([flows[x] for x in positions])
+            for i, c in _match_batch(batch, rules):
+                yield positions[i], c, batch, i
+
+    def match_indexes(self, flows):
+        """Find the index of the NAT rule that matches each of many packets
+
+        Packets are matched in batches, as in
+        :meth:`SecurityPolicyEngine.match_indexes`.
+
+        Args:
+            flows (list): Dicts with the arguments of :meth:`match`
+
+        Returns:
+            list: The 1-based index of the rule matching each packet, or None
+
+        """
+        ans = [None] * len(flows)
+        for position, c, _, _ in self._match_batch(flows):
+            ans[position] = c.index
+        return ans
+
+    def match_many(self, flows):
+        """Find the NAT rule and translation of each of many packets
+
+        Args:
+            flows (list): Dicts with the arguments of :meth:`match`
+
+        Returns:
+            list: The result of :meth:`match` for each packet
+
+        """
+        ans = [None] * len(flows)
+        for position, c, batch, i in self._match_batch(flows):
+            ans[position] = self._result(
+                c, batch.sources[i], batch.destinations[i], batch.ports[i]
+            )
+        return ans
+
+
+def _translate(key, original, translated):
+    """Map an address into translated addresses
+
+    The offset in the original range is kept when the translated addresses
+    are a range of the same size, otherwise the first translated address
+    is used.
+
+    """
+    if not translated:
+        return key
+    first, last = next(iter(translated))
+    if len(translated) == 1 and first != last and original is not None:
+        for start, end in original:
+            if start <= key <= end and end - start == last - first:
+                return first + key - start
+    return first
+
+
+def _format_interval(interval):
+    first, last = interval
+    if first == last:
+        return format_address(first)
+    return "{0}-{1}".format(format_address(first), format_address(last))
+
+
+class RuleAnalyzer(object):
+    """Find security rules that earlier rules keep from ever matching
+
+    Each rule is compared with the others on every dimension: rule type,
+    zones, source and destination addresses, users, applications, services
+    and URL categories.  A rule is covered by another when each of its
+    dimensions is a subset of the other's.  Rather than comparing every
+    pair of rules, the rules are indexed per dimension as bitsets, with one
+    bit per rule: members of zones, users, applications and categories map
+    to the rules listing them, and addresses and services are split into
+    elementary segments that map to the rules holding them.  The rules
+    covering a rule are then found by and-ing a few bitsets together.
+
+    The rules reported by :meth:`analyze` are:
+
+    * ``shadowed``: an earlier rule with a different action covers the
+      rule, so its traffic gets the other action
+    * ``redundant``: an earlier rule with the same action covers the rule,
+      so removing it changes nothing
+    * ``generalization``: the rule covers earlier rules with a different
+      action, which are exceptions to it
+
+    Only coverage by a single rule is found, not by the union of several.
+    Names are compared as given, so ``known-user`` doesn't cover named
+    users, and ``application-default`` only covers itself.  Disabled rules
+    and rules with addresses, applications or services that resolve to
+    nothing are left out.
+
+    Args:
+        engine (SecurityPolicyEngine): The compiled rules
+
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.rules = [c for c in engine._compiled if not _never_matches(c)]
+
+    @classmethod
+    def from_rulebases(cls, *rulebases, **kwargs):
+        """Build an analyzer from the security rules of rulebases
+
+        Args:
+            *rulebases: Rulebases with their security rules refreshed, in
+                the order the device evaluates them
+            **kwargs: Passed to :class:`SecurityPolicyEngine`
+
+        Returns:
+            RuleAnalyzer
+
+        """
+        return cls(SecurityPolicyEngine.from_rulebases(*rulebases, **kwargs))
+
+    def _dimensions(self):
+        """Index every dimension, returning (index, values) pairs"""
+        types = []
+        fromzones = []
+        tozones = []
+        for c in self.rules:
+            types.append(None if c.type == "universal" else frozenset([c.type]))
+            fromzones.append(c.fromzone)
+            tozones.append(c.fromzone if c.type == "intrazone" else c.tozone)
+        ans = [
+            (_SetIndex, types),
+            (_SetIndex, fromzones),
+            (_SetIndex, tozones),
+            (_SetIndex, [c.source_user for c in self.rules]),
+            (_SetIndex, [c.application for c in self.rules]),
+            (_SetIndex, [c.category for c in self.rules]),
+            (_SegmentIndex, [_address_line(c, "source") for c in self.rules]),
+            (_SegmentIndex, [_address_line(c, "destination") for c in self.rules]),
+            (_SegmentIndex, [_service_line(c) for c in self.rules]),
+        ]
+        return [(cls(values), values) for cls, values in ans]
+
+    def analyze(self):
+        """Report shadowed, redundant and generalization rules
+
+        Returns:
+            list: Dicts with the ``name``, 1-based ``index`` and ``type`` of
+            each rule found, and the names of the other ``rules`` involved,
+            ordered by index
+
+        """
+        dimensions = self._dimensions()
+        everything = (1 << len(self.rules)) - 1
+        found = {}
+        generalizes = {}
+        for position, c in enumerate(self.rules):
+            candidates = everything & ~(1 << position)
+            for index, values in dimensions:
+                candidates = index.covering(values[position], candidates)
+                if not candidates:
+                    break
+            if not candidates:
+                continue
+            earlier = candidates & ((1 << position) - 1)
+            if earlier:
+                first = self.rules[_lowest_bit(earlier)]
+                found[c.index] = {
+                    "name": c.name,
+                    "index": c.index,
+                    "type": "redundant" if first.action == c.action else "shadowed",
+                    "rules": [x.name for x in self._rules_in(earlier)],
+                }
+            if c.index in found:
+                # An exception that never matches isn't one
+                continue
+            later = candidates >> (position + 1) << (position + 1)
+            for x in self._rules_in(later):
+                if x.action != c.action:
+                    generalizes.setdefault(x, []).append(c.name)
+        for c, names in generalizes.items():
+            if c.index not in found:
+                found[c.index] = {
+                    "name": c.name,
+                    "index": c.index,
+                    "type": "generalization",
+                    "rules": names,
+                }
+        return [found[x] for x in sorted(found)]
+
+    def _rules_in(self, bits):
+        ans = []
+        while bits:
+            ans.append(self.rules[_lowest_bit(bits)])
+            bits &= bits - 1
+        return ans
+
+
+def _never_matches(c):
+    """True if a part of a rule resolved to nothing"""
+    for value in (c.source, c.destination, c.application):
+        if value is not None and not value:
+            return True
+    service = c.service
+    return service is not None and not service.any_protocol and not service.ports
+
+
+def _lowest_bit(bits):
+    return (bits & -bits).bit_length() - 1
+
+
+class _SetIndex(object):
+    """Bitsets of the rules listing each member of a dimension"""
+
+    def __init__(self, values):
+        self.any = 0
+        self.members = {}
+        for position, value in enumerate(values):
+            bit = 1 << position
+            if value is None:
+                self.any |= bit
+                continue
+            for member in value:
+                self.members[member] = self.members.get(member, 0) | bit
+
+    def covering(self, value, candidates):
+        """The candidates whose value is a superset of value"""
+        ans = candidates & self.any
+        if value is None:
+            return ans
+        rest = candidates & ~self.any
+        for member in value:
+            if not rest:
+                break
+            rest &= self.members.get(member, 0)
+        return ans | rest
+
+
+class _SegmentIndex(object):
+    """Bitsets of the rules holding each elementary segment of a line
+
+    The interval ends of all the rules split the line into segments, and
+    each segment maps to the rules whose intervals contain it.
+
+    """
+
+    def __init__(self, values):
+        toggles = {}
+        for position, intervals in enumerate(values):
+            bit = 1 << position
+            # The intervals of a set are merged, so they never touch
+            for first, last in intervals:
+                toggles[first] = toggles.get(first, 0) ^ bit
+                toggles[last + 1] = toggles.get(last + 1, 0) ^ bit
+        self.bounds = sorted(toggles)
+        self.active = []
+        active = 0
+        for bound in self.bounds:
+            active ^= toggles[bound]
+            self.active.append(active)
+
+    def covering(self, intervals, candidates):
+        """The candidates whose intervals contain all of intervals"""
+        for first, last in intervals:
+            i = bisect.bisect_right(self.bounds, first) - 1
+            if i < 0:
+                return 0
+            while True:
+                candidates &= self.active[i]
+                i += 1
+                if not candidates or i == len(self.bounds) or self.bounds[i] > last:
+                    break
+            if not candidates:
+                return 0
+        return candidates
+
+
+# Services are placed on a line of protocol and port, with one more point
+# for application-default
+_SERVICE_LINE_END = 256 << 16
+_ANY_ADDRESS = IntervalSet([(IPV4_SPACE[0], IPV6_SPACE[1])])
+_ANY_SERVICE_LINE = IntervalSet([(0, _SERVICE_LINE_END)])
+_APPLICATION_DEFAULT_LINE = IntervalSet([(_SERVICE_LINE_END, _SERVICE_LINE_END)])
+
+
+def _address_line(c, field):
+    intervals = getattr(c, field)
+    if intervals is None:
+        return _ANY_ADDRESS
+    if getattr(c, "negate_" + field):
+        return _complement(intervals, IPV4_SPACE[0], IPV6_SPACE[1])
+    return intervals
+
+
+def _service_line(c):
+    if c.application_default:
+        return _APPLICATION_DEFAULT_LINE
+    if c.service is None or c.service.any_protocol:
+        return _ANY_SERVICE_LINE
+    intervals = []
+    for protocol, ports in c.service.ports.items():
+        intervals.extend(
+            ((protocol << 16) + first, (protocol << 16) + last) for first, last in ports
+        )
+    return IntervalSet(intervals)
+
+
+def _complement(intervals, first, last):
+    """The integers from first to last that aren't in an IntervalSet"""
+    ans = []
+    for start, end in intervals:
+        if start > first:
+            ans.append((first, start - 1))
+        first = end + 1
+    if first <= last:
+        ans.append((first, last))
+    return IntervalSet(ans)
+
+
+def _rulebase_resolver(rulebases):
+    """An ObjectResolver for the objects of the parents of rulebases"""
+    scopes = []
+    for rulebase in rulebases:
+        parent = rulebase.parent
+        while parent is not None:
+            if parent not in scopes:
+                scopes.append(parent)
+            parent = parent.parent
+    predefined = None
+    if rulebases:
+        try:
+            device = rulebases[0].nearest_pandevice()
+        except err.PanDeviceNotSet:
+            # Matching needs no device, only the objects in the tree
+            device = None
+        predefined = getattr(device, "predefined", None)
+    return ObjectResolver(scopes, predefined=predefined)
+
+
+def _match_batch(batch, rules, show_all=False):
+    """Match a batch of flows against compiled rules
+
+    Args:
+        batch (_FlowBatch): The flows
+        rules (list): (compiled rule, ServiceSet or None) tuples, in order
+        show_all (bool): Keep matching flows until a rule allows them
+
+    Returns:
+        list: (flow position, compiled rule) tuples, in order
+
+    """
+    if numpy is None:
+        return list(_match_batch_python(batch, rules, show_all))
+    ans = []
+    pending = numpy.arange(len(batch))
+    for c, service in rules:
+        if not len(pending):
+            break
+        mask = numpy.ones(len(pending), dtype=bool)
+        if c.source is not None:
+            found = batch.sources.contains(c.source, pending)
+            mask &= found != c.negate_source
+        if c.destination is not None:
+            found = batch.destinations.contains(c.destination, pending)
+            mask &= found != c.negate_destination
+        if service is not None:
+            mask &= service.matches_many(
+                batch.protocol_array[pending], batch.port_array[pending]
+            )
+        ans.extend((i, c) for i in pending[mask].tolist())
+        if not show_all or c.action == "allow":
+            pending = pending[~mask]
+    # Rules are listed in order for each flow
+    ans.sort(key=lambda x: (x[0], x[1].index))
+    return ans
+
+
+def _match_batch_python(batch, rules, show_all):
+    for i in range(len(batch)):
+        src = batch.sources[i]
+        dst = batch.destinations[i]
+        for c, service in rules:
+            if c.source is not None and (src in c.source) == c.negate_source:
+                continue
+            if c.destination is not None and (
+                (dst in c.destination) == c.negate_destination
+            ):
+                continue
+            if service is not None and not service.matches(
+                batch.protocols[i], batch.ports[i]
+            ):
+                continue
+            yield i, c
+            if not show_all or c.action == "allow":
+                break
+
+
+class _AddressColumn(object):
+    """The address keys of a batch of flows
+
+    With NumPy the keys are also held in an int64 array.  Keys past the
+    int64 range (IPv6) are stored there as -1, which no interval contains,
+    and are checked one at a time.
+
+    """
+
+    def __init__(self, addresses):
+        # Flows tend to repeat addresses, so each one is parsed once
+        parsed = {}
+        self.keys = []
+        for address in addresses:
+            key = parsed.get(address)
+            if key is None:
+                key = parsed[address] = address_key(address)
+            self.keys.append(key)
+        if numpy is not None:
+            self.array = numpy.array(
+                [-1 if x > _INT64_MAX else x for x in self.keys], dtype=numpy.int64
+            )
+            self.large = numpy.array([x > _INT64_MAX for x in self.keys], dtype=bool)
+
+    def __getitem__(self, i):
+        return self.keys[i]
+
+    def contains(self, intervals, pending):
+        """Check the keys of the pending flows against an IntervalSet"""
+        ans = intervals.contains_many(self.array[pending])
+        for i in numpy.nonzero(self.large[pending])[0].tolist():
+            ans[i] = self.keys[pending[i]] in intervals
+        return ans
+
+
+class _FlowBatch(object):
+    """The addresses, protocols and ports of flows, as columns"""
+
+    def __init__(self, flows):
+        self.sources = _AddressColumn([x["source"] for x in flows])
+        self.destinations = _AddressColumn([x["destination"] for x in flows])
+        self.protocols = [int(x["protocol"]) for x in flows]
+        self.ports = [None if x.get("port") is None else int(x["port"]) for x in flows]
+        if numpy is not None:
+            self.protocol_array = numpy.array(self.protocols, dtype=numpy.int64)
+            self.port_array = numpy.array(
+                [-1 if x is None else x for x in self.ports], dtype=numpy.int64
+            )
+
+    def __len__(self):
+        return len(self.protocols)
+
+
+def _set_or_none(value):
+    value = _members(value)
+    return None if value is None else frozenset(value)
@@ -17,6 +17,10 @@
 
 """Retrieving and parsing predefined objects from the firewall"""
 
+import json
+import os
+import tempfile
+
 from pan.xapi import PanXapiError
 
 import panos.errors as err
@@ -62,16 +66,35 @@ class Predefined(object):
     ALL_TAG_XPATH = PREDEFINED_ROOT_XPATH + TAG
     SINGLE_TAG_XPATH = ALL_TAG_XPATH + ENTRY
 
+    # Most names to look up in one request, see refresh_applications()
+    LOOKUP_CHUNK_SIZE = 100
+
+    # On-disk cache, see save_cache()
+    CACHE_FORMAT = 1
+    CACHE_SECTIONS = (
+        ("applications", "application_objects", objects.ApplicationObject),
+        (
+            "application_containers",
+            "application_container_objects",
+            objects.ApplicationContainer,
+        ),
+        ("services", "service_objects", objects.ServiceObject),
+        ("tags", "tag_objects", objects.Tag),
+    )
+
     def __init__(self, device=None, *args, **kwargs):
         # Create a class logger
         self._logger = getlogger(__name__ + "." + self.__class__.__name__)
 
         self.parent = device
+        self.cache_dir = None
 
         self.service_objects = {}
         self.application_objects = {}
         self.application_container_objects = {}
         self.tag_objects = {}
+        # Objects loaded from the cache but not built yet
+        self._cached = {}
 
     def _get_xml(self, xpath):
         """use the parent to get the xml given the xpath"""
@@ -154,6 +177,55 @@ class Predefined(object):
         xml = self._get_xml(xpath)
         self._parse_tag_xml(xml)
 
+    def _names_xpath(self, xpath, names):
+        """An xpath for the entries of all the names"""
+        conditions = ["@name={0}".format(_xpath_literal(x)) for x in names]
+        return "{0}/entry[{1}]".format(xpath, " or ".join(conditions))
+
+    def _refresh_names(self, xpath, names, parse):
+        names = sorted(set(names))
+        size = self.LOOKUP_CHUNK_SIZE
+        for i in range(0, len(names), size):
+            xml = self._get_xml(self._names_xpath(xpath, names[i : i + size]))
+            parse(xml)
+
+    def refresh_applications(self, names):
+        """Refresh many Predefined Applications
+
+        Retrieves the predefined applications and application containers
+        with any of the names in as few API calls as possible, asking for
+        up to :attr:`LOOKUP_CHUNK_SIZE` names in each one.
+
+        Args:
+            names (list): Names of the applications to refresh
+
+        """
+        self._refresh_names(
+            self.ALL_APPLICATION_XPATH, names, self._parse_application_xml
+        )
+
+    def refresh_services(self, names):
+        """Refresh many Predefined Services
+
+        Like :meth:`refresh_applications`, but for services.
+
+        Args:
+            names (list): Names of the services to refresh
+
+        """
+        self._refresh_names(self.ALL_SERVICE_XPATH, names, self._parse_service_xml)
+
+    def refresh_tags(self, names):
+        """Refresh many Predefined Tags
+
+        Like :meth:`refresh_applications`, but for tags.
+
+        Args:
+            names (list): Names of the tags to refresh
+
+        """
+        self._refresh_names(self.ALL_TAG_XPATH, names, self._parse_tag_xml)
+
     def refreshall_applications(self):
         """Refresh all Predefined Applications
 
@@ -194,22 +266,184 @@ class Predefined(object):
         This method refreshes all predefined objects. This includes applications,
         application containers, services, and tags.
 
+        If :attr:`cache_dir` is set, the objects are loaded from the cache for
+        the content version of the device when there is one, and the cache is
+        written after they are retrieved from the device otherwise.  See
+        :meth:`save_cache`.
+
         CAUTION: This method requires a lot of overhead on the device api to respond.
         Response time will vary by platform, but know that it will generally take
         longer than a normal api request.
 
         """
+        if self.cache_dir is not None and self.load_cache():
+            return
+
         # first we clear all existing objects
         self.application_objects = {}
         self.application_container_objects = {}
         self.service_objects = {}
         self.tag_objects = {}
+        self._cached = {}
 
         # now we call the refresh methods
         self.refreshall_services()
         self.refreshall_applications()
         self.refreshall_tags()
 
+        if self.cache_dir is not None:
+            self.save_cache()
+
+    def content_version(self):
+        """The content version of the device
+
+        Uses the ``content_version`` of the device, and reads it from
+        ``show system info`` if it isn't known yet.
+
+        Returns:
+            str: The application and threat content version
+
+        """
+        version = self.parent.content_version
+        if version is None:
+            system_info = self.parent.show_system_info()
+            version = system_info["system"].get("app-version")
+            self.parent.content_version = version
+        return version
+
+    def cache_path(self, cache_dir=None):
+        """The cache file for the content version of the device
+
+        Devices on the same content version share the file.
+
+        Args:
+            cache_dir (str): Directory of the cache.  Defaults to
+                :attr:`cache_dir`.
+
+        Returns:
+            str: The path of the file, or None if there is no cache directory
+            or the content version is unknown
+
+        """
+        if cache_dir is None:
+            cache_dir = self.cache_dir
+        if cache_dir is None:
+            return None
+        version = self.content_version()
+        if not version:
+            return None
+        return os.path.join(cache_dir, "predefined-{0}.json".format(version))
+
+    def save_cache(self, path=None):
+        """Save the predefined objects to a file
+
+        Predefined objects only change with the content version, so the file
+        can be loaded with :meth:`load_cache` by later runs, and for other
+        devices on the same content version, instead of retrieving the
+        objects again.
+
+        Args:
+            path (str): The file to write.  Defaults to :meth:`cache_path`.
+
+        """
+        if path is None:
+            path = self.cache_path()
+        if path is None:
+            raise err.PanDeviceError("No cache path or content version")
+
+        data = {
+            "format": self.CACHE_FORMAT,
+            "content_version": self.parent.content_version,
+        }
+        for section, attr, cls in self.CACHE_SECTIONS:
+            entries = dict(self._cached.get(section, {}))
+            for name, obj in getattr(self, attr).items():
+                entries[name] = dict(
+                    (k, v) for k, v in obj.about().items() if v is not None
+                )
+            data[section] = entries
+
+        # Write to a temporary file first, so readers never see half a file.
+        directory = os.path.dirname(path) or "."
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, separators=(",", ":"))
+            if os.path.exists(path) and not hasattr(os, "replace"):
+                os.remove(path)
+            getattr(os, "replace", os.rename)(tmp, path)
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def load_cache(self, path=None, lazy=False):
+        """Load the predefined objects from a file
+
+        Replaces the current objects with those saved by :meth:`save_cache`.
+
+        With ``lazy``, objects are only built when they are first returned
+        by :meth:`application`, :meth:`service`, :meth:`tag` and the like,
+        which makes loading a cache of thousands of applications take a few
+        milliseconds.  Until then they are not in the dicts like
+        :attr:`application_objects`.
+
+        Args:
+            path (str): The file to read.  Defaults to :meth:`cache_path`.
+            lazy (bool): Build the objects when they are first used
+
+        Returns:
+            bool: True if the cache was loaded, False if there is no usable
+            cache file
+
+        """
+        if path is None:
+            path = self.cache_path()
+        if path is None or not os.path.isfile(path):
+            return False
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            self._logger.debug("Unable to read {0}: {1}".format(path, e))
+            return False
+        if data.get("format") != self.CACHE_FORMAT:
+            return False
+
+        self._cached = {}
+        for section, attr, cls in self.CACHE_SECTIONS:
+            setattr(self, attr, {})
+            self._cached[section] = data.get(section, {})
+        if not lazy:
+            for section in self._cached:
+                for name in list(self._cached[section]):
+                    self._from_cache(section, name)
+        return True
+
+    def _from_cache(self, section, name):
+        """Build an object that was loaded from the cache"""
+        values = self._cached.get(section, {}).pop(name, None)
+        if values is None:
+            return None
+        for s, attr, cls in self.CACHE_SECTIONS:
+            if s == section:
+                obj = cls(**values)
+                getattr(self, attr)[name] = obj
+                return obj
+
+    def application_catalog(self, custom=None):
+        """An index of the applications for resolving application filters
+
+        Args:
+            custom (list): Custom ApplicationObjects to include
+
+        Returns:
+            ApplicationCatalog
+
+        """
+        return ApplicationCatalog.from_predefined(self, custom)
+
     def application(self, name, refresh_if_none=True, include_containers=True):
         """Get a Predefined Application
 
@@ -225,8 +459,12 @@ class Predefined(object):
 
         """
         obj = self.application_objects.get(name, None)
+        if obj is None:
+            obj = self._from_cache("applications", name)
         if obj is None and include_containers:
             obj = self.application_container_objects.get(name, None)
+            if obj is None:
+                obj = self._from_cache("application_containers", name)
 
         if obj is None and refresh_if_none:
             self.refresh_application(name)
@@ -251,6 +489,8 @@ class Predefined(object):
 
         """
         obj = self.service_objects.get(name, None)
+        if obj is None:
+            obj = self._from_cache("services", name)
 
         if obj is None and refresh_if_none:
             self.refresh_service(name)
@@ -273,6 +513,8 @@ class Predefined(object):
 
         """
         obj = self.tag_objects.get(name, None)
+        if obj is None:
+            obj = self._from_cache("tags", name)
 
         if obj is None and refresh_if_none:
             self.refresh_tag(name)
@@ -285,6 +527,8 @@ class Predefined(object):
         """Get a list of Predefined Applications
 
         Return a list of the instances of the applications from the given names.
+        Applications that are not known yet are retrieved together, see
+        :meth:`refresh_applications`.
 
         Args:
             names (list): Names of the applications
@@ -295,13 +539,21 @@ class Predefined(object):
             A list of all found ApplicationObjects or ApplicationContainerObjects
 
         """
+        names = set(names)
+        if refresh_if_none:
+            missing = [
+                name
+                for name in names
+                if self.application(name, False, include_containers) is None
+            ]
+            if missing:
+                self.refresh_applications(missing)
+
         objs = []
 
-        for name in set(names):
+        for name in names:
             obj = self.application(
-                name,
-                refresh_if_none=refresh_if_none,
-                include_containers=include_containers,
+                name, refresh_if_none=False, include_containers=include_containers
             )
             if obj:
                 objs.append(obj)
@@ -312,6 +564,7 @@ class Predefined(object):
         """Get a list of Predefined Services
 
         Return a list of the instances of the services from the given names.
+        Services that are not known yet are retrieved together.
 
         Args:
             names (list): Names of the services
@@ -321,10 +574,16 @@ class Predefined(object):
             A list of all found ServiceObjects
 
         """
+        names = set(names)
+        if refresh_if_none:
+            missing = [name for name in names if self.service(name, False) is None]
+            if missing:
+                self.refresh_services(missing)
+
         objs = []
 
-        for name in set(names):
-            obj = self.service(name, refresh_if_none=refresh_if_none)
+        for name in names:
+            obj = self.service(name, refresh_if_none=False)
             if obj:
                 objs.append(obj)
 
@@ -334,6 +593,7 @@ class Predefined(object):
         """Get a list of Predefined Tags
 
         Return a list of the instances of the tags from the given names.
+        Tags that are not known yet are retrieved together.
 
         Args:
             names (list): Names of the tags
@@ -343,10 +603,16 @@ class Predefined(object):
             A list of all found Tags
 
         """
+        names = set(names)
+        if refresh_if_none:
+            missing = [name for name in names if self.tag(name, False) is None]
+            if missing:
+                self.refresh_tags(missing)
+
         objs = []
 
-        for name in set(names):
-            obj = self.tag(name, refresh_if_none=refresh_if_none)
+        for name in names:
+            obj = self.tag(name, refresh_if_none=False)
             if obj:
                 objs.append(obj)
 
@@ -393,3 +659,228 @@ class Predefined(object):
             return self.services(names, refresh_if_none)
         elif classtype == objects.Tag:
             return self.tags(names, refresh_if_none)
+
+
+class ApplicationCatalog(object):
+    """Find the applications matched by application filters
+
+    Keeps an inverted index per application attribute, from each value to
+    the names of the applications that have it, so an
+    :class:`panos.objects.ApplicationFilter` resolves to its applications
+    with a few set operations instead of a scan of every application.
+    Resolved filters are remembered until the catalog changes.
+
+    Like on the device, a filter matches an application that has any of the
+    listed values of each of category, subcategory, technology, risk and
+    tag, and every characteristic that is set.
+
+    Usually created with :meth:`Predefined.application_catalog`, which
+    indexes the predefined applications without building an object for
+    applications that were loaded lazily from the cache.
+
+    Example::
+
+        fw.predefined.refreshall()
+        catalog = fw.predefined.application_catalog(custom=custom_apps)
+        names = catalog.match(app_filter)
+
+    Args:
+        applications (list): ApplicationObjects, or dicts of their
+            :meth:`about` values, to index
+
+    """
+
+    # ApplicationFilter params matching any of a list of values, and the
+    # ApplicationObject param they match
+    ATTRIBUTES = (
+        ("category", "category"),
+        ("subcategory", "subcategory"),
+        ("technology", "technology"),
+        ("risk", "risk"),
+        ("tag", "tag"),
+    )
+    # ApplicationFilter characteristics, and the ApplicationObject param they
+    # match.  None when applications don't have the characteristic.
+    CHARACTERISTICS = (
+        ("evasive", "evasive_behavior"),
+        ("excessive_bandwidth_use", "consume_big_bandwidth"),
+        ("prone_to_misuse", "prone_to_misuse"),
+        ("is_saas", None),
+        ("transfers_files", "able_to_transfer_file"),
+        ("tunnels_other_apps", "tunnel_other_application"),
+        ("used_by_malware", "used_by_malware"),
+        ("has_known_vulnerabilities", "has_known_vulnerability"),
+        ("pervasive", "pervasive_use"),
+    )
+
+    def __init__(self, applications=None):
+        self._index = {}
+        self._values = {}
+        self._matches = {}
+        for app in applications or ():
+            self.add(app)
+
+    @classmethod
+    def from_predefined(cls, predefined, custom=None):
+        """Index the predefined applications plus custom applications
+
+        Args:
+            predefined (Predefined): Predefined objects, already refreshed
+                or loaded from the cache
+            custom (list): Custom ApplicationObjects to add
+
+        Returns:
+            ApplicationCatalog
+
+        """
+        catalog = cls()
+        for values in predefined._cached.get("applications", {}).values():
+            catalog.add(values)
+        for app in predefined.application_objects.values():
+            catalog.add(app)
+        for app in custom or ():
+            catalog.add(app)
+        return catalog
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, name):
+        return name in self._values
+
+    def names(self):
+        """The names of every application in the catalog"""
+        return frozenset(self._values)
+
+    def add(self, app):
+        """Index an application, replacing one of the same name
+
+        Args:
+            app: An ApplicationObject, or a dict of its :meth:`about` values
+
+        """
+        values = app if isinstance(app, dict) else app.about()
+        name = values["name"]
+        if name in self._values:
+            self.remove(name)
+        keys = []
+        for _, param in self.ATTRIBUTES:
+            value = values.get(param)
+            if value is None:
+                continue
+            if not isinstance(value, list):
+                value = [value]
+            keys.extend((param, "{0}".format(x)) for x in value)
+        for _, param in self.CHARACTERISTICS:
+            if param is not None and values.get(param):
+                keys.append((param, True))
+        for key in keys:
+            self._index.setdefault(key, set()).add(name)
+        self._values[name] = keys
+        self._matches = {}
+
+    def remove(self, name):
+        """Remove an application from the catalog
+
+        Args:
+            name (str): Name of the application
+
+        """
+        for key in self._values.pop(name, ()):
+            names = self._index.get(key)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._index[key]
+        self._matches = {}
+
+    def _signature(self, app_filter):
+        """The criteria of a filter, as a hashable tuple"""
+        values = app_filter if isinstance(app_filter, dict) else app_filter.about()
+        criteria = []
+        for attr, param in self.ATTRIBUTES:
+            value = values.get(attr)
+            if value is None:
+                continue
+            if not isinstance(value, list):
+                value = [value]
+            criteria.append((param, tuple(sorted("{0}".format(x) for x in value))))
+        for attr, param in self.CHARACTERISTICS:
+            if values.get(attr):
+                if param is None:
+                    raise ValueError(
+                        "Applications have no {0} characteristic".format(attr)
+                    )
+                criteria.append((param, (True,)))
+        return tuple(criteria)
+
+    def match(self, app_filter):
+        """The applications matched by an application filter
+
+        Args:
+            app_filter: An ApplicationFilter, or a dict of its
+                :meth:`about` values
+
+        Returns:
+            frozenset: Names of the matching applications
+
+        Raises:
+            ValueError: The filter uses a characteristic that applications
+                don't have, like ``is_saas``
+
+        """
+        signature = self._signature(app_filter)
+        ans = self._matches.get(signature)
+        if ans is not None:
+            return ans
+
+        candidates = []
+        for param, values in signature:
+            if len(values) == 1:
+                names = self._index.get((param, values[0]), set())
+            else:
+                names = set()
+                for value in values:
+                    names.update(self._index.get((param, value), ()))
+            candidates.append(names)
+
+        if not candidates:
+            ans = frozenset(self._values)
+        else:
+            candidates.sort(key=len)
+            ans = set(candidates[0])
+            for names in candidates[1:]:
+                if not ans:
+                    break
+                ans.intersection_update(names)
+            ans = frozenset(ans)
+
+        self._matches[signature] = ans
+        return ans
+
+    def match_any(self, app_filters):
+        """The applications matched by any of the application filters
+
+        Args:
+            app_filters (list): ApplicationFilters, or dicts of their
+                :meth:`about` values
+
+        Returns:
+            frozenset: Names of the matching applications
+
+        """
+        ans = set()
+        for app_filter in app_filters:
+            ans.update(self.match(app_filter))
+        return frozenset(ans)
+
+
+def _xpath_literal(value):
+    """A string as an xpath literal, quoted with whatever it doesn't contain"""
+    if "'" not in value:
+        return "'{0}'".format(value)
+    if '"' not in value:
+        return '"{0}"'.format(value)
+    # XPath 1.0 can't escape quotes, so join the parts between single quotes
+    parts = ["'{0}'".format(x) for x in value.split("'")]
+    return "concat({0})".format(', "\'", '.join(parts))
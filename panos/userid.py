@@ -17,18 +17,376 @@
 
 """User-ID and Dynamic Address Group updates using the User-ID API"""
 
+import collections
+import threading
+import time
 import xml.etree.ElementTree as ET
 from copy import deepcopy
 
 from pan.xapi import PanXapiError
 
 import panos.errors as err
-from panos import getlogger, string_or_list, string_or_list_or_none
+from panos import getlogger, jobs, string_or_list, string_or_list_or_none
 from panos.updater import PanOSVersion
 
 logger = getlogger(__name__)
 
 
+class UidMessage(object):
+    """The operations of a uid-message, before they are sent
+
+    Operations are kept per type (login, register, ...) in the order they
+    were first added, and the uid-message XML is only built when it is sent.
+    Adding the same operation twice keeps just one copy.
+
+    With ``coalesce``, an operation also cancels the pending opposite
+    operation of the same mapping.  For example, a login followed by a logout
+    of the same user and IP only sends the logout, and an unregister of a tag
+    drops the pending register of that tag on that IP.  The result is the
+    same as sending each operation in order.
+
+    An operation that has to be sent after an operation of a later type,
+    like a login of a user after its logout without ``coalesce``, or a tag
+    of a user after all of its tags were removed, starts a new part of the
+    message.  :meth:`split` gives one message per part, to send in order.
+
+    Args:
+        coalesce (bool): Cancel opposite operations on the same mapping
+
+    """
+
+    # The sections of a uid-message, and the attribute naming their entries
+    _SECTIONS = {
+        "login": "name",
+        "logout": "name",
+        "register": "ip",
+        "unregister": "ip",
+        "register-user": "user",
+        "unregister-user": "user",
+        "groups": "name",
+    }
+
+    def __init__(self, coalesce=True):
+        self.coalesce = coalesce
+        self.clear()
+
+    def __len__(self):
+        return self.entries
+
+    def clear(self):
+        """Remove every operation"""
+        self.sections = collections.OrderedDict()
+        # The sections of each part, the last one is self.sections
+        self.parts = [self.sections]
+        # Number of pending operations, and estimated size in bytes
+        self.entries = 0
+        self.size = 0
+        self.created = time.time()
+
+    def _section(self, name, create=True):
+        section = self.sections.get(name)
+        if section is None and create:
+            section = self.sections[name] = collections.OrderedDict()
+        return section
+
+    def _follow(self, name, opposite, conflict):
+        """Start a new part if an operation must follow a later section"""
+        names = list(self.sections)
+        if (
+            conflict
+            and name in names
+            and opposite in names
+            and names.index(name) < names.index(opposite)
+        ):
+            self.sections = collections.OrderedDict()
+            self.parts.append(self.sections)
+
+    def _added(self, size):
+        self.entries += 1
+        self.size += size
+
+    def _removed(self, size):
+        self.entries -= 1
+        self.size -= size
+
+    def _discard(self, name, key):
+        """Drop a pending login or logout"""
+        section = self._section(name, False)
+        if section and key in section:
+            del section[key]
+            self._removed(len(key[0]) + len(key[1]) + 30)
+
+    def _discard_tag(self, name, key, tag):
+        """Drop a pending tag (un)registration of an IP or user"""
+        section = self._section(name, False)
+        tags = section.get(key) if section else None
+        if tags and tag in tags:
+            del tags[tag]
+            self._removed(len(tag) + 20)
+            if not tags:
+                del section[key]
+
+    def login(self, user, ip, timeout=None):
+        if self.coalesce:
+            self._discard("logout", (user, ip))
+        logouts = self._section("logout", False) or {}
+        self._follow("login", "logout", (user, ip) in logouts)
+        section = self._section("login")
+        if (user, ip) not in section:
+            self._added(len(user) + len(ip) + 30)
+        section[(user, ip)] = timeout
+
+    def logout(self, user, ip):
+        if self.coalesce:
+            self._discard("login", (user, ip))
+        logins = self._section("login", False) or {}
+        self._follow("logout", "login", (user, ip) in logins)
+        section = self._section("logout")
+        if (user, ip) not in section:
+            self._added(len(user) + len(ip) + 30)
+            section[(user, ip)] = None
+
+    def register(self, ip, tag, timeout=None):
+        self._tag("register", "unregister", ip, tag, timeout)
+
+    def unregister(self, ip, tag):
+        self._tag("unregister", "register", ip, tag, None)
+
+    def tag_user(self, user, tag, timeout=None):
+        self._tag("register-user", "unregister-user", user, tag, timeout)
+
+    def untag_user(self, user, tag=None):
+        """Untag a user, or remove all of a user's tags when tag is None"""
+        if tag is not None:
+            self._tag("unregister-user", "register-user", user, tag, None)
+            return
+        if self.coalesce:
+            tags = self._section("register-user", False)
+            for pending in list((tags or {}).get(user, ())):
+                self._discard_tag("register-user", user, pending)
+        registered = self._section("register-user", False) or {}
+        self._follow("unregister-user", "register-user", user in registered)
+        section = self._section("unregister-user")
+        tags = section.get(user)
+        if tags is None and user in section:
+            # Already removing all tags
+            return
+        for pending in list(tags or ()):
+            self._discard_tag("unregister-user", user, pending)
+        section[user] = None
+        self._added(len(user) + 30)
+
+    def _tag(self, name, opposite, key, tag, timeout):
+        if self.coalesce:
+            self._discard_tag(opposite, key, tag)
+        pending = (self._section(opposite, False) or {}).get(key, ())
+        self._follow(name, opposite, pending is None or tag in pending)
+        section = self._section(name)
+        if key in section and section[key] is None:
+            # Already removing all tags of this user
+            return
+        tags = section.setdefault(key, collections.OrderedDict())
+        if tag not in tags:
+            self._added(len(tag) + 20 + (len(key) + 30 if len(tags) == 0 else 0))
+        tags[tag] = timeout
+
+    def set_group(self, group, users):
+        section = self._section("groups")
+        members = section.setdefault(group, [])
+        for user in users:
+            members.append(user)
+            self._added(len(user) + 20)
+
+    def update(self, other):
+        """Add the operations of another message to this one
+
+        The operations of the other message are added type by type, as if
+        they were added to this message after its own operations.
+
+        Args:
+            other (UidMessage): The message to merge into this one
+
+        """
+        for name, section in other.operations():
+            if name == "login":
+                for (user, ip), timeout in section.items():
+                    self.login(user, ip, timeout)
+            elif name == "logout":
+                for user, ip in section:
+                    self.logout(user, ip)
+            elif name == "groups":
+                for group, users in section.items():
+                    self.set_group(group, users)
+            elif name == "unregister-user":
+                for user, tags in section.items():
+                    if tags is None:
+                        self.untag_user(user)
+                    else:
+                        for tag in tags:
+                            self.untag_user(user, tag)
+            else:
+                method = {
+                    "register": self.register,
+                    "unregister": self.unregister,
+                    "register-user": self.tag_user,
+                }[name]
+                for key, tags in section.items():
+                    for tag, timeout in tags.items():
+                        if timeout is None:
+                            method(key, tag)
+                        else:
+                            method(key, tag, timeout)
+        self.created = min(self.created, other.created)
+
+    def operations(self):
+        """The sections of every part, in the order they are sent
+
+        Yields:
+            tuple: The operation type and its section
+
+        """
+        for sections in self.parts:
+            for name, section in sections.items():
+                yield name, section
+
+    def split(self):
+        """Split the message into the uid-messages to send
+
+        Returns:
+            list: One :class:`UidMessage` per part, in the order to send
+            them
+
+        """
+        if len(self.parts) == 1:
+            return [self]
+        ans = []
+        for sections in self.parts:
+            part = UidMessage(self.coalesce)
+            part.sections = sections
+            part.parts = [sections]
+            part.entries = part._count()
+            part.size = self.size * part.entries // max(self.entries, 1)
+            part.created = self.created
+            ans.append(part)
+        return ans
+
+    def _count(self):
+        """Count the operations of the current part"""
+        ans = 0
+        for name, section in self.sections.items():
+            for value in section.values():
+                if name in ("login", "logout"):
+                    ans += 1
+                elif value is None:
+                    # Remove all tags of a user
+                    ans += 1
+                else:
+                    ans += len(value)
+        return ans
+
+    @classmethod
+    def from_element(cls, uidmessage, coalesce=False):
+        """Read the operations of a uid-message
+
+        Args:
+            uidmessage (xml.etree.ElementTree): The uid-message
+            coalesce (bool): Cancel opposite operations on the same mapping
+
+        Returns:
+            UidMessage: The operations, or None if the uid-message has
+            something other than the operations of this class
+
+        """
+        if (uidmessage.findtext("type") or "update") != "update":
+            return None
+        payload = uidmessage.find("payload")
+        if payload is None:
+            return None
+        message = cls(coalesce)
+        for elm in payload:
+            if elm.tag not in cls._SECTIONS:
+                return None
+            for entry in elm.findall("entry"):
+                key = entry.get(cls._SECTIONS[elm.tag])
+                if key is None:
+                    return None
+                if elm.tag == "login":
+                    message.login(key, entry.get("ip"), entry.get("timeout"))
+                elif elm.tag == "logout":
+                    message.logout(key, entry.get("ip"))
+                elif elm.tag == "groups":
+                    users = [x.get("name") for x in entry.findall("members/entry")]
+                    message.set_group(key, users)
+                elif elm.tag == "unregister-user" and entry.find("tag") is None:
+                    message.untag_user(key)
+                else:
+                    for member in entry.findall("tag/member"):
+                        if elm.tag == "register":
+                            message.register(key, member.text, member.get("timeout"))
+                        elif elm.tag == "unregister":
+                            message.unregister(key, member.text)
+                        elif elm.tag == "register-user":
+                            message.tag_user(key, member.text, member.get("timeout"))
+                        else:
+                            message.untag_user(key, member.text)
+        return message
+
+    def element(self):
+        """Build the uid-message
+
+        Only the last part is built, use :meth:`split` first for a message
+        with more than one part.
+
+        Returns:
+            xml.etree.ElementTree: The uid-message, or None if there are no
+            operations
+
+        """
+        if not any(self.sections.values()):
+            return None
+        root = ET.fromstring(
+            "<uid-message>"
+            + "<version>1.0</version>"
+            + "<type>update</type>"
+            + "<payload/>"
+            + "</uid-message>"
+        )
+        payload = root.find("payload")
+        for name, section in self.sections.items():
+            if not section:
+                continue
+            elm = ET.SubElement(payload, name)
+            if name in ("login", "logout"):
+                for (user, ip), timeout in section.items():
+                    entry = ET.SubElement(elm, "entry", {"name": user, "ip": ip})
+                    if timeout:
+                        entry.set("timeout", str(timeout))
+            elif name in ("register", "unregister"):
+                for ip, tags in section.items():
+                    entry = ET.SubElement(elm, "entry", {"ip": ip})
+                    self._tag_members(entry, tags)
+            elif name in ("register-user", "unregister-user"):
+                for user, tags in section.items():
+                    entry = ET.SubElement(elm, "entry", {"user": user})
+                    if tags is not None:
+                        self._tag_members(entry, tags)
+            elif name == "groups":
+                for group, users in section.items():
+                    entry = ET.SubElement(elm, "entry", {"name": group})
+                    members = ET.SubElement(entry, "members")
+                    for user in users:
+                        ET.SubElement(members, "entry", {"name": user})
+        return root
+
+    def _tag_members(self, entry, tags):
+        tag_elm = ET.SubElement(entry, "tag")
+        for tag, timeout in tags.items():
+            props = {}
+            if timeout is not None:
+                props["timeout"] = "{0}".format(timeout)
+            ET.SubElement(tag_elm, "member", props).text = tag
+
+
 class UserId(object):
     """User-ID Subsystem of Firewall
 
@@ -69,27 +427,101 @@ class UserId(object):
         )
         # Batch state
         self._batch = False
-        self._batch_uidmessage = deepcopy(self._uidmessage)
+        self._batch_message = None
+        self._batch_limits = (None, None, None)
+        # Background sender, see start_dispatcher()
+        self.dispatcher = None
+        # Local copy of the tag tables, see start_mirror()
+        self.mirror = None
+        # Objects with an apply(message) method, told of each message sent,
+        # like panos.policymatch.DynamicUserGroupEvaluator
+        self.listeners = []
 
     def _create_uidmessage(self):
-        if self._batch:
-            payload = self._batch_uidmessage.find("payload")
-            return self._batch_uidmessage, payload
-        else:
-            root = deepcopy(self._uidmessage)
-            payload = root.find("payload")
-            return root, payload
+        root = deepcopy(self._uidmessage)
+        payload = root.find("payload")
+        return root, payload
 
-    def batch_start(self):
+    def _message(self):
+        """The UidMessage to add an operation to"""
+        if self._batch:
+            return self._batch_message
+        return UidMessage()
+
+    def _checkpoint(self, message):
+        """Flush the batch if it is full, and return the message to add to"""
+        if not self._batch:
+            return message
+        max_entries, max_bytes, max_age = self._batch_limits
+        if (
+            (max_entries is not None and message.entries >= max_entries)
+            or (max_bytes is not None and message.size >= max_bytes)
+            or (max_age is not None and time.time() - message.created >= max_age)
+        ):
+            self.batch_flush()
+        return self._batch_message
+
+    def _commit_message(self, message):
+        """Send a message, or flush the batch if it is full"""
+        if self._batch:
+            self._checkpoint(message)
+            return
+        self._deliver(message)
+
+    def _notify(self, message):
+        """Apply a message to the mirror and the listeners"""
+        if self.mirror is not None:
+            self.mirror.apply(message)
+        for listener in self.listeners:
+            listener.apply(message)
+
+    def _deliver(self, message):
+        """Send a message now, or queue it if the dispatcher is running"""
+        self._notify(message)
+        if self.dispatcher is not None and self.dispatcher.is_running():
+            self.dispatcher.put(message)
+            return
+        for part in message.split():
+            uidmessage = part.element()
+            if uidmessage is not None:
+                self._send(ET.tostring(uidmessage), self.device.xapi, self.device.vsys)
+
+    def batch_start(
+        self, max_entries=None, max_bytes=None, max_age=None, coalesce=True
+    ):
         """Start creating an API call
 
         The API call will not be sent to the firewall until batch_end() is
         called. This allows multiple operations to be added to a single API
         call.
 
+        Large batches can be sent in parts as they grow, by setting any of
+        ``max_entries``, ``max_bytes`` or ``max_age``.  When an operation
+        brings the batch to one of these limits, the batch is sent and a new
+        one is started.
+
+        Args:
+            max_entries (int): Send the batch when it has this many operations
+            max_bytes (int): Send the batch when the estimated size of the
+                uid-message reaches this many bytes
+            max_age (float): Send the batch when an operation is added this
+                many seconds after the batch started
+            coalesce (bool): Cancel opposite operations on the same mapping
+                within the batch, such as a login followed by a logout of the
+                same user and IP.  See :class:`UidMessage`.
+
         """
         self._batch = True
-        self._batch_uidmessage = deepcopy(self._uidmessage)
+        self._batch_message = UidMessage(coalesce)
+        self._batch_limits = (max_entries, max_bytes, max_age)
+
+    def batch_flush(self):
+        """Send the operations batched so far, and keep batching"""
+        if not self._batch:
+            return
+        message = self._batch_message
+        self._batch_message = UidMessage(message.coalesce)
+        self._deliver(message)
 
     def batch_end(self):
         """End a batched API call and send it to the firewall
@@ -102,12 +534,13 @@ class UserId(object):
         call.
 
         """
-        uid_message, payload = self._create_uidmessage()
+        if not self._batch:
+            return
+        message = self._batch_message
         self._batch = False
+        self._batch_message = None
         # Only send the API call if there was actually a command added to the payload
-        if len(payload) > 0:
-            self.send(uid_message)
-        self._batch_uidmessage = deepcopy(self._uidmessage)
+        self._deliver(message)
 
     def send(self, uidmessage):
         """Send a uidmessage to the User-ID API of a firewall
@@ -115,27 +548,95 @@ class UserId(object):
         Used for adhoc User-ID API calls that are not supported by other
         methods in this class. This method cannot be batched.
 
+        The message is sent to the firewall exactly as given.  Operations
+        that :class:`UidMessage` knows are also applied to the mirror and
+        the listeners.  If the dispatcher is running, the message is queued
+        behind the pending operations and sent unchanged.
+
         Args:
-            uidmessage (str): The UID Message in XML to send to the firewall
+            uidmessage (xml.etree.ElementTree): The UID Message to send to
+                the firewall
 
         """
         if self._batch:
             return
-        else:
-            cmd = ET.tostring(uidmessage)
-            try:
-                self.device.xapi.user_id(cmd=cmd, vsys=self.device.vsys)
-            except (err.PanDeviceXapiError, PanXapiError) as e:
-                # Check if this is just an error about duplicates or nonexistant tags
-                # If so, ignore the error. Most operations don't care about this.
-                message = str(e)
-                if self.ignore_dup_errors and (
-                    message.endswith("already exists, ignore")
-                    or message.endswith("does not exist, ignore unreg")
-                ):
-                    return
-                else:
-                    raise e
+        message = UidMessage.from_element(uidmessage)
+        if message is not None:
+            self._notify(message)
+        cmd = ET.tostring(uidmessage)
+        if self.dispatcher is not None and self.dispatcher.is_running():
+            self.dispatcher.put_raw(cmd, message)
+            return
+        self._send(cmd, self.device.xapi, self.device.vsys)
+
+    def _send(self, cmd, xapi, vsys):
+        try:
+            xapi.user_id(cmd=cmd, vsys=vsys)
+        except (err.PanDeviceXapiError, PanXapiError) as e:
+            # Check if this is just an error about duplicates or nonexistant tags
+            # If so, ignore the error. Most operations don't care about this.
+            message = str(e)
+            if self.ignore_dup_errors and (
+                message.endswith("already exists, ignore")
+                or message.endswith("does not exist, ignore unreg")
+            ):
+                return
+            else:
+                raise e
+
+    def start_dispatcher(self, **kwargs):
+        """Send User-ID operations from a background thread
+
+        Once started, operations like :meth:`login` and :meth:`register`
+        return right away.  They are queued, merged with the other pending
+        operations, and sent by a :class:`UserIdDispatcher`.
+
+        Args:
+            **kwargs: Passed to :class:`UserIdDispatcher`
+
+        Returns:
+            UserIdDispatcher: The running dispatcher
+
+        """
+        if self.dispatcher is not None and self.dispatcher.is_running():
+            return self.dispatcher
+        self.dispatcher = UserIdDispatcher(self, **kwargs)
+        self.dispatcher.start()
+        return self.dispatcher
+
+    def stop_dispatcher(self, flush=True, timeout=None):
+        """Stop the background dispatcher
+
+        Args:
+            flush (bool): Send the pending operations before stopping
+            timeout (float): Seconds to wait for the thread to stop
+
+        """
+        if self.dispatcher is not None:
+            self.dispatcher.stop(flush, timeout)
+
+    def start_mirror(self, refresh=True):
+        """Keep a local copy of the registered-ip and user tag tables
+
+        Once started, the operations sent through this UserId also update
+        the :class:`UserIdMirror`, so lookups don't need an API call.
+
+        Args:
+            refresh (bool): Load the tables from the device now
+
+        Returns:
+            UserIdMirror: The mirror
+
+        """
+        if self.mirror is None:
+            self.mirror = UserIdMirror(self)
+            if refresh:
+                self.mirror.refresh()
+        return self.mirror
+
+    def stop_mirror(self):
+        """Stop updating the local copy of the tag tables"""
+        self.mirror = None
 
     def login(self, user, ip, timeout=None):
         """Login a single user
@@ -150,14 +651,9 @@ class UserId(object):
             timeout (int): timeout in minutes to remove this mapping
 
         """
-        root, payload = self._create_uidmessage()
-        login = payload.find("login")
-        if login is None:
-            login = ET.SubElement(payload, "login")
-        entry = ET.SubElement(login, "entry", {"name": user, "ip": ip})
-        if timeout:
-            entry.set("timeout", str(timeout))
-        self.send(root)
+        message = self._message()
+        message.login(user, ip, timeout)
+        self._commit_message(message)
 
     def logins(self, users):
         """Login multiple users in the same API call
@@ -171,18 +667,16 @@ class UserId(object):
         """
         if not users:
             return
-        root, payload = self._create_uidmessage()
-        login = payload.find("login")
-        if login is None:
-            login = ET.SubElement(payload, "login")
+        message = self._message()
         for user in users:
-            entry = ET.SubElement(login, "entry", {"name": user[0], "ip": user[1]})
             try:
-                entry.set("timeout", str(user[2]))
+                timeout = user[2]
             except IndexError:
                 # No timeout specified
-                pass
-        self.send(root)
+                timeout = None
+            message.login(user[0], user[1], timeout)
+            message = self._checkpoint(message)
+        self._commit_message(message)
 
     def logout(self, user, ip):
         """Logout a single user
@@ -196,12 +690,9 @@ class UserId(object):
             ip (str): an ip address
 
         """
-        root, payload = self._create_uidmessage()
-        logout = payload.find("logout")
-        if logout is None:
-            logout = ET.SubElement(payload, "logout")
-        ET.SubElement(logout, "entry", {"name": user, "ip": ip})
-        self.send(root)
+        message = self._message()
+        message.logout(user, ip)
+        self._commit_message(message)
 
     def logouts(self, users):
         """Logout multiple users in the same API call
@@ -215,13 +706,11 @@ class UserId(object):
         """
         if not users:
             return
-        root, payload = self._create_uidmessage()
-        logout = payload.find("logout")
-        if logout is None:
-            logout = ET.SubElement(payload, "logout")
+        message = self._message()
         for user in users:
-            ET.SubElement(logout, "entry", {"name": user[0], "ip": user[1]})
-        self.send(root)
+            message.logout(user[0], user[1])
+            message = self._checkpoint(message)
+        self._commit_message(message)
 
     def register(self, ip, tags):
         """Register an ip tag for a Dynamic Address Group
@@ -233,24 +722,17 @@ class UserId(object):
             tags (:obj:`list` or :obj:`str`): The tag(s) for the IP address
 
         """
-        root, payload = self._create_uidmessage()
-        register = payload.find("register")
-        if register is None:
-            register = ET.SubElement(payload, "register")
         ip = list(set(string_or_list(ip)))
         tags = list(set(string_or_list(tags)))
         if not tags:
             return
         tags = [self.prefix + t for t in tags]
+        message = self._message()
         for c_ip in ip:
-            tagelement = register.find("./entry[@ip='%s']/tag" % c_ip)
-            if tagelement is None:
-                entry = ET.SubElement(register, "entry", {"ip": c_ip})
-                tagelement = ET.SubElement(entry, "tag")
             for tag in tags:
-                member = ET.SubElement(tagelement, "member")
-                member.text = tag
-        self.send(root)
+                message.register(c_ip, tag)
+                message = self._checkpoint(message)
+        self._commit_message(message)
 
     def unregister(self, ip, tags):
         """Unregister an ip tag for a Dynamic Address Group
@@ -262,26 +744,19 @@ class UserId(object):
             tags (:obj:`list` or :obj:`str`): The tag(s) to remove from the IP address
 
         """
-        root, payload = self._create_uidmessage()
-        unregister = payload.find("unregister")
-        if unregister is None:
-            unregister = ET.SubElement(payload, "unregister")
         ip = list(set(string_or_list(ip)))
         tags = list(set(string_or_list(tags)))
         if not tags:
             return
         tags = [self.prefix + t for t in tags]
+        message = self._message()
         for c_ip in ip:
-            tagelement = unregister.find("./entry[@ip='%s']/tag" % c_ip)
-            if tagelement is None:
-                entry = ET.SubElement(unregister, "entry", {"ip": c_ip})
-                tagelement = ET.SubElement(entry, "tag")
             for tag in tags:
-                member = ET.SubElement(tagelement, "member")
-                member.text = tag
-        self.send(root)
+                message.unregister(c_ip, tag)
+                message = self._checkpoint(message)
+        self._commit_message(message)
 
-    def get_registered_ip(self, ip=None, tags=None, prefix=None):
+    def get_registered_ip(self, ip=None, tags=None, prefix=None, page_size=500):
         """Return registered/tagged addresses
 
         When called without arguments, retrieves all registered addresses.
@@ -292,12 +767,16 @@ class UserId(object):
         result in retreival of the entire tag database from the firewall which is then filtered and
         returned with only the relevant entries. Therefor, using a single ip or tag is more efficient.
 
+        For very large tables use :meth:`iter_registered_ip`, which doesn't
+        keep the whole table in memory.
+
         **Support:** PAN-OS 6.0 and higher
 
         Args:
             ip (:obj:`list` or :obj:`str`): IP address(es) to get tags for
             tags (:obj:`list` or :obj:`str`): Tag(s) to get
             prefix (str): Override class tag prefix
+            page_size (int): Entries to request per API call (PAN-OS 8.0+)
 
         Returns:
             dict: ip addresses as keys with tags as values
@@ -306,6 +785,40 @@ class UserId(object):
             PanDeviceError if running PAN-OS < 8.0 and a logfile is returned
                 instead of IP/tag mapings.
 
+        """
+        return dict(
+            self.iter_registered_ip(ip, tags, prefix, page_size, prefetch=False)
+        )
+
+    def iter_registered_ip(
+        self, ip=None, tags=None, prefix=None, page_size=500, prefetch=True
+    ):
+        """Iterate over registered/tagged addresses one page at a time
+
+        Works like :meth:`get_registered_ip`, but yields each address as it
+        is read, so only a page or two of the table is in memory at once.
+
+        With ``prefetch`` the next page is requested from a background
+        thread while the caller works through the current one.  The
+        background thread uses its own API connection, so the caller can
+        keep using the device while iterating.
+
+        **Support:** PAN-OS 6.0 and higher
+
+        Args:
+            ip (:obj:`list` or :obj:`str`): IP address(es) to get tags for
+            tags (:obj:`list` or :obj:`str`): Tag(s) to get
+            prefix (str): Override class tag prefix
+            page_size (int): Entries to request per API call (PAN-OS 8.0+)
+            prefetch (bool): Request the next page in the background
+
+        Yields:
+            tuple: An ip address and its list of tags
+
+        Raises:
+            PanDeviceError if running PAN-OS < 8.0 and a logfile is returned
+                instead of IP/tag mapings.
+
         """
         if self.device is None:
             raise err.PanDeviceNotSet("No device set for this userid instance")
@@ -316,74 +829,87 @@ class UserId(object):
 
         # Build up the command.
         limit = 0
-        start_elm = None
-        start_offset = 1
         root = ET.Element("show")
         cmd = ET.SubElement(root, "object")
         if version >= (6, 1, 0):
             cmd = ET.SubElement(cmd, "registered-ip")
             if version >= (8, 0, 0):
                 # PAN-OS 8.0+ supports paging.
-                limit = 500
+                limit = int(page_size)
                 ET.SubElement(cmd, "limit").text = "{0}".format(limit)
-                start_elm = ET.SubElement(cmd, "start-point")
-                start_elm.text = "{0}".format(start_offset)
+                ET.SubElement(cmd, "start-point")
         else:
             cmd = ET.SubElement(cmd, "registered-address")
 
         # Add ip/tag filter arguments to command.
-        ip = list(set(string_or_list_or_none(ip)))
-        tags = list(set(string_or_list_or_none(tags)))
-        tags = [prefix + t for t in tags]
+        ip = set(string_or_list_or_none(ip))
+        tags = set(prefix + t for t in string_or_list_or_none(tags))
         if len(tags) == 1:
             tag_element = ET.SubElement(cmd, "tag")
-            ET.SubElement(tag_element, "entry", {"name": tags[0]})
+            ET.SubElement(tag_element, "entry", {"name": next(iter(tags))})
         if len(ip) == 1:
             ip_element = ET.SubElement(cmd, "ip")
-            ip_element.text = ip[0]
+            ip_element.text = next(iter(ip))
 
-        addresses = {}
-        while True:
-            resp = self.device.op(
-                cmd=ET.tostring(root, encoding="utf-8"),
-                vsys=self.device.vsys,
-                cmd_xml=False,
-            )
+        xapi = None
+        if prefetch and limit:
+            xapi = self.device.generate_xapi()
 
-            # PAN-OS 7.1 and lower can return "outfile" instead of actual results.
-            outfile = resp.find("./result/msg/line/outfile")
-            if outfile is not None:
-                msg = [
-                    'PAN-OS returned "{0}" instead of IP/tag mappings'.format(
-                        outfile.text
-                    ),
-                    "please upgrade to PAN-OS 8.0+",
-                ]
-                raise err.PanDeviceError(", ".join(msg))
+        start_offset = 1
+        page = self._registered_ip_page(root, start_offset)
+        while True:
+            entries = page.findall("./result/entry")
+            next_page = None
+            if limit and len(entries) >= limit:
+                start_offset += len(entries)
+                if xapi is not None:
+                    next_page = _Prefetch(
+                        self._registered_ip_page, root, start_offset, xapi
+                    )
+                else:
+                    next_page = start_offset
+            del page
 
-            entries = resp.findall("./result/entry")
             for entry in entries:
                 c_ip = entry.get("ip")
                 if ip and c_ip not in ip:
                     continue
-                members = entry.findall("./tag/member")
                 c_tags = []
-                for member in members:
+                for member in entry.findall("./tag/member"):
                     tag = member.text
                     if not prefix or tag.startswith(prefix):
                         if not tags or tag in tags:
                             c_tags.append(tag)
                 if c_tags:
-                    addresses[c_ip] = c_tags
+                    yield c_ip, c_tags
 
-            if start_elm is None or limit == 0 or len(entries) < limit:
+            if next_page is None:
                 break
+            elif isinstance(next_page, _Prefetch):
+                page = next_page.result()
+            else:
+                page = self._registered_ip_page(root, next_page)
 
-            start_offset += len(entries)
+    def _registered_ip_page(self, root, start_offset, xapi=None):
+        start_elm = root.find("./object/registered-ip/start-point")
+        if start_elm is not None:
             start_elm.text = "{0}".format(start_offset)
+        cmd = ET.tostring(root, encoding="utf-8")
+        if xapi is None:
+            resp = self.device.op(cmd=cmd, vsys=self.device.vsys, cmd_xml=False)
+        else:
+            resp = xapi.op(cmd=cmd, vsys=self.device.vsys, cmd_xml=False)
 
-        # Done.
-        return addresses
+        # PAN-OS 7.1 and lower can return "outfile" instead of actual results.
+        outfile = resp.find("./result/msg/line/outfile")
+        if outfile is not None:
+            msg = [
+                'PAN-OS returned "{0}" instead of IP/tag mappings'.format(outfile.text),
+                "please upgrade to PAN-OS 8.0+",
+            ]
+            raise err.PanDeviceError(", ".join(msg))
+
+        return resp
 
     def clear_registered_ip(self, ip=None, tags=None, prefix=None):
         """Unregister registered/tagged addresses
@@ -414,7 +940,7 @@ class UserId(object):
             self.unregister(ip, tags)
         self.batch_end()
 
-    def audit_registered_ip(self, ip_tags_pairs):
+    def audit_registered_ip(self, ip_tags_pairs, chunk_size=1000, dry_run=False):
         """Synchronize the current registered-ip tag list to this exact set of ip-tags
 
         Sets the registered-ip tag list on the device.
@@ -424,6 +950,10 @@ class UserId(object):
         needed. If the list is currently in the requested state, no API call is made after
         retrieving the list.
 
+        The changes are sent in uid-messages of at most ``chunk_size``
+        tag operations each.  With ``dry_run``, the changes are computed
+        but nothing is sent.
+
         **Support:** PAN-OS 6.0 and higher
 
         Warning:
@@ -431,34 +961,60 @@ class UserId(object):
 
         Args:
             ip_tags_pairs (dict): dictionary where keys are ip addresses and values or tuples of tags
+            chunk_size (int): Most tag operations to send in one API call
+            dry_run (bool): Only compute the changes, don't send them
+
+        Returns:
+            dict: The number of tags to ``register`` and ``unregister``, and
+            the number of IPs with tags to register (``register_ips``) or
+            unregister (``unregister_ips``)
 
         """
-        device_list = self.get_registered_ip()
-        requested_list = deepcopy(ip_tags_pairs)
-        self.batch_start()
-        # Handle unregistrations
-        for ip, tags in device_list.items():
-            if ip not in requested_list:
-                # The IP is not requested, unregister it and all its tags
-                self.unregister(ip, tags)
-            else:
-                # Convert requested tags from tuple to list
-                requested_list[ip] = list(requested_list[ip])
-                # The IP is requested, audit its tags
-                for tag in tags:
-                    if tag not in requested_list[ip]:
-                        # Tag is not requested, unregister it
-                        self.unregister(ip, tag)
-                    else:
-                        # Tag already exists on device, so don't re-register it
-                        requested_list[ip].remove(tag)
-        # Remove ip's with no tags left to register
-        requested_list = {ip: tags for ip, tags in requested_list.items() if tags}
-        # Handle registrations
-        for ip, tags in requested_list.items():
-            self.register(ip, tags)
+        requested = dict(
+            (ip, set(string_or_list_or_none(tags)))
+            for ip, tags in ip_tags_pairs.items()
+        )
+        prefix = self.prefix or ""
+
+        # Compute the difference while reading the device's list, and only
+        # send it after the whole list is read, as unregistering shifts
+        # the position of the entries still to be read.
+        to_register = {}
+        to_unregister = {}
+        seen = set()
+        for ip, tags in self.iter_registered_ip():
+            current = set(t[len(prefix) :] for t in tags)
+            wanted = requested.get(ip)
+            if wanted is None:
+                to_unregister[ip] = current
+                continue
+            seen.add(ip)
+            if current - wanted:
+                to_unregister[ip] = current - wanted
+            if wanted - current:
+                to_register[ip] = wanted - current
+        for ip, tags in requested.items():
+            if ip not in seen and tags:
+                to_register[ip] = tags
+
+        ans = {
+            "register": sum(len(x) for x in to_register.values()),
+            "unregister": sum(len(x) for x in to_unregister.values()),
+            "register_ips": len(to_register),
+            "unregister_ips": len(to_unregister),
+        }
+        if dry_run:
+            return ans
+
+        self.batch_start(max_entries=chunk_size)
+        for ip, tags in to_unregister.items():
+            self.unregister(ip, list(tags))
+        for ip, tags in to_register.items():
+            self.register(ip, list(tags))
         self.batch_end()
 
+        return ans
+
     def set_group(self, group, users):
         """
         Set a group's membership to the specified users.
@@ -470,29 +1026,9 @@ class UserId(object):
             users (list): The users to be in this group.
 
         """
-        root, payload = self._create_uidmessage()
-
-        # Find the groups section.
-        groups = payload.find("./groups")
-        if groups is None:
-            groups = ET.SubElement(payload, "groups")
-
-        # Find the group.
-        entries = groups.findall("./entry")
-        for entry in entries:
-            if entry.attrib["name"] == group:
-                ge = entry.find("./members")
-                break
-        else:
-            entry = ET.SubElement(groups, "entry", {"name": group})
-            ge = ET.SubElement(entry, "members")
-
-        # Now add in the users to this group.
-        for user in users:
-            ET.SubElement(ge, "entry", {"name": user})
-
-        # Done.
-        self.send(root)
+        message = self._message()
+        message.set_group(group, users)
+        self._commit_message(message)
 
     def get_groups(self, style=None):
         """
@@ -664,32 +1200,11 @@ class UserId(object):
         if prefix is None:
             prefix = self.prefix or ""
 
-        root, payload = self._create_uidmessage()
-
-        # Find the register user tags section.
-        ru = payload.find("./register-user")
-        if ru is None:
-            ru = ET.SubElement(payload, "register-user")
-
-        # Find the tags section for this specific user.
-        entries = ru.findall("./entry")
-        for entry in entries:
-            if entry.attrib["name"] == user:
-                te = entry.find("./tag")
-                break
-        else:
-            entry = ET.SubElement(ru, "entry", {"user": user,})
-            te = ET.SubElement(entry, "tag")
-
-        # Now add in the tags with the specified timeout.
-        props = {}
-        if timeout is not None:
-            props["timeout"] = "{0}".format(timeout)
+        message = self._message()
         for tag in tags:
-            ET.SubElement(te, "member", props).text = prefix + tag
-
-        # Done.
-        self.send(root)
+            message.tag_user(user, prefix + tag, timeout)
+            message = self._checkpoint(message)
+        self._commit_message(message)
 
     def untag_user(self, user, tags=None, prefix=None):
         """
@@ -705,33 +1220,809 @@ class UserId(object):
             prefix: Override class tag prefix.
 
         """
-        root, payload = self._create_uidmessage()
-
         if prefix is None:
             prefix = self.prefix or ""
 
-        # Find the unregister user tags section.
-        uu = payload.find("./unregister-user")
-        if uu is None:
-            uu = ET.SubElement(payload, "unregister-user")
-
-        # Find the tags section for this specific user.
-        entries = uu.findall("./entry")
-        for entry in entries:
-            if entry.attrib["name"] == user:
-                break
+        message = self._message()
+        if tags is None:
+            message.untag_user(user)
         else:
-            entry = ET.SubElement(uu, "entry", {"user": user,})
+            for tag in tags:
+                message.untag_user(user, prefix + tag)
+                message = self._checkpoint(message)
+        self._commit_message(message)
+
+
+class UserIdDispatcher(object):
+    """Send User-ID operations to a device from a background thread
+
+    Operations given to :meth:`put` are merged into one pending
+    :class:`UidMessage`, so opposite operations on the same mapping cancel
+    out before they are sent.  The pending message is sent every
+    ``interval`` seconds, or as soon as it has ``max_entries`` operations.
+    Producers never wait on the device.
+
+    Sends that fail with a connection error are retried with an increasing
+    wait, up to ``retries`` times.  The API calls go through the HA aware
+    :class:`panos.base.PanDevice.XapiWrapper`, so an HA pair fails over to
+    the peer.  The dispatcher uses its own connection, so the thread
+    doesn't share one with the rest of the program.
+
+    Usually created with :meth:`UserId.start_dispatcher`.
+
+    Args:
+        userid (UserId): The User-ID subsystem to send for
+        interval (float): Longest time in seconds an operation waits before
+            it is sent
+        max_entries (int): Send as soon as this many operations are pending
+        retries (int): Times to retry a send that failed with a connection
+            error
+        wait (panos.jobs.WaitStrategy): Time between retries.  Defaults to
+            exponential backoff.
+        coalesce (bool): Cancel opposite operations on the same mapping
+
+    Attributes:
+        stats (dict): Counters of sent and failed messages and operations,
+            retries, and the latency from the oldest operation of a message
+            being queued until it was sent
+
+    """
+
+    def __init__(
+        self,
+        userid,
+        interval=1.0,
+        max_entries=1000,
+        retries=3,
+        wait=None,
+        coalesce=True,
+    ):
+        self._logger = getlogger(__name__ + "." + self.__class__.__name__)
+        self.userid = userid
+        self.interval = interval
+        self.max_entries = max_entries
+        self.retries = retries
+        if wait is None:
+            wait = jobs.ExponentialWait(interval=1.0, max_interval=30.0)
+        self.wait = wait
+        self.coalesce = coalesce
+        # Set on first use, tests may set their own
+        self.xapi = None
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._pending = UidMessage(coalesce)
+        # Messages to send before the pending one: (cmd, entries, created)
+        self._ready = collections.deque()
+        self._sending = 0
+        self._thread = None
+        self._stopping = False
+        self._flush_on_stop = True
+        self._flush_requested = False
+        self.last_error = None
+        self.stats = {
+            "sent_messages": 0,
+            "sent_entries": 0,
+            "failed_messages": 0,
+            "failed_entries": 0,
+            "retries": 0,
+            "last_latency": None,
+            "max_latency": 0.0,
+            "total_latency": 0.0,
+        }
+
+    def __len__(self):
+        return self.queue_depth()
+
+    def is_running(self):
+        """True if the background thread is running"""
+        with self._lock:
+            return self._thread is not None and not self._stopping
+
+    def queue_depth(self):
+        """The number of operations waiting to be sent"""
+        with self._lock:
+            ready = sum(entries for cmd, entries, created in self._ready)
+            return len(self._pending) + ready + self._sending
+
+    def oldest_age(self):
+        """Seconds the oldest pending operation has been waiting"""
+        with self._lock:
+            if self._ready:
+                return time.time() - self._ready[0][2]
+            if not len(self._pending):
+                return 0.0
+            return time.time() - self._pending.created
+
+    def average_latency(self):
+        """Average seconds from queueing a message until it was sent"""
+        with self._lock:
+            if not self.stats["sent_messages"]:
+                return None
+            return self.stats["total_latency"] / self.stats["sent_messages"]
+
+    def put(self, message):
+        """Queue the operations of a message
+
+        Args:
+            message (UidMessage): The operations to send
+
+        """
+        with self._lock:
+            if not len(self._pending):
+                self._pending.created = time.time()
+            self._pending.update(message)
+            if len(self._pending) >= self.max_entries:
+                self._wakeup.notify_all()
+
+    def put_raw(self, cmd, message=None):
+        """Queue a uid-message that is sent unchanged
+
+        The operations pending so far are sent first, so the order of the
+        operations is kept.
+
+        Args:
+            cmd (str): The uid-message to send
+            message (UidMessage): The operations of ``cmd``, if known, for
+                the stats
+
+        """
+        with self._lock:
+            self._take_pending()
+            entries = len(message) if message is not None else 1
+            self._ready.append((cmd, entries, time.time()))
+            self._wakeup.notify_all()
+
+    def _take_pending(self):
+        """Move the pending operations to the ready messages"""
+        if not len(self._pending):
+            return
+        message = self._pending
+        self._pending = UidMessage(self.coalesce)
+        self._flush_requested = False
+        for part in message.split():
+            uidmessage = part.element()
+            if uidmessage is not None:
+                self._ready.append((ET.tostring(uidmessage), len(part), part.created))
+
+    def flush(self):
+        """Ask the thread to send the pending operations now"""
+        with self._lock:
+            if len(self._pending):
+                self._flush_requested = True
+                self._wakeup.notify_all()
+
+    def start(self):
+        """Start the background thread"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name="panos-userid-dispatcher"
+            )
+            self._thread.daemon = True
+            self._thread.start()
 
-        # Do tag removal.
-        te = entry.find("./tag")
-        if tags is not None:
-            if te is None:
-                te = ET.SubElement(entry, "tag")
+    def stop(self, flush=True, timeout=None):
+        """Stop the background thread
+
+        Args:
+            flush (bool): Send the pending operations before stopping
+            timeout (float): Seconds to wait for the thread to stop
+
+        """
+        with self._lock:
+            thread = self._thread
+            self._stopping = True
+            self._flush_on_stop = flush
+            self._wakeup.notify_all()
+        if thread is not None:
+            thread.join(timeout)
+        with self._lock:
+            if thread is None or not thread.is_alive():
+                self._thread = None
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._stopping and not self._ready:
+                    remaining = self._pending.created + self.interval - time.time()
+                    if len(self._pending) and (
+                        remaining <= 0
+                        or len(self._pending) >= self.max_entries
+                        or self._flush_requested
+                    ):
+                        break
+                    self._wakeup.wait(
+                        self.interval if not len(self._pending) else remaining
+                    )
+                if self._stopping and (
+                    not self._flush_on_stop
+                    or (not len(self._pending) and not self._ready)
+                ):
+                    return
+                if not self._ready:
+                    self._take_pending()
+                if not self._ready:
+                    continue
+                cmd, entries, created = self._ready.popleft()
+                self._sending = entries
+            try:
+                self._send(cmd, entries, created)
+            finally:
+                with self._lock:
+                    self._sending = 0
+
+    def _retried(self, error):
+        with self._lock:
+            self.stats["retries"] += 1
+
+    def _send(self, cmd, entries, created):
+        if self.xapi is None:
+            self.xapi = self.userid.device.generate_xapi()
+        try:
+            _send_with_retries(
+                self.userid,
+                self.userid.device,
+                cmd,
+                self.xapi,
+                self.userid.device.vsys,
+                self.retries,
+                self.wait,
+                self._retried,
+            )
+        except Exception as e:
+            self._logger.warning("Failed to send User-ID message: %s" % e)
+            with self._lock:
+                self.last_error = e
+                self.stats["failed_messages"] += 1
+                self.stats["failed_entries"] += entries
+            return
+        latency = time.time() - created
+        with self._lock:
+            self.stats["sent_messages"] += 1
+            self.stats["sent_entries"] += entries
+            self.stats["last_latency"] = latency
+            self.stats["max_latency"] = max(self.stats["max_latency"], latency)
+            self.stats["total_latency"] += latency
+
+
+class UserIdMirror(object):
+    """A local copy of the registered-ip and user tag tables of a device
+
+    :meth:`refresh` reads both tables from the device.  After that, the
+    operations sent through the :class:`UserId` are applied to the copy
+    as they are sent, and lookups like :meth:`ips_for_tag` are answered
+    from in-memory indexes.
+
+    The tags touched by those operations, and the users whose tags
+    changed, are remembered.  :meth:`reconcile` reads just those back
+    from the device, using the device side tag and user filters, to catch
+    sends that failed and tags that timed out.  Changes made by other
+    clients are only seen by a full :meth:`refresh`.
+
+    Like :meth:`UserId.get_registered_ip`, tags are stored with the
+    :class:`UserId` prefix and only tags with the prefix are loaded.
+    Lookups take tag names without the prefix.
+
+    Usually created with :meth:`UserId.start_mirror`.
+
+    Args:
+        userid (UserId): The User-ID subsystem to mirror
+
+    """
+
+    def __init__(self, userid):
+        self._logger = getlogger(__name__ + "." + self.__class__.__name__)
+        self.userid = userid
+        self._lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Forget everything"""
+        with self._lock:
+            self._ip_tags = {}
+            self._tag_ips = {}
+            self._user_tags = {}
+            self._tag_users = {}
+            self._dirty_tags = set()
+            self._dirty_users = set()
+            self.last_refresh = None
+            self.last_reconcile = None
+
+    def _link(self, forward, reverse, key, tag):
+        forward.setdefault(key, set()).add(tag)
+        reverse.setdefault(tag, set()).add(key)
+
+    def _unlink(self, forward, reverse, key, tag):
+        for index, a, b in ((forward, key, tag), (reverse, tag, key)):
+            values = index.get(a)
+            if values is not None:
+                values.discard(b)
+                if not values:
+                    del index[a]
+
+    def refresh(self):
+        """Load both tag tables from the device"""
+        ip_tags = {}
+        tag_ips = {}
+        for ip, tags in self.userid.iter_registered_ip():
             for tag in tags:
-                ET.SubElement(te, "member").text = prefix + tag
-        elif te is not None:
-            entry.remove(te)
+                self._link(ip_tags, tag_ips, ip, tag)
+        user_tags = {}
+        tag_users = {}
+        if self.userid.device.retrieve_panos_version() >= (9, 1, 0):
+            for user, tags in self.userid.get_user_tags().items():
+                for tag in tags:
+                    self._link(user_tags, tag_users, user, tag)
+        with self._lock:
+            self._ip_tags, self._tag_ips = ip_tags, tag_ips
+            self._user_tags, self._tag_users = user_tags, tag_users
+            self._dirty_tags = set()
+            self._dirty_users = set()
+            self.last_refresh = self.last_reconcile = time.time()
 
-        # Done.
-        self.send(root)
+    def reconcile(self, full=False):
+        """Re-read from the device what changed since the last sync
+
+        Args:
+            full (bool): Do a full :meth:`refresh` instead
+
+        Returns:
+            int: The number of tags and users that were read back
+
+        """
+        if full:
+            self.refresh()
+            return len(self._tag_ips) + len(self._user_tags)
+        with self._lock:
+            tags, self._dirty_tags = self._dirty_tags, set()
+            users, self._dirty_users = self._dirty_users, set()
+        try:
+            for tag in tags:
+                ips = set(
+                    ip
+                    for ip, _ in self.userid.iter_registered_ip(
+                        tags=tag, prefix="", prefetch=False
+                    )
+                )
+                with self._lock:
+                    for ip in self._tag_ips.get(tag, set()) - ips:
+                        self._unlink(self._ip_tags, self._tag_ips, ip, tag)
+                    for ip in ips:
+                        self._link(self._ip_tags, self._tag_ips, ip, tag)
+            for user in users:
+                current = set(self.userid.get_user_tags(user).get(user, ()))
+                with self._lock:
+                    for tag in self._user_tags.get(user, set()) - current:
+                        self._unlink(self._user_tags, self._tag_users, user, tag)
+                    for tag in current:
+                        self._link(self._user_tags, self._tag_users, user, tag)
+        except Exception:
+            with self._lock:
+                self._dirty_tags.update(tags)
+                self._dirty_users.update(users)
+            raise
+        self.last_reconcile = time.time()
+        return len(tags) + len(users)
+
+    def apply(self, message):
+        """Apply the operations of a message to the copy
+
+        Args:
+            message (UidMessage): The operations being sent
+
+        """
+        with self._lock:
+            for name, section in message.operations():
+                if name in ("register", "unregister"):
+                    for ip, tags in section.items():
+                        for tag in tags:
+                            self._dirty_tags.add(tag)
+                            if name == "register":
+                                self._link(self._ip_tags, self._tag_ips, ip, tag)
+                            else:
+                                self._unlink(self._ip_tags, self._tag_ips, ip, tag)
+                elif name in ("register-user", "unregister-user"):
+                    for user, tags in section.items():
+                        self._dirty_users.add(user)
+                        if tags is None:
+                            tags = list(self._user_tags.get(user, ()))
+                        for tag in tags:
+                            if name == "register-user":
+                                self._link(self._user_tags, self._tag_users, user, tag)
+                            else:
+                                self._unlink(
+                                    self._user_tags, self._tag_users, user, tag
+                                )
+
+    def dirty(self):
+        """The number of tags and users changed since the last sync"""
+        with self._lock:
+            return len(self._dirty_tags) + len(self._dirty_users)
+
+    def _tag(self, tag, prefix):
+        if prefix is None:
+            prefix = self.userid.prefix or ""
+        return prefix + tag
+
+    def tags_for_ip(self, ip):
+        """The tags registered to an IP
+
+        Returns:
+            set: Tag names, as on the device
+
+        """
+        with self._lock:
+            return set(self._ip_tags.get(ip, ()))
+
+    def ips_for_tag(self, tag, prefix=None):
+        """The IPs a tag is registered to
+
+        Args:
+            tag (str): The tag, without the prefix
+            prefix (str): Override class tag prefix
+
+        Returns:
+            set: IP addresses
+
+        """
+        with self._lock:
+            return set(self._tag_ips.get(self._tag(tag, prefix), ()))
+
+    def tags_for_user(self, user):
+        """The tags of a user
+
+        Returns:
+            set: Tag names, as on the device
+
+        """
+        with self._lock:
+            return set(self._user_tags.get(user, ()))
+
+    def users_for_tag(self, tag, prefix=None):
+        """The users with a tag
+
+        Args:
+            tag (str): The tag, without the prefix
+            prefix (str): Override class tag prefix
+
+        Returns:
+            set: User names
+
+        """
+        with self._lock:
+            return set(self._tag_users.get(self._tag(tag, prefix), ()))
+
+    def registered_ip(self):
+        """The registered-ip table, like :meth:`UserId.get_registered_ip`"""
+        with self._lock:
+            return dict((ip, sorted(tags)) for ip, tags in self._ip_tags.items())
+
+    def user_tags(self):
+        """The user tag table, like :meth:`UserId.get_user_tags`"""
+        with self._lock:
+            return dict((user, sorted(tags)) for user, tags in self._user_tags.items())
+
+
+class UserIdFanout(UserId):
+    """Send the same User-ID operations to many devices
+
+    Has the same operations as :class:`UserId`, like :meth:`login`,
+    :meth:`register` and batching, but each uid-message is serialized once
+    and sent to every target, with up to ``concurrency`` devices at a time.
+    A target is a firewall or Panorama, or a ``(device, vsys)`` tuple to
+    send to a vsys other than the device's own.  Each target gets its own
+    API connection.
+
+    Sends that fail with a connection error are retried with an increasing
+    wait, up to ``retries`` times.  A target that still fails is counted
+    and logged, and doesn't stop the other targets.  The per target
+    counters are in :attr:`targets`.
+
+    By default each operation returns once it was sent to every target.
+    After :meth:`start`, messages are sent by a background thread instead.
+    At most ``max_pending`` messages are queued, after that the operations
+    wait for the queue to drain, so a slow target holds back the producer
+    rather than filling memory.
+
+    The worker threads sending to the targets are created on the first
+    send and reused for every message until :meth:`stop`.
+
+    Example::
+
+        fanout = UserIdFanout(firewalls, concurrency=16)
+        fanout.batch_start()
+        for ip, tags in mappings.items():
+            fanout.register(ip, tags)
+        fanout.batch_end()
+
+    Args:
+        targets (list): Devices or (device, vsys) tuples to send to
+        prefix (str): Prefix to use in all IP tag operations
+        ignore_dup_errors (bool): Ignore errors about registering a tag that
+            already exists
+        concurrency (int): Most devices to send to at once
+        retries (int): Times to retry a send that failed with a connection
+            error
+        wait (panos.jobs.WaitStrategy): Time between retries.  Defaults to
+            exponential backoff.
+        max_pending (int): Most messages queued while the background thread
+            is running
+
+    Attributes:
+        targets (list): A dict per target, with the ``device`` and ``vsys``
+            sent to, counters of ``sent`` and ``failed`` messages and
+            ``retries``, and the ``last_error`` of the target, which is None
+            if the last message was sent
+
+    """
+
+    def __init__(
+        self,
+        targets,
+        prefix="",
+        ignore_dup_errors=True,
+        concurrency=8,
+        retries=3,
+        wait=None,
+        max_pending=10,
+    ):
+        super(UserIdFanout, self).__init__(None, prefix, ignore_dup_errors)
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self.concurrency = concurrency
+        self.retries = retries
+        if wait is None:
+            wait = jobs.ExponentialWait(interval=1.0, max_interval=30.0)
+        self.wait = wait
+        self.max_pending = max_pending
+        self.targets = []
+        for target in targets:
+            if isinstance(target, (tuple, list)):
+                device, vsys = target
+            else:
+                device, vsys = target, target.vsys
+            self.targets.append(
+                {
+                    "device": device,
+                    "vsys": vsys,
+                    "xapi": None,
+                    "sent": 0,
+                    "failed": 0,
+                    "retries": 0,
+                    "last_error": None,
+                }
+            )
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._queue = collections.deque()
+        self._sending = False
+        self._thread = None
+        self._stopping = False
+        # Worker threads and the sends they have to do
+        self._work = threading.Condition(self._lock)
+        self._done = threading.Condition(self._lock)
+        self._jobs = collections.deque()
+        self._pool = None
+
+    def failed_targets(self):
+        """The targets the last message could not be sent to"""
+        with self._lock:
+            return [x for x in self.targets if x["last_error"] is not None]
+
+    def send(self, uidmessage):
+        """Send a uidmessage to every target
+
+        Args:
+            uidmessage (xml.etree.ElementTree.Element): The uid-message
+
+        """
+        if self._batch:
+            return
+        self._fanout(ET.tostring(uidmessage))
+
+    def _deliver(self, message):
+        for part in message.split():
+            uidmessage = part.element()
+            if uidmessage is not None:
+                self._fanout(ET.tostring(uidmessage))
+
+    def _fanout(self, cmd):
+        with self._lock:
+            if self._thread is not None and not self._stopping:
+                while len(self._queue) >= self.max_pending and not self._stopping:
+                    self._wakeup.wait()
+                self._queue.append(cmd)
+                self._wakeup.notify_all()
+                return
+        self._send_all(cmd)
+
+    def _send_all(self, cmd):
+        count = min(self.concurrency, len(self.targets))
+        if count <= 1:
+            for target in self.targets:
+                self._send_target(target, cmd)
+            return
+        with self._lock:
+            if self._pool is None:
+                self._pool = {"closing": False}
+                for _ in range(count):
+                    thread = threading.Thread(
+                        target=self._work_loop,
+                        args=(self._pool,),
+                        name="panos-userid-fanout-worker",
+                    )
+                    thread.daemon = True
+                    thread.start()
+            remaining = [len(self.targets)]
+            for target in self.targets:
+                self._jobs.append((target, cmd, remaining))
+            self._work.notify_all()
+            while remaining[0]:
+                self._done.wait()
+
+    def _work_loop(self, pool):
+        while True:
+            with self._lock:
+                while not self._jobs:
+                    if pool["closing"]:
+                        return
+                    self._work.wait()
+                target, cmd, remaining = self._jobs.popleft()
+            try:
+                self._send_target(target, cmd)
+            finally:
+                with self._lock:
+                    remaining[0] -= 1
+                    if not remaining[0]:
+                        self._done.notify_all()
+
+    def _send_target(self, target, cmd):
+        device = target["device"]
+        if target["xapi"] is None:
+            target["xapi"] = device.generate_xapi()
+
+        def retried(error):
+            with self._lock:
+                target["retries"] += 1
+
+        try:
+            _send_with_retries(
+                self,
+                device,
+                cmd,
+                target["xapi"],
+                target["vsys"],
+                self.retries,
+                self.wait,
+                retried,
+            )
+        except Exception as e:
+            self._logger.warning(
+                "Failed to send User-ID message to {0}: {1}".format(device, e)
+            )
+            with self._lock:
+                target["failed"] += 1
+                target["last_error"] = e
+            return
+        with self._lock:
+            target["sent"] += 1
+            target["last_error"] = None
+
+    def is_running(self):
+        """True if the background thread is running"""
+        with self._lock:
+            return self._thread is not None and not self._stopping
+
+    def queue_depth(self):
+        """The number of messages waiting to be sent"""
+        with self._lock:
+            return len(self._queue) + (1 if self._sending else 0)
+
+    def start(self):
+        """Send messages from a background thread"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run, name="panos-userid-fanout"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, flush=True, timeout=None):
+        """Stop the background thread
+
+        The worker threads are stopped too, once they are idle.
+
+        Args:
+            flush (bool): Send the queued messages before stopping
+            timeout (float): Seconds to wait for the thread to stop
+
+        """
+        with self._lock:
+            thread = self._thread
+            self._stopping = True
+            if not flush:
+                self._queue.clear()
+            self._wakeup.notify_all()
+        if thread is not None:
+            thread.join(timeout)
+        with self._lock:
+            if thread is None or not thread.is_alive():
+                self._thread = None
+            if self._pool is not None:
+                self._pool["closing"] = True
+                self._pool = None
+                self._work.notify_all()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._stopping:
+                    self._wakeup.wait()
+                if not self._queue:
+                    return
+                cmd = self._queue.popleft()
+                self._sending = True
+                self._wakeup.notify_all()
+            try:
+                self._send_all(cmd)
+            finally:
+                with self._lock:
+                    self._sending = False
+
+
+def _send_with_retries(userid, device, cmd, xapi, vsys, retries, wait, on_retry=None):
+    """Send a uid-message to a device, retrying connection errors
+
+    Raises the last error if the message could not be sent.
+
+    """
+    connection_errors = type(device).XapiWrapper.CONNECTION_EXCEPTIONS
+    start = time.time()
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            userid._send(cmd, xapi, vsys)
+            return
+        except Exception as e:
+            retry = isinstance(e, connection_errors) or jobs.is_connection_error(e)
+            if not retry or attempt > retries:
+                raise
+            delay = wait.next_interval(attempt, time.time() - start)
+            logger.debug(
+                "Connection error sending User-ID message, retry in %.2f "
+                "seconds: %s" % (delay, e)
+            )
+            if on_retry is not None:
+                on_retry(e)
+            time.sleep(delay)
+
+
+class _Prefetch(object):
+    """Run one call in a background thread and hand back its result"""
+
+    def __init__(self, func, *args):
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, args=(func,) + args)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, func, *args):
+        try:
+            self._result = func(*args)
+        except Exception as e:
+            self._error = e
+
+    def result(self):
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
@@ -0,0 +1,344 @@
+# Copyright (c) 2014, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+import unittest
+import xml.etree.ElementTree as ET
+
+import pan.xapi
+
+import panos.errors as err
+import panos.firewall
+from panos import jobs
+
+
+JOB_TEMPLATE = """<job>
+<tenq>2020/01/01 00:00:00</tenq>
+<tdeq>00:00:00</tdeq>
+<id>{id}</id>
+<user>admin</user>
+<type>{type}</type>
+<status>{status}</status>
+<queued>NO</queued>
+<stoppable>no</stoppable>
+<result>{result}</result>
+<tfin>{tfin}</tfin>
+<description/>
+<positionInQ>0</positionInQ>
+<progress>{progress}</progress>
+<details><line>Configuration committed successfully</line></details>
+<warnings/>
+</job>"""
+
+
+def job_elm(job_id, status="ACT", job_type="Commit", progress=50):
+    return ET.fromstring(
+        JOB_TEMPLATE.format(
+            id=job_id,
+            type=job_type,
+            status=status,
+            result="OK" if status == "FIN" else "PEND",
+            tfin="2020/01/01 00:00:10" if status == "FIN" else "",
+            progress=100 if status == "FIN" else progress,
+        )
+    )
+
+
+def response(*job_elms):
+    resp = ET.Element("response", {"status": "success"})
+    result = ET.SubElement(resp, "result")
+    for elm in job_elms:
+        result.append(elm)
+    return resp
+
+
+class FakeJobs(object):
+    """Answers 'show jobs' for a firewall from a dict of job id to status."""
+
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.commands = []
+
+    def op(self, cmd=None, **kwargs):
+        self.commands.append(cmd)
+        if cmd == "show jobs all":
+            return response(
+                *[job_elm(x, status) for x, status in sorted(self.statuses.items())]
+            )
+        job_id = cmd.split('"')[1]
+        return response(job_elm(job_id, self.statuses[job_id]))
+
+
+def fake_firewall(statuses):
+    fw = panos.firewall.Firewall("fw", "user", "passwd", "authkey", serial="serial")
+    fw._xapi_private = mock.Mock()
+    fake = FakeJobs(statuses)
+    fw._xapi_private.op.side_effect = fake.op
+    return fw, fake
+
+
+class TestJobWatcher(unittest.TestCase):
+    def test_job_id_from_response(self):
+        resp = ET.fromstring("<response><result><job>7</job></result></response>")
+
+        self.assertEqual("7", jobs.job_id_from(resp))
+        self.assertEqual("7", jobs.job_id_from(7))
+        self.assertIsNone(jobs.job_id_from(ET.fromstring("<response/>")))
+
+    def test_one_summary_request_per_device(self):
+        fw, fake = fake_firewall({"1": "ACT", "2": "ACT", "3": "ACT"})
+        watcher = jobs.JobWatcher()
+        futures = [watcher.watch(fw, x) for x in ("1", "2", "3")]
+
+        watcher.poll()
+
+        self.assertEqual(["show jobs all"], fake.commands)
+        self.assertFalse(any(x.done() for x in futures))
+        self.assertEqual(3, len(watcher))
+
+    def test_finished_jobs_are_resolved(self):
+        fw, fake = fake_firewall({"1": "FIN", "2": "ACT"})
+        watcher = jobs.JobWatcher()
+        callback = mock.Mock()
+        done = watcher.watch(fw, "1", callback=callback)
+        pending = watcher.watch(fw, "2")
+
+        watcher.poll()
+
+        self.assertEqual(["show jobs all", 'show jobs id "1"'], fake.commands)
+        self.assertTrue(done.done())
+        self.assertTrue(done.result()["success"])
+        self.assertEqual("1", done.result()["jobid"])
+        callback.assert_called_once_with(done)
+        self.assertFalse(pending.done())
+        self.assertEqual(1, len(watcher))
+
+    def test_wait_until_done(self):
+        fw, fake = fake_firewall({"1": "ACT"})
+        watcher = jobs.JobWatcher(
+            interval=0, age_factor=0, type_intervals={"Commit": 0}
+        )
+        future = watcher.watch(fw, "1")
+
+        def finish_job(*args, **kwargs):
+            fake.statuses["1"] = "FIN"
+
+        with mock.patch("panos.jobs.time.sleep", side_effect=finish_job) as sleep:
+            self.assertTrue(watcher.wait())
+
+        self.assertEqual(1, sleep.call_count)
+        self.assertTrue(future.result()["success"])
+        self.assertEqual(0, len(watcher))
+
+    def test_connection_errors_are_retried(self):
+        fw, fake = fake_firewall({"1": "FIN"})
+        fw._xapi_private.op.side_effect = [
+            pan.xapi.PanXapiError("URLError: reason: connection refused"),
+        ]
+        watcher = jobs.JobWatcher()
+        future = watcher.watch(fw, "1")
+
+        watcher.poll()
+
+        self.assertFalse(future.done())
+
+    def test_other_errors_fail_the_jobs(self):
+        fw, fake = fake_firewall({"1": "FIN"})
+        fw._xapi_private.op.side_effect = err.PanDeviceXapiError("boom")
+        watcher = jobs.JobWatcher()
+        future = watcher.watch(fw, "1")
+
+        watcher.poll()
+
+        self.assertIsInstance(future.exception(), err.PanDeviceXapiError)
+        self.assertRaises(err.PanDeviceXapiError, future.result)
+
+    def test_timeout(self):
+        fw, fake = fake_firewall({"1": "ACT"})
+        watcher = jobs.JobWatcher(timeout=10)
+        future = watcher.watch(fw, "1")
+        start = watcher._devices[id(fw)][1]["1"].start
+
+        with mock.patch("panos.jobs.time.time", return_value=start + 11):
+            watcher.poll()
+
+        self.assertIsInstance(future.exception(), err.PanJobTimeout)
+
+    def test_interval_grows_with_job_age(self):
+        watcher = jobs.JobWatcher(interval=0.5, max_interval=30, age_factor=0.1)
+        job = mock.Mock(type="Commit", start=0)
+
+        self.assertEqual(0.5, watcher._next_interval(job, 1))
+        self.assertEqual(10, watcher._next_interval(job, 100))
+        self.assertEqual(30, watcher._next_interval(job, 1000))
+        job.type = "Install"
+        self.assertEqual(5.0, watcher._next_interval(job, 1))
+
+    def test_wait_strategy_replaces_age_factor(self):
+        wait = jobs.WaitStrategy(interval=7)
+        watcher = jobs.JobWatcher(interval=0.5, max_interval=30, wait=wait)
+        job = mock.Mock(type="Commit", start=0, polls=3, progress=None)
+
+        self.assertEqual(7, watcher._next_interval(job, 1000))
+        job.type = "Install"
+        self.assertEqual(7, watcher._next_interval(job, 1000))
+        wait.interval = 1
+        self.assertEqual(5.0, watcher._next_interval(job, 1000))
+
+    def test_watcher_records_poll_stats(self):
+        fw, fake = fake_firewall({"1": "FIN"})
+        watcher = jobs.JobWatcher()
+        watcher.watch(fw, "1")
+
+        watcher.poll()
+
+        self.assertEqual(1, fw.poll_stats.stats["watcher"]["completed"])
+        self.assertEqual(1.0, fw.poll_stats.polls_per_completion())
+
+
+class TestWaitStrategies(unittest.TestCase):
+    def test_fixed(self):
+        wait = jobs.WaitStrategy(interval=2)
+
+        self.assertEqual(2, wait.next_interval(1, 0))
+        self.assertEqual(2, wait.next_interval(100, 1000, 50))
+
+    def test_exponential_without_jitter(self):
+        wait = jobs.ExponentialWait(interval=0.5, max_interval=5, jitter=0)
+
+        self.assertEqual(
+            [0.5, 1, 2, 4, 5, 5], [wait.next_interval(x, 0) for x in range(1, 7)]
+        )
+        self.assertEqual(5, wait.next_interval(10 ** 6, 0))
+
+    def test_exponential_jitter_stays_in_range(self):
+        wait = jobs.ExponentialWait(interval=1, max_interval=8, jitter=0.5)
+
+        for _ in range(100):
+            value = wait.next_interval(4, 0)
+            self.assertGreaterEqual(value, 4)
+            self.assertLessEqual(value, 8)
+
+    def test_elapsed_steps(self):
+        wait = jobs.ElapsedWait(steps=[(0, 1), (10, 3), (60, 9)])
+
+        self.assertEqual(1, wait.next_interval(1, 0))
+        self.assertEqual(1, wait.next_interval(1, 9.9))
+        self.assertEqual(3, wait.next_interval(1, 10))
+        self.assertEqual(9, wait.next_interval(1, 600))
+        self.assertRaises(ValueError, jobs.ElapsedWait, steps=[])
+
+    def test_progress_estimates_remaining_time(self):
+        wait = jobs.ProgressWait(interval=0.5, max_interval=60, fraction=0.5)
+
+        self.assertEqual(0.5, wait.next_interval(1, 10, None))
+        self.assertEqual(0.5, wait.next_interval(1, 10, 0))
+        # 25% done in 20 seconds leaves 60 seconds, wait for half of that
+        self.assertEqual(30, wait.next_interval(1, 20, 25))
+        self.assertEqual(0.5, wait.next_interval(1, 20, 99))
+        self.assertEqual(60, wait.next_interval(1, 200, 1))
+
+    def test_job_progress(self):
+        self.assertEqual(50, jobs.job_progress(job_elm("1")))
+        self.assertEqual(100, jobs.job_progress(response(job_elm("1", "FIN"))))
+        self.assertIsNone(jobs.job_progress(ET.fromstring("<job/>")))
+
+
+class TestSyncMethods(unittest.TestCase):
+    def test_syncjob_uses_wait_strategy(self):
+        fw, fake = fake_firewall({"1": "ACT"})
+        wait = mock.Mock()
+        wait.next_interval.return_value = 3
+
+        def finish_job(*args, **kwargs):
+            fake.statuses["1"] = "FIN"
+
+        with mock.patch("panos.base.time.sleep", side_effect=finish_job) as sleep:
+            result = fw.syncjob("1", wait=wait)
+
+        self.assertTrue(result["success"])
+        sleep.assert_called_once_with(3)
+        attempt, elapsed, progress = wait.next_interval.call_args[0]
+        self.assertEqual((1, 50), (attempt, progress))
+        self.assertEqual(2, fw.poll_stats.stats["syncjob"]["polls"])
+        self.assertEqual(2.0, fw.poll_stats.polls_per_completion("syncjob"))
+
+    def test_syncjob_device_default_strategy(self):
+        fw, fake = fake_firewall({"1": "ACT"})
+        fw.wait_strategy = jobs.WaitStrategy(interval=4)
+
+        def finish_job(*args, **kwargs):
+            fake.statuses["1"] = "FIN"
+
+        with mock.patch("panos.base.time.sleep", side_effect=finish_job) as sleep:
+            fw.syncjob("1")
+
+        sleep.assert_called_once_with(4)
+
+    def test_syncjob_retries_connection_errors(self):
+        fw, fake = fake_firewall({"1": "FIN"})
+        fw._xapi_private.op.side_effect = [
+            pan.xapi.PanXapiError("URLError: reason: connection refused"),
+            response(job_elm("1", "FIN")),
+        ]
+
+        with mock.patch("panos.base.time.sleep") as sleep:
+            result = fw.syncjob("1", interval=2)
+
+        self.assertTrue(result["success"])
+        sleep.assert_called_once_with(2)
+        self.assertEqual(2, fw.poll_stats.stats["syncjob"]["polls"])
+
+    def test_syncjob_invalid_interval(self):
+        fw, fake = fake_firewall({"1": "FIN"})
+
+        self.assertRaises(err.PanDeviceError, fw.syncjob, "1", interval=-1)
+
+    def test_syncreboot_uses_wait_strategy(self):
+        fw, fake = fake_firewall({})
+        wait = jobs.ElapsedWait(steps=[(0, 1)])
+        fw.refresh_version = mock.Mock(
+            side_effect=[
+                pan.xapi.PanXapiError("URLError: reason: connection refused"),
+                "9.1.0",
+            ]
+        )
+
+        with mock.patch("panos.base.time.sleep") as sleep:
+            self.assertEqual("9.1.0", fw.syncreboot(wait=wait))
+
+        self.assertEqual([mock.call(1), mock.call(1)], sleep.call_args_list)
+        self.assertEqual(2, fw.poll_stats.stats["syncreboot"]["polls"])
+
+    def test_watch_op_uses_wait_strategy(self):
+        fw, fake = fake_firewall({})
+        values = iter(["no", "no", "yes"])
+        fw._xapi_private.op.side_effect = lambda *args, **kwargs: ET.fromstring(
+            "<response><result><done>{0}</done></result></response>".format(
+                next(values)
+            )
+        )
+        wait = jobs.ExponentialWait(interval=1, jitter=0)
+
+        with mock.patch("panos.base.time.sleep") as sleep:
+            self.assertTrue(fw.watch_op("show done", "done", "yes", wait=wait))
+
+        self.assertEqual([mock.call(1), mock.call(2)], sleep.call_args_list)
+        self.assertEqual(3, fw.poll_stats.stats["watch_op"]["polls"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,679 @@
+# Copyright (c) 2014, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+import unittest
+import xml.etree.ElementTree as ET
+
+import panos.errors as err
+import panos.firewall
+import panos.network
+import panos.objects
+import panos.panorama
+
+
+def synthetic_panorama(num_devices, num_devicegroups=10, vsys_per_device=1):
+    """Build a Panorama whose API returns synthetic managed device xml.
+
+    Every device is placed into one of the device groups, round robin.
+
+    """
+    devices = ET.Element("devices")
+    dg_config = ET.Element("device-group")
+    dg_op = ET.Element("devicegroups")
+    dg_config_devices = []
+    dg_op_devices = []
+    for num in range(num_devicegroups):
+        name = "dg{0}".format(num)
+        dg_config_devices.append(
+            ET.SubElement(ET.SubElement(dg_config, "entry", {"name": name}), "devices")
+        )
+        dg_op_devices.append(
+            ET.SubElement(ET.SubElement(dg_op, "entry", {"name": name}), "devices")
+        )
+
+    for num in range(num_devices):
+        serial = "{0:012d}".format(num)
+        entry = ET.SubElement(devices, "entry", {"name": serial})
+        ET.SubElement(entry, "serial").text = serial
+        ET.SubElement(entry, "connected").text = "yes"
+        ET.SubElement(entry, "unsupported-version").text = "no"
+        ET.SubElement(entry, "hostname").text = "fw{0}".format(num)
+        ET.SubElement(entry, "ip-address").text = "10.{0}.{1}.{2}".format(
+            num // 65536, (num // 256) % 256, num % 256
+        )
+        ET.SubElement(entry, "sw-version").text = "9.1.0"
+        ET.SubElement(entry, "multi-vsys").text = "yes" if vsys_per_device > 1 else "no"
+        vsys = ET.SubElement(entry, "vsys")
+        for vnum in range(1, vsys_per_device + 1):
+            vsys_entry = ET.SubElement(vsys, "entry", {"name": "vsys{0}".format(vnum)})
+            ET.SubElement(vsys_entry, "display-name").text = "vsys{0}".format(vnum)
+
+        dg_entry = ET.SubElement(
+            dg_config_devices[num % num_devicegroups], "entry", {"name": serial}
+        )
+        op_entry = ET.SubElement(
+            dg_op_devices[num % num_devicegroups], "entry", {"name": serial}
+        )
+        ET.SubElement(op_entry, "serial").text = serial
+        ET.SubElement(op_entry, "connected").text = "yes"
+        if vsys_per_device > 1:
+            dg_vsys = ET.SubElement(dg_entry, "vsys")
+            op_vsys = ET.SubElement(op_entry, "vsys")
+            for vnum in range(1, vsys_per_device + 1):
+                name = "vsys{0}".format(vnum)
+                ET.SubElement(dg_vsys, "entry", {"name": name})
+                op_vsys_entry = ET.SubElement(op_vsys, "entry", {"name": name})
+                ET.SubElement(op_vsys_entry, "shared-policy-status").text = "In Sync"
+        else:
+            ET.SubElement(op_entry, "shared-policy-status").text = "Out of Sync"
+
+    def response(elm):
+        resp = ET.Element("response", {"status": "success"})
+        ET.SubElement(resp, "result").append(elm)
+        return resp
+
+    def op(cmd, *args, **kwargs):
+        if cmd.startswith("show devices"):
+            return response(devices)
+        elif cmd == "show devicegroups":
+            return response(dg_op)
+        raise ValueError("Unexpected op: {0}".format(cmd))
+
+    pano = panos.panorama.Panorama("pano", api_key="secret")
+    pano._set_version_and_version_info("9.1.0")
+    pano._xapi_private = mock.Mock()
+    pano._xapi_private.get.side_effect = lambda *args, **kwargs: response(dg_config)
+    pano.op = mock.Mock(side_effect=op)
+
+    return pano
+
+
+class TestRefreshDevices(unittest.TestCase):
+    def test_firewalls_are_placed_in_device_groups(self):
+        pano = synthetic_panorama(30, num_devicegroups=3)
+
+        ret = pano.refresh_devices()
+
+        dgs = [x for x in ret if isinstance(x, panos.panorama.DeviceGroup)]
+        fws = [x for x in ret if isinstance(x, panos.firewall.Firewall)]
+        self.assertEqual(3, len(dgs))
+        self.assertEqual([], fws)
+        for num, dg in enumerate(dgs):
+            serials = [x.serial for x in dg.children]
+            self.assertEqual(["{0:012d}".format(x) for x in range(num, 30, 3)], serials)
+            for fw in dg.children:
+                self.assertEqual("vsys1", fw.vsys)
+                self.assertTrue(fw.state.connected)
+                self.assertFalse(fw.state.shared_policy_synced)
+
+    def test_system_settings_match_serial(self):
+        pano = synthetic_panorama(5, num_devicegroups=1)
+
+        ret = pano.refresh_devices(include_device_groups=False)
+
+        for num, fw in enumerate(ret):
+            system = fw.find("", panos.device.SystemSettings)
+            self.assertEqual("fw{0}".format(num), system.hostname)
+            self.assertEqual("10.0.0.{0}".format(num), system.ip_address)
+
+    def test_multi_vsys_expanded(self):
+        pano = synthetic_panorama(4, num_devicegroups=2, vsys_per_device=3)
+
+        ret = pano.refresh_devices()
+
+        self.assertEqual(2, len(ret))
+        for dg in ret:
+            self.assertEqual(6, len(dg.children))
+            self.assertEqual(
+                ["vsys1", "vsys2", "vsys3"] * 2, [x.vsys for x in dg.children]
+            )
+
+    def test_filter_by_firewall_and_vsys(self):
+        pano = synthetic_panorama(4, num_devicegroups=2, vsys_per_device=3)
+        wanted = panos.firewall.Firewall(serial="{0:012d}".format(1), vsys="vsys2")
+
+        ret = pano.refresh_devices(devices=[wanted])
+
+        fws = [fw for dg in ret for fw in dg.children]
+        self.assertEqual(1, len(fws))
+        self.assertEqual((wanted.serial, "vsys2"), (fws[0].serial, fws[0].vsys))
+
+    def test_add_replaces_tree(self):
+        pano = synthetic_panorama(10, num_devicegroups=2)
+        existing = pano.add(panos.panorama.DeviceGroup("dg0"))
+        existing.add(panos.firewall.Firewall(serial="stale"))
+
+        pano.refresh_devices(add=True)
+
+        dgs = pano.findall(panos.panorama.DeviceGroup)
+        self.assertEqual(["dg0", "dg1"], [x.name for x in dgs])
+        self.assertIs(existing, dgs[0])
+        self.assertNotIn("stale", [x.serial for x in existing.children])
+        self.assertEqual(5, len(existing.children))
+
+    def test_large_fleet_places_each_firewall_once(self):
+        pano = synthetic_panorama(1500, num_devicegroups=7, vsys_per_device=2)
+        placed = []
+        original_add = panos.panorama.DeviceGroup.add
+
+        def add(dg, child):
+            placed.append((dg.name, child.serial, child.vsys))
+            return original_add(dg, child)
+
+        with mock.patch.object(
+            panos.panorama.DeviceGroup, "add", autospec=True, side_effect=add
+        ):
+            pano.refresh_devices(add=True)
+
+        expected = [
+            ("dg{0}".format(dg), "{0:012d}".format(num), "vsys{0}".format(vsys))
+            for dg in range(7)
+            for num in range(dg, 1500, 7)
+            for vsys in (1, 2)
+        ]
+        self.assertEqual(expected, placed)
+        found = [
+            (dg.name, fw.serial, fw.vsys)
+            for dg in pano.findall(panos.panorama.DeviceGroup)
+            for fw in dg.children
+        ]
+        self.assertEqual(expected, found)
+        self.assertEqual([], pano.findall(panos.firewall.Firewall))
+        self.assertEqual(2, pano.op.call_count)
+
+
+COMMIT_ALL_DEVICE = """<entry>
+<serial-no>{serial}</serial-no>
+<devicename>fw-{serial}</devicename>
+<status>{status}</status>
+<progress>{progress}</progress>
+<result>{result}</result>
+<tstart>2020/01/01 00:00:00</tstart>
+<tfin>2020/01/01 00:00:10</tfin>
+<details><msg><errors/><warnings/></msg></details>
+</entry>"""
+
+
+class FakeCommitAllPanorama(object):
+    """Runs commit-all jobs that finish on the second poll.
+
+    ``outcomes`` maps a serial to the list of results of each push to it,
+    defaulting to "OK".
+
+    """
+
+    def __init__(self, serials_by_dg, outcomes=None):
+        self.serials_by_dg = serials_by_dg
+        self.outcomes = outcomes or {}
+        self.pushes = []
+        self.jobs = {}
+        self.pano = panos.panorama.Panorama("pano", api_key="secret")
+        self.pano._set_version_and_version_info("9.1.0")
+        self.pano.commit = mock.Mock(side_effect=self.commit)
+        self.pano._xapi_private = mock.Mock()
+        self.pano._xapi_private.op.side_effect = self.op
+
+    def commit(self, cmd=None, **kwargs):
+        serials = cmd.devices or self.serials_by_dg[cmd.name]
+        jobid = str(len(self.pushes) + 1)
+        self.pushes.append((cmd.name, list(serials)))
+        results = {}
+        for serial in serials:
+            outcomes = self.outcomes.get(serial, [])
+            results[serial] = outcomes.pop(0) if outcomes else "OK"
+        self.jobs[jobid] = [0, results]
+        return jobid
+
+    def op(self, cmd=None, **kwargs):
+        jobid = cmd.split('"')[1]
+        job = self.jobs[jobid]
+        job[0] += 1
+        done = job[0] > 1
+        devices = "".join(
+            COMMIT_ALL_DEVICE.format(
+                serial=serial,
+                status="FIN" if done else "ACT",
+                progress=100 if done else 50,
+                result=result if done else "PEND",
+            )
+            for serial, result in sorted(job[1].items())
+        )
+        return ET.fromstring(
+            "<response><result><job><id>{0}</id><user>admin</user>"
+            "<type>CommitAll</type><status>FIN</status><result>{1}</result>"
+            "<tenq>2020/01/01 00:00:00</tenq><tfin>2020/01/01 00:00:10</tfin>"
+            "<progress>100</progress><warnings/><details/>"
+            "<devices>{2}</devices></job></result></response>".format(
+                jobid, "OK", devices
+            )
+        )
+
+
+@mock.patch("panos.panorama.time.sleep")
+class TestCommitAllScheduler(unittest.TestCase):
+    def test_device_group_waves(self, sleep):
+        waves = panos.panorama.CommitAllScheduler.device_group_waves(
+            ["a", "b", "c"], per_wave=2, description="push"
+        )
+
+        self.assertEqual([["a", "b"], ["c"]], [[x.name for x in w] for w in waves])
+        self.assertEqual("push", waves[1][0].description)
+
+    def test_device_group_waves_batches_serials(self, sleep):
+        waves = panos.panorama.CommitAllScheduler.device_group_waves(
+            {"a": ["1", "2", "3"]}, per_wave=5, batch_size=2
+        )
+
+        self.assertEqual(1, len(waves))
+        self.assertEqual([["1", "2"], ["3"]], [x.devices for x in waves[0]])
+
+    def test_waves_run_in_order(self, sleep):
+        fake = FakeCommitAllPanorama({"a": ["1", "2"], "b": ["3"], "c": ["4"]})
+        plan = panos.panorama.CommitAllScheduler.device_group_waves(
+            ["a", "b", "c"], per_wave=2
+        )
+        events = []
+
+        result = panos.panorama.CommitAllScheduler(
+            fake.pano, plan, concurrency=2, callback=events.append
+        ).run()
+
+        self.assertTrue(result["success"])
+        self.assertEqual(["1", "2", "3", "4"], sorted(result["devices"]))
+        self.assertEqual(3, len(result["jobs"]))
+        submitted = [x["commit"].name for x in events if x["event"] == "submitted"]
+        finished = [x["commit"].name for x in events if x["event"] == "finished"]
+        self.assertEqual(["a", "b", "c"], submitted)
+        # The second wave doesn't start until the first is finished
+        order = [(x["event"], x["commit"].name) for x in events]
+        self.assertLess(order.index(("finished", "a")), order.index(("submitted", "c")))
+        self.assertLess(order.index(("finished", "b")), order.index(("submitted", "c")))
+        self.assertEqual(["a", "b", "c"], sorted(finished))
+
+    def test_device_progress_streamed_once_per_change(self, sleep):
+        fake = FakeCommitAllPanorama({"a": ["1", "2"]})
+        events = []
+
+        panos.panorama.CommitAllScheduler(
+            fake.pano,
+            [[panos.panorama.PanoramaCommitAll("device group", "a")]],
+            callback=events.append,
+        ).run()
+
+        device_events = [
+            (x["serial"], x["status"], x["result"])
+            for x in events
+            if x["event"] == "device"
+        ]
+        self.assertEqual(
+            [
+                ("1", "ACT", "PEND"),
+                ("2", "ACT", "PEND"),
+                ("1", "FIN", "OK"),
+                ("2", "FIN", "OK"),
+            ],
+            device_events,
+        )
+
+    def test_concurrency_limit(self, sleep):
+        fake = FakeCommitAllPanorama({x: [x] for x in "abcd"})
+        plan = panos.panorama.CommitAllScheduler.device_group_waves("abcd", per_wave=4)
+        in_flight = []
+
+        def track(event):
+            if event["event"] == "submitted":
+                in_flight.append(event["jobid"])
+                self.assertLessEqual(len(in_flight), 2)
+            elif event["event"] == "finished":
+                in_flight.remove(event["jobid"])
+
+        panos.panorama.CommitAllScheduler(
+            fake.pano, plan, concurrency=2, callback=track
+        ).run()
+
+        self.assertEqual(4, len(fake.pushes))
+
+    def test_failed_devices_are_retried_alone(self, sleep):
+        fake = FakeCommitAllPanorama(
+            {"a": ["1", "2", "3"]}, outcomes={"2": ["FAIL", "OK"]}
+        )
+        plan = [[panos.panorama.PanoramaCommitAll("device group", "a")]]
+
+        result = panos.panorama.CommitAllScheduler(fake.pano, plan, retries=1).run()
+
+        self.assertTrue(result["success"])
+        self.assertEqual([("a", ["1", "2", "3"]), ("a", ["2"])], fake.pushes)
+        self.assertEqual(2, result["devices"]["2"]["attempts"])
+        self.assertEqual(1, result["devices"]["1"]["attempts"])
+
+    def test_failure_budget_skips_remaining_waves(self, sleep):
+        fake = FakeCommitAllPanorama(
+            {"a": ["1", "2"], "b": ["3"]}, outcomes={"1": ["FAIL"], "2": ["FAIL"]}
+        )
+        plan = panos.panorama.CommitAllScheduler.device_group_waves(["a", "b"])
+        events = []
+
+        result = panos.panorama.CommitAllScheduler(
+            fake.pano, plan, failure_budget=1, callback=events.append
+        ).run()
+
+        self.assertFalse(result["success"])
+        self.assertTrue(result["aborted"])
+        self.assertEqual(["1", "2"], result["failed"])
+        self.assertEqual(["b"], [x.name for x in result["skipped"]])
+        self.assertEqual([("a", ["1", "2"])], fake.pushes)
+        self.assertIn("skipped", [x["event"] for x in events])
+
+    def test_nothing_to_commit(self, sleep):
+        fake = FakeCommitAllPanorama({"a": ["1"]})
+        fake.pano.commit.side_effect = None
+        fake.pano.commit.return_value = None
+
+        result = panos.panorama.CommitAllScheduler(
+            fake.pano, [[panos.panorama.PanoramaCommitAll("device group", "a")]]
+        ).run()
+
+        self.assertTrue(result["success"])
+        self.assertEqual({}, result["devices"])
+
+
+DG_HIERARCHY = """<response status="success"><result><dg-hierarchy>
+<dg name="global" dg_id="11">
+  <dg name="east" dg_id="12"><dg name="branch1" dg_id="14"/></dg>
+  <dg name="west" dg_id="13"/>
+</dg>
+<dg name="lab" dg_id="15"/>
+</dg-hierarchy></result></response>"""
+
+DG_OBJECTS = """<response status="success"><result>
+<shared><address>
+  <entry name="web01"><ip-netmask>10.0.0.1</ip-netmask></entry>
+  <entry name="dns"><ip-netmask>10.0.0.53</ip-netmask></entry>
+</address></shared>
+<device-group>
+  <entry name="global"><address>
+    <entry name="web01"><ip-netmask>10.1.0.1</ip-netmask></entry>
+  </address></entry>
+  <entry name="east"><address>
+    <entry name="ntp"><ip-netmask>10.2.0.123</ip-netmask></entry>
+  </address></entry>
+  <entry name="branch1"><address>
+    <entry name="web01"><fqdn>web01.branch1.example.com</fqdn></entry>
+  </address></entry>
+  <entry name="west"/>
+  <entry name="lab"/>
+</device-group>
+</result></response>"""
+
+
+class TestDeviceGroupHierarchy(unittest.TestCase):
+    def setUp(self):
+        self.pano = panos.panorama.Panorama("pano", api_key="secret")
+        self.pano._set_version_and_version_info("9.1.0")
+        self.pano.op = mock.Mock(return_value=ET.fromstring(DG_HIERARCHY))
+        self.pano._xapi_private = mock.Mock()
+        self.pano._xapi_private.get.return_value = ET.fromstring(DG_OBJECTS)
+        self.hierarchy = panos.panorama.DeviceGroupHierarchy(self.pano)
+        self.hierarchy.refresh()
+        self.hierarchy.refresh_objects()
+
+    def test_hierarchy(self):
+        h = self.hierarchy
+
+        self.assertEqual("east", h.parent("branch1"))
+        self.assertIsNone(h.parent("global"))
+        self.assertEqual(["east", "global"], h.ancestors("branch1"))
+        self.assertEqual(["global", "lab"], h.children())
+        self.assertEqual(["east", "west", "branch1"], h.descendants("global"))
+
+    def test_objects_loaded_in_one_request(self):
+        self.assertEqual(1, self.pano._xapi_private.get.call_count)
+        xpath = self.pano._xapi_private.get.call_args[0][0]
+        self.assertEqual(
+            "/config/shared | "
+            "/config/devices/entry[@name='localhost.localdomain']/device-group",
+            xpath,
+        )
+
+    def test_closest_object_wins(self):
+        h = self.hierarchy
+        cls = panos.objects.AddressObject
+
+        self.assertEqual("10.0.0.1", h.resolve(None, cls, "web01").value)
+        self.assertEqual("10.1.0.1", h.resolve("west", cls, "web01").value)
+        self.assertEqual("10.1.0.1", h.resolve("east", cls, "web01").value)
+        branch = h.resolve("branch1", cls, "web01")
+        self.assertEqual("web01.branch1.example.com", branch.value)
+        self.assertEqual("fqdn", branch.type)
+        self.assertEqual("10.0.0.1", h.resolve("lab", cls, "web01").value)
+        self.assertEqual("branch1", h.location_of("branch1", cls, "web01"))
+        self.assertEqual("shared", h.location_of("branch1", cls, "dns"))
+
+    def test_objects_of_siblings_are_not_visible(self):
+        h = self.hierarchy
+        cls = panos.objects.AddressObject
+
+        self.assertIsNotNone(h.resolve("branch1", cls, "ntp"))
+        self.assertIsNone(h.resolve("west", cls, "ntp"))
+        self.assertEqual(
+            ["dns", "ntp", "web01"], sorted(h.effective_objects("east", cls))
+        )
+
+    def test_resolve_for_firewall(self):
+        dg = self.pano.add(panos.panorama.DeviceGroup("branch1"))
+        fw = dg.add(panos.firewall.Firewall(serial="0001"))
+
+        obj = self.hierarchy.resolve(fw, panos.objects.AddressObject, "web01")
+
+        self.assertEqual("web01.branch1.example.com", obj.value)
+        self.assertRaises(
+            ValueError,
+            self.hierarchy.resolve,
+            panos.firewall.Firewall(serial="0002"),
+            panos.objects.AddressObject,
+            "web01",
+        )
+
+    def test_set_objects_invalidates_descendants(self):
+        h = self.hierarchy
+        cls = panos.objects.AddressObject
+        self.assertIsNone(h.resolve("branch1", cls, "syslog"))
+
+        h.set_objects("east", cls, [panos.objects.AddressObject("syslog", "10.2.0.1")])
+
+        self.assertEqual("10.2.0.1", h.resolve("branch1", cls, "syslog").value)
+        self.assertIsNone(h.resolve("east", cls, "ntp"))
+        self.assertIsNone(h.resolve("west", cls, "syslog"))
+
+    def test_unknown_device_group(self):
+        self.assertRaises(
+            err.PanDeviceError,
+            self.hierarchy.resolve,
+            "nope",
+            panos.objects.AddressObject,
+            "web01",
+        )
+
+    def test_hierarchy_loop(self):
+        self.hierarchy.parents["global"] = "branch1"
+        self.hierarchy.invalidate()
+
+        self.assertRaises(
+            err.PanDeviceError,
+            self.hierarchy.resolve,
+            "east",
+            panos.objects.AddressObject,
+            "web01",
+        )
+
+
+TEMPLATES = """<response status="success"><result>
+<template>
+  <entry name="base">
+    <variable>
+      <entry name="$mgmt"><type><ip-netmask>10.0.0.1/24</ip-netmask></type></entry>
+      <entry name="$dns"><type><ip-netmask>8.8.8.8</ip-netmask></type></entry>
+    </variable>
+    <config><devices><entry name="localhost.localdomain">
+      <network><interface><ethernet>
+        <entry name="ethernet1/1"><layer3>
+          <ip><entry name="$mgmt"/></ip>
+          <mtu>1400</mtu>
+        </layer3><comment>base</comment></entry>
+        <entry name="ethernet1/2"><layer3><mtu>1500</mtu></layer3></entry>
+      </ethernet></interface></network>
+      <deviceconfig><system>
+        <dns-setting><servers><primary>$dns</primary></servers></dns-setting>
+      </system></deviceconfig>
+    </entry></devices></config>
+  </entry>
+  <entry name="site">
+    <variable>
+      <entry name="$dns"><type><ip-netmask>10.9.9.9</ip-netmask></type></entry>
+    </variable>
+    <config><devices><entry name="localhost.localdomain">
+      <network><interface><ethernet>
+        <entry name="ethernet1/1"><layer3><mtu>9000</mtu></layer3></entry>
+      </ethernet></interface></network>
+    </entry></devices></config>
+  </entry>
+</template>
+<template-stack>
+  <entry name="stack">
+    <templates><member>site</member><member>base</member></templates>
+    <variable>
+      <entry name="$mgmt"><type><ip-netmask>10.1.1.1/24</ip-netmask></type></entry>
+    </variable>
+    <devices>
+      <entry name="0001"><variable>
+        <entry name="$mgmt"><type><ip-netmask>10.2.2.2/24</ip-netmask></type></entry>
+      </variable></entry>
+      <entry name="0002"/>
+    </devices>
+  </entry>
+  <entry name="broken">
+    <templates><member>nope</member></templates>
+  </entry>
+</template-stack>
+</result></response>"""
+
+
+class TestTemplateMerger(unittest.TestCase):
+    def setUp(self):
+        self.pano = panos.panorama.Panorama("pano", api_key="secret")
+        self.pano._set_version_and_version_info("9.1.0")
+        self.pano._xapi_private = mock.Mock()
+        self.pano._xapi_private.get.return_value = ET.fromstring(TEMPLATES)
+        self.merger = panos.panorama.TemplateMerger(self.pano)
+        self.merger.refresh()
+
+    def eth(self, merged, name):
+        return merged.find(
+            "devices/entry/network/interface/ethernet/entry[@name='{0}']".format(name)
+        )
+
+    def test_loaded_in_one_request(self):
+        self.assertEqual(1, self.pano._xapi_private.get.call_count)
+        self.assertEqual(["base", "site"], sorted(self.merger.templates))
+        self.assertEqual(["broken", "stack"], sorted(self.merger.stacks))
+
+    def test_higher_priority_template_wins(self):
+        merged = self.merger.merged_xml("stack")
+
+        eth1 = self.eth(merged, "ethernet1/1")
+        self.assertEqual("9000", eth1.findtext("layer3/mtu"))
+        self.assertEqual("base", eth1.findtext("comment"))
+        self.assertEqual("1500", self.eth(merged, "ethernet1/2").findtext("layer3/mtu"))
+
+    def test_variables(self):
+        self.assertEqual(
+            {"$mgmt": "10.1.1.1/24", "$dns": "10.9.9.9"},
+            self.merger.variables("stack"),
+        )
+        self.assertEqual("10.2.2.2/24", self.merger.variables("stack", "0001")["$mgmt"])
+        self.assertEqual("10.1.1.1/24", self.merger.variables("stack", "0002")["$mgmt"])
+
+    def test_variables_are_substituted(self):
+        merged = self.merger.merged_xml("stack", serial="0001")
+
+        self.assertEqual(
+            "10.9.9.9",
+            merged.findtext(
+                "devices/entry/deviceconfig/system/dns-setting/servers/primary"
+            ),
+        )
+
+    def test_single_template(self):
+        merged = self.merger.merged_xml("base")
+
+        self.assertEqual("1400", self.eth(merged, "ethernet1/1").findtext("layer3/mtu"))
+        self.assertEqual(
+            "8.8.8.8",
+            merged.findtext(
+                "devices/entry/deviceconfig/system/dns-setting/servers/primary"
+            ),
+        )
+
+    def test_firewall_tree(self):
+        fw = self.merger.firewall("stack", serial="0001")
+
+        self.assertEqual("0001", fw.serial)
+        eth1 = fw.find("ethernet1/1", panos.network.EthernetInterface)
+        self.assertEqual(9000, eth1.mtu)
+        self.assertEqual(["10.2.2.2/24"], eth1.ip)
+        self.assertEqual("base", eth1.comment)
+        system = fw.find("", panos.device.SystemSettings)
+        self.assertEqual("10.9.9.9", system.dns_primary)
+
+    def test_merges_are_cached_by_content(self):
+        first = self.merger.merged_xml("stack")
+        self.assertIs(first, self.merger.merged_xml("stack"))
+        self.assertIsNot(first, self.merger.merged_xml("stack", serial="0001"))
+
+        # Same content after a refresh is still cached
+        self.merger.refresh()
+        self.assertIs(first, self.merger.merged_xml("stack"))
+
+        # Changed content is merged again
+        changed = TEMPLATES.replace("<mtu>9000</mtu>", "<mtu>8000</mtu>")
+        self.pano._xapi_private.get.return_value = ET.fromstring(changed)
+        self.merger.refresh()
+        merged = self.merger.merged_xml("stack")
+        self.assertEqual("8000", self.eth(merged, "ethernet1/1").findtext("layer3/mtu"))
+
+    def test_missing_variables(self):
+        self.merger.templates["base"]["variables"].pop("$dns")
+        self.merger.templates["site"]["variables"].pop("$dns")
+
+        with self.assertRaises(err.PanDeviceError) as cm:
+            self.merger.merged_xml("stack", strict=True)
+        self.assertEqual("stack has no value for variables: $dns", str(cm.exception))
+        merged = self.merger.merged_xml("stack")
+        self.assertEqual(
+            "$dns",
+            merged.findtext(
+                "devices/entry/deviceconfig/system/dns-setting/servers/primary"
+            ),
+        )
+
+    def test_unknown_template(self):
+        self.assertRaises(err.PanDeviceError, self.merger.merged_xml, "broken")
+        self.assertRaises(err.PanDeviceError, self.merger.merged_xml, "nope")
+
+
+if __name__ == "__main__":
+    unittest.main()
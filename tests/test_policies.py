@@ -0,0 +1,250 @@
+# Copyright (c) 2014, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+import random
+import unittest
+import xml.etree.ElementTree as ET
+
+import panos.errors as err
+import panos.firewall
+
+from panos import panorama, policies
+
+
+def rulebase_with(names, nat_names=()):
+    fw = panos.firewall.Firewall("fw1", "user", "passwd", "authkey", serial="Serial")
+    fw._set_version_and_version_info("9.1.0")
+    fw._xapi_private = mock.Mock()
+    rulebase = fw.add(policies.Rulebase())
+    for name in nat_names:
+        rulebase.add(policies.NatRule(name))
+    for name in names:
+        rulebase.add(policies.SecurityRule(name))
+    return fw, rulebase
+
+
+def security_names(rulebase):
+    return [x.uid for x in rulebase.findall(policies.SecurityRule)]
+
+
+def replay(current, calls):
+    """Apply xapi.move calls to a list of names"""
+    current = list(current)
+    for call in calls:
+        name = call[0][0].rsplit("'", 2)[-2]
+        location, dst = call[0][1], call[0][2]
+        current.remove(name)
+        if location == "top":
+            current.insert(0, name)
+        else:
+            current.insert(current.index(dst) + 1, name)
+    return current
+
+
+class TestRulebaseReorder(unittest.TestCase):
+    def test_minimal_moves(self):
+        fw, rulebase = rulebase_with(["a", "b", "c", "d", "e"], nat_names=["n1"])
+        desired = ["e", "a", "b", "d", "c"]
+
+        ans = rulebase.reorder(desired)
+
+        self.assertEqual(2, ans["calls"])
+        self.assertEqual(3, ans["saved"])
+        # a, b and one of c and d stay in place
+        self.assertEqual("e", ans["moved"][0])
+        self.assertEqual(desired, security_names(rulebase))
+        calls = fw._xapi_private.move.call_args_list
+        self.assertEqual(2, len(calls))
+        self.assertEqual(desired, replay("abcde", calls))
+
+    def test_random_orders(self):
+        rand = random.Random(3)
+        names = ["rule{0}".format(x) for x in range(40)]
+        for _ in range(20):
+            fw, rulebase = rulebase_with(names)
+            desired = list(names)
+            for _ in range(rand.randint(0, 6)):
+                i, j = rand.randrange(40), rand.randrange(40)
+                desired.insert(j, desired.pop(i))
+
+            ans = rulebase.reorder(desired)
+
+            self.assertEqual(desired, security_names(rulebase))
+            calls = fw._xapi_private.move.call_args_list
+            self.assertEqual(desired, replay(names, calls))
+            self.assertEqual(ans["calls"], len(calls))
+            self.assertLessEqual(ans["calls"], 12)
+
+    def test_multi_config(self):
+        fw, rulebase = rulebase_with(["a", "b", "c"])
+        desired = [rulebase.find("c"), rulebase.find("a"), rulebase.find("b")]
+
+        ans = rulebase.reorder(desired, multi_config=True)
+
+        self.assertEqual({"moved": ["c"], "calls": 1, "saved": 2}, ans)
+        self.assertFalse(fw._xapi_private.move.called)
+        kwargs = fw._xapi_private.multi_config.call_args[1]
+        self.assertTrue(kwargs["strict"])
+        move = ET.fromstring(kwargs["element"]).find("./move")
+        self.assertEqual("top", move.get("where"))
+        self.assertIsNone(move.get("dst"))
+        self.assertTrue(move.get("xpath").endswith("/entry[@name='c']"))
+        self.assertEqual(["c", "a", "b"], security_names(rulebase))
+
+    def test_already_ordered(self):
+        fw, rulebase = rulebase_with(["a", "b"])
+
+        ans = rulebase.reorder(["a", "b"], multi_config=True)
+
+        self.assertEqual({"moved": [], "calls": 0, "saved": 2}, ans)
+        self.assertFalse(fw._xapi_private.multi_config.called)
+
+    def test_other_rule_type(self):
+        fw, rulebase = rulebase_with(["a"], nat_names=["n1", "n2"])
+
+        rulebase.reorder(["n2", "n1"], rule_type=policies.NatRule, update=False)
+
+        self.assertEqual(["n2", "n1", "a"], [x.uid for x in rulebase.children])
+        self.assertFalse(fw._xapi_private.move.called)
+
+    def test_must_list_every_rule(self):
+        fw, rulebase = rulebase_with(["a", "b", "c"])
+
+        for desired in (["a", "b"], ["a", "b", "c", "c"], ["a", "b", "x"]):
+            self.assertRaises(ValueError, rulebase.reorder, desired)
+
+
+HIT_COUNT_ENTRY = """<entry name="{0}">
+<latest>yes</latest>
+<hit-count>{1}</hit-count>
+<last-hit-timestamp>{3}</last-hit-timestamp>
+<last-reset-timestamp>0</last-reset-timestamp>
+<first-hit-timestamp>{2}</first-hit-timestamp>
+</entry>"""
+
+
+def hit_count_response(vsys, rule_base, counts):
+    """A show rule-hit-count response for (name, hits, first, last) tuples"""
+    return ET.fromstring(
+        "<response status='success'><result><rule-hit-count><vsys>"
+        "<entry name='{0}'><rule-base><entry name='{1}'><rules>{2}</rules>"
+        "</entry></rule-base></entry></vsys></rule-hit-count></result>"
+        "</response>".format(
+            vsys, rule_base, "".join(HIT_COUNT_ENTRY.format(*x) for x in counts)
+        )
+    )
+
+
+class FakeHitCounts(object):
+    """Answers show rule-hit-count from a dict of rule base to counts"""
+
+    def __init__(self, counts):
+        self.counts = counts
+        self.cmds = []
+
+    def op(self, cmd, cmd_xml=True, **kwargs):
+        cmd = ET.fromstring(cmd)
+        self.cmds.append(cmd)
+        vsys = cmd.find("./rule-hit-count/vsys/vsys-name/entry").get("name")
+        rule_base = cmd.find(".//rule-base/entry")
+        names = [x.text for x in rule_base.findall("./rules/list/member")]
+        counts = [
+            x
+            for x in self.counts.get(rule_base.get("name"), [])
+            if not names or x[0] in names
+        ]
+        return hit_count_response(vsys, rule_base.get("name"), counts)
+
+
+class TestRefreshHitCounts(unittest.TestCase):
+    def test_firewall(self):
+        fw, rulebase = rulebase_with(["a", "b"], nat_names=["n1"])
+        fake = FakeHitCounts(
+            {
+                "security": [("a", 10, 1500000000, 1600000000), ("b", 0, 0, 0)],
+                "nat": [("n1", 3, 1500000000, 1500000100)],
+            }
+        )
+        fw.op = fake.op
+
+        ans = rulebase.refresh_hit_counts()
+
+        self.assertEqual(["nat", "security"], sorted(ans))
+        self.assertEqual(2, len(fake.cmds))
+        rule = rulebase.find("a", policies.SecurityRule)
+        self.assertEqual(10, rule.hit_count)
+        self.assertEqual(1500000000, rule.first_hit)
+        self.assertEqual(1600000000, rule.last_hit)
+        rule = rulebase.find("b", policies.SecurityRule)
+        self.assertEqual(
+            (0, None, None), (rule.hit_count, rule.first_hit, rule.last_hit)
+        )
+        self.assertEqual(3, rulebase.find("n1", policies.NatRule).hit_count)
+        self.assertEqual("vsys1", fake.cmds[0].find(".//vsys-name/entry").get("name"))
+
+    def test_pages(self):
+        fw, rulebase = rulebase_with(["a", "b", "c"])
+        fake = FakeHitCounts(
+            {"security": [(x, 1, 1500000000, 1500000000) for x in "abc"]}
+        )
+        fw.op = fake.op
+
+        rulebase.refresh_hit_counts(policies.SecurityRule, page_size=2)
+
+        self.assertEqual(
+            [["a", "b"], ["c"]],
+            [[y.text for y in x.findall(".//member")] for x in fake.cmds],
+        )
+        self.assertEqual([1, 1, 1], [x.hit_count for x in rulebase.children])
+
+    def test_device_group_aggregates_firewalls(self):
+        pano = panorama.Panorama("pano", "user", "passwd", "authkey")
+        dg = pano.add(panorama.DeviceGroup("dg"))
+        rulebase = dg.add(policies.PreRulebase())
+        rulebase.add(policies.SecurityRule("a"))
+        rulebase.add(policies.SecurityRule("b"))
+        fakes = [
+            FakeHitCounts({"security": [("a", 5, 1500000000, 1500000500)]}),
+            FakeHitCounts(
+                {"security": [("a", 7, 1400000000, 1500000100), ("b", 1, 5, 6)]}
+            ),
+        ]
+        for num, fake in enumerate(fakes):
+            fw = dg.add(panos.firewall.Firewall(serial="serial{0}".format(num)))
+            fw.op = fake.op
+        dg.children[-1].vsys = "vsys2"
+
+        rulebase.refresh_hit_counts()
+
+        rule = rulebase.find("a")
+        self.assertEqual(12, rule.hit_count)
+        self.assertEqual(1400000000, rule.first_hit)
+        self.assertEqual(1500000500, rule.last_hit)
+        self.assertEqual(1, rulebase.find("b").hit_count)
+        self.assertEqual(
+            "vsys2", fakes[1].cmds[0].find(".//vsys-name/entry").get("name")
+        )
+
+    def test_device_group_without_firewalls(self):
+        pano = panorama.Panorama("pano", "user", "passwd", "authkey")
+        rulebase = pano.add(panorama.DeviceGroup("dg")).add(policies.PostRulebase())
+
+        self.assertRaises(err.PanDeviceError, rulebase.refresh_hit_counts)
+
+
+if __name__ == "__main__":
+    unittest.main()
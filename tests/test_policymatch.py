@@ -0,0 +1,1290 @@
+# Copyright (c) 2014, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+import random
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+import panos.errors as err
+import panos.firewall
+from panos import objects, policies, policymatch
+from panos.policymatch import IntervalSet, SecurityPolicyEngine
+
+
+class TestAddressParsing(unittest.TestCase):
+    def test_ipv4(self):
+        self.assertEqual(
+            [(0x0A010000, 0x0A01FFFF)], policymatch.parse_address("10.1.2.3/16")
+        )
+        self.assertEqual(
+            [(0x0A010101, 0x0A010109)],
+            policymatch.parse_address("10.1.1.1-10.1.1.9", "ip-range"),
+        )
+        self.assertEqual("10.1.2.3", policymatch.format_address(0x0A010203))
+
+    def test_ipv6(self):
+        first, last = policymatch.parse_address("2001:db8::/32")[0]
+        self.assertEqual("2001:db8::", policymatch.format_address(first))
+        self.assertEqual(
+            "2001:db8:ffff:ffff:ffff:ffff:ffff:ffff", policymatch.format_address(last)
+        )
+        self.assertEqual(
+            policymatch.address_key("::ffff:10.1.1.1"),
+            policymatch.address_key("::ffff:a01:101"),
+        )
+        self.assertGreater(policymatch.address_key("::"), 0xFFFFFFFF)
+
+    def test_wildcard(self):
+        self.assertEqual(
+            [(0x0A000100, 0x0A0001FF), (0x0A000300, 0x0A0003FF)],
+            policymatch.parse_address("10.0.1.0/0.0.2.255", "ip-wildcard"),
+        )
+
+    def test_invalid(self):
+        for value in ("10.1.1", "10.1.1.256", "1::2::3", "10.1.1.1/33", "host"):
+            self.assertRaises(ValueError, policymatch.parse_address, value)
+
+    def test_interval_set(self):
+        ans = IntervalSet([(10, 20), (5, 9), (30, 40), (35, 50)])
+
+        self.assertEqual([(5, 20), (30, 50)], list(ans))
+        self.assertIn(7, ans)
+        self.assertNotIn(25, ans)
+        self.assertTrue(ans.covers(31, 50))
+        self.assertFalse(ans.covers(15, 31))
+        self.assertTrue(ans.overlaps(21, 30))
+        self.assertFalse(ans.overlaps(21, 29))
+
+
+def policy_firewall():
+    fw = panos.firewall.Firewall("fw1", "user", "passwd", "authkey", serial="Serial")
+    for obj in (
+        objects.AddressObject("web1", "10.1.1.10"),
+        objects.AddressObject("web2", "10.1.1.11"),
+        objects.AddressObject("dmz", "10.1.1.0/24"),
+        objects.AddressObject("v6", "2001:db8::/32"),
+        objects.AddressObject("www", "www.example.com", type="fqdn"),
+        objects.AddressGroup("webservers", static_value=["web1", "web2"]),
+        objects.AddressGroup("nested", static_value=["webservers", "v6"]),
+        objects.ServiceObject("tcp-8080", protocol="tcp", destination_port="8080"),
+        objects.ServiceObject("dns", protocol="udp", destination_port="53"),
+        objects.ServiceGroup("web-ports", value=["tcp-8080", "service-http"]),
+        objects.ApplicationGroup("browsing", value=["web-browsing", "ssl"]),
+    ):
+        fw.add(obj)
+    # A predefined service, as if refreshed
+    fw.predefined.service_objects["service-http"] = objects.ServiceObject(
+        "service-http", protocol="tcp", destination_port="80,8080"
+    )
+    fw.predefined.application_objects["dns"] = objects.ApplicationObject(
+        "dns", default_type="port", default_port=["udp/53", "tcp/53"]
+    )
+    rulebase = fw.add(policies.Rulebase())
+    for rule in (
+        policies.SecurityRule(
+            "disabled",
+            fromzone=["trust"],
+            tozone=["dmz"],
+            action="deny",
+            disabled=True,
+        ),
+        policies.SecurityRule(
+            "web",
+            fromzone=["trust"],
+            tozone=["dmz"],
+            destination=["nested"],
+            application=["browsing"],
+            service=["web-ports"],
+            action="allow",
+        ),
+        policies.SecurityRule(
+            "not-dmz",
+            fromzone=["trust"],
+            tozone=["untrust"],
+            destination=["dmz"],
+            negate_destination=True,
+            source_user=["known-user"],
+            service=["any"],
+            action="allow",
+        ),
+        policies.SecurityRule(
+            "dns",
+            fromzone=["trust"],
+            tozone=["untrust"],
+            application=["dns"],
+            service="application-default",
+            action="allow",
+        ),
+        policies.SecurityRule(
+            "intra", type="intrazone", fromzone=["trust"], action="allow"
+        ),
+        policies.SecurityRule("log-all", service=["any"], action="deny"),
+        policies.SecurityRule("fqdn", destination=["www"], action="allow"),
+    ):
+        rulebase.add(rule)
+    return fw, rulebase
+
+
+class TestSecurityPolicyEngine(unittest.TestCase):
+    def setUp(self):
+        self.fw, self.rulebase = policy_firewall()
+        self.engine = SecurityPolicyEngine.from_rulebases(self.rulebase)
+
+    def names(self, *args, **kwargs):
+        return [x["name"] for x in self.engine.match(*args, **kwargs)]
+
+    def test_nested_group_and_service_group(self):
+        ans = self.engine.match(
+            "192.168.1.1",
+            "10.1.1.11",
+            6,
+            application="ssl",
+            port=80,
+            from_zone="trust",
+            to_zone="dmz",
+        )
+
+        self.assertEqual([{"name": "web", "index": 2, "action": "allow"}], ans)
+        # IPv6 from the nested group
+        self.assertEqual(
+            ["web"],
+            self.names(
+                "192.168.1.1",
+                "2001:db8::1",
+                6,
+                port=8080,
+                from_zone="trust",
+                to_zone="dmz",
+            ),
+        )
+
+    def test_service_and_application_mismatch(self):
+        self.assertEqual(
+            ["log-all"],
+            self.names(
+                "192.168.1.1",
+                "10.1.1.10",
+                6,
+                port=443,
+                from_zone="trust",
+                to_zone="dmz",
+            ),
+        )
+        self.assertEqual(
+            ["log-all"],
+            self.names(
+                "192.168.1.1",
+                "10.1.1.10",
+                6,
+                application="ssh",
+                port=80,
+                from_zone="trust",
+                to_zone="dmz",
+            ),
+        )
+
+    def test_negated_destination_and_user(self):
+        self.assertEqual(
+            ["not-dmz"],
+            self.names(
+                "192.168.1.1",
+                "8.8.8.8",
+                17,
+                port=53,
+                user="corp\\bob",
+                from_zone="trust",
+                to_zone="untrust",
+            ),
+        )
+        self.assertEqual(
+            ["dns"],
+            self.names(
+                "192.168.1.1",
+                "8.8.8.8",
+                17,
+                port=53,
+                application="dns",
+                user="unknown",
+                from_zone="trust",
+                to_zone="untrust",
+            ),
+        )
+        self.assertNotIn(
+            "not-dmz",
+            self.names(
+                "192.168.1.1",
+                "10.1.1.5",
+                17,
+                port=53,
+                from_zone="trust",
+                to_zone="untrust",
+                show_all=True,
+            ),
+        )
+
+    def test_application_default(self):
+        flow = {
+            "source": "192.168.1.1",
+            "destination": "8.8.8.8",
+            "protocol": 17,
+            "application": "dns",
+            "user": "unknown",
+            "from_zone": "trust",
+            "to_zone": "untrust",
+        }
+
+        self.assertEqual(["dns"], self.names(port=53, **flow))
+        self.assertEqual(["log-all"], self.names(port=5353, **flow))
+
+    def test_intrazone(self):
+        self.assertEqual(
+            ["intra"],
+            self.names(
+                "192.168.1.1",
+                "192.168.1.2",
+                6,
+                port=22,
+                from_zone="trust",
+                to_zone="trust",
+            ),
+        )
+        self.assertEqual(
+            ["log-all"],
+            self.names(
+                "192.168.1.1",
+                "192.168.1.2",
+                6,
+                port=22,
+                from_zone="guest",
+                to_zone="trust",
+            ),
+        )
+
+    def test_show_all_until_first_allow(self):
+        self.rulebase.find("not-dmz").action = "deny"
+        engine = SecurityPolicyEngine.from_rulebases(self.rulebase)
+
+        ans = engine.match(
+            "192.168.1.1",
+            "8.8.8.8",
+            17,
+            application="dns",
+            port=53,
+            user="corp\\bob",
+            from_zone="trust",
+            to_zone="untrust",
+            show_all=True,
+        )
+
+        self.assertEqual(["not-dmz", "dns"], [x["name"] for x in ans])
+
+    def test_fqdn(self):
+        resolver = policymatch.ObjectResolver(
+            [self.fw], fqdn={"www.example.com": ["93.184.216.34"]}
+        )
+        engine = SecurityPolicyEngine(
+            [x for x in self.engine.rules if x.name == "fqdn"], resolver
+        )
+
+        self.assertEqual(1, len(engine.match("10.0.0.1", "93.184.216.34", 6)))
+        self.assertEqual(0, len(engine.match("10.0.0.1", "93.184.216.35", 6)))
+        self.assertEqual(set(), resolver.unresolved)
+
+    def test_unresolved_never_matches(self):
+        rule = policies.SecurityRule("r", destination=["US"], action="allow")
+        engine = SecurityPolicyEngine([rule])
+
+        self.assertEqual([], engine.match("10.0.0.1", "8.8.8.8", 6))
+        self.assertEqual(set(["US"]), engine.resolver.unresolved)
+
+    def test_application_filter_without_predefined(self):
+        self.fw.add(objects.ApplicationFilter("risky", risk=["5"]))
+        self.fw.add(objects.ApplicationGroup("apps", value=["risky", "ssh"]))
+        resolver = policymatch.ObjectResolver([self.fw])
+
+        self.assertEqual(frozenset(), resolver.application("risky"))
+        self.assertEqual(frozenset(["ssh"]), resolver.application("apps"))
+        self.assertEqual(set(["risky"]), resolver.unresolved)
+
+    def test_service_with_source_port_never_matches(self):
+        self.fw.add(
+            objects.ServiceObject(
+                "from-53", protocol="udp", source_port="53", destination_port="1-65535"
+            )
+        )
+        self.fw.add(objects.ServiceObject("dns", protocol="udp", destination_port="53"))
+        self.fw.add(objects.ServiceGroup("both", value=["from-53", "dns"]))
+        resolver = policymatch.ObjectResolver([self.fw])
+
+        self.assertFalse(resolver.service("from-53").matches(17, 1000))
+        self.assertTrue(resolver.service("both").matches(17, 53))
+        self.assertFalse(resolver.service("both").matches(17, 1000))
+        self.assertEqual(set(["from-53"]), resolver.unresolved)
+
+    def test_standalone_rulebase(self):
+        rulebase = policies.Rulebase()
+        rulebase.add(policies.SecurityRule("r", destination=["10.0.0.0/8"]))
+        rulebase.add(policies.SecurityRule("deny", action="deny"))
+
+        engine = SecurityPolicyEngine.from_rulebases(rulebase)
+
+        self.assertEqual("r", engine.match("1.1.1.1", "10.1.1.1", 6)[0]["name"])
+        self.assertEqual("deny", engine.match("1.1.1.1", "8.8.8.8", 6)[0]["name"])
+
+    def test_group_loop(self):
+        self.fw.add(objects.AddressGroup("loop1", static_value=["loop2"]))
+        self.fw.add(objects.AddressGroup("loop2", static_value=["loop1"]))
+        resolver = policymatch.ObjectResolver([self.fw])
+
+        self.assertRaises(err.PanDeviceError, resolver.address, "loop1")
+
+    def test_match_many(self):
+        flows = [
+            {
+                "source": "192.168.1.1",
+                "destination": "10.1.1.10",
+                "protocol": 6,
+                "port": 80,
+                "from_zone": "trust",
+                "to_zone": "dmz",
+            },
+            {
+                "source": "192.168.1.1",
+                "destination": "10.1.1.10",
+                "protocol": 1,
+                "from_zone": "trust",
+                "to_zone": "dmz",
+            },
+        ]
+
+        ans = self.engine.match_many(flows)
+
+        self.assertEqual(["web", "log-all"], [x[0]["name"] for x in ans])
+
+
+class TestMatchIndexes(unittest.TestCase):
+    def setUp(self):
+        self.fw, self.rulebase = policy_firewall()
+        self.engine = SecurityPolicyEngine.from_rulebases(self.rulebase)
+        rand = random.Random(4)
+        addresses = [
+            "10.1.1.10",
+            "10.1.1.11",
+            "10.1.1.200",
+            "8.8.8.8",
+            "2001:db8::5",
+            "2001:db9::5",
+        ]
+        self.flows = []
+        for _ in range(300):
+            self.flows.append(
+                {
+                    "source": rand.choice(addresses),
+                    "destination": rand.choice(addresses),
+                    "protocol": rand.choice([6, 17, 1]),
+                    "port": rand.choice([None, 53, 80, 443, 8080]),
+                    "application": rand.choice([None, "dns", "ssl"]),
+                    "user": rand.choice([None, "unknown", "bob"]),
+                    "from_zone": rand.choice([None, "trust", "guest"]),
+                    "to_zone": rand.choice([None, "dmz", "untrust", "trust"]),
+                }
+            )
+
+    def expected(self, show_all):
+        return [
+            [x["index"] for x in ans]
+            for ans in self.engine.match_many(self.flows, show_all=show_all)
+        ]
+
+    def test_same_as_match(self):
+        for show_all in (False, True):
+            self.assertEqual(
+                self.expected(show_all),
+                self.engine.match_indexes(self.flows, show_all=show_all),
+            )
+
+    def test_without_numpy(self):
+        with mock.patch.object(policymatch, "numpy", None):
+            for show_all in (False, True):
+                self.assertEqual(
+                    self.expected(show_all),
+                    self.engine.match_indexes(self.flows, show_all=show_all),
+                )
+
+    @unittest.skipIf(policymatch.numpy is None, "NumPy is not installed")
+    def test_contains_many_array(self):
+        numpy = policymatch.numpy
+        ans = IntervalSet([(5, 9), (20, 30), (1 << 70, 1 << 71)])
+        points = numpy.array([-1, 4, 5, 9, 10, 25, 31], dtype=numpy.int64)
+
+        self.assertEqual(
+            [False, False, True, True, False, True, False],
+            ans.contains_many(points).tolist(),
+        )
+        self.assertEqual([False, True], ans.contains_many([4, 1 << 70]))
+
+
+def analyze(*rules):
+    fw, _ = policy_firewall()
+    engine = SecurityPolicyEngine(rules, policymatch.ObjectResolver([fw]))
+    return [
+        (x["name"], x["type"], x["rules"])
+        for x in policymatch.RuleAnalyzer(engine).analyze()
+    ]
+
+
+class TestRuleAnalyzer(unittest.TestCase):
+    def test_shadowed_redundant_generalization(self):
+        ans = analyze(
+            policies.SecurityRule(
+                "allow-web",
+                fromzone=["trust"],
+                tozone=["dmz"],
+                destination=["10.1.1.0/24"],
+                service=["tcp-8080"],
+                action="allow",
+            ),
+            policies.SecurityRule(
+                "deny-host",
+                fromzone=["trust"],
+                tozone=["dmz"],
+                destination=["10.1.1.10"],
+                service=["tcp-8080"],
+                action="deny",
+            ),
+            policies.SecurityRule(
+                "allow-dup",
+                fromzone=["trust"],
+                tozone=["dmz"],
+                destination=["10.1.1.10-10.1.1.20"],
+                service=["tcp-8080"],
+                action="allow",
+            ),
+            policies.SecurityRule(
+                "other-zone",
+                fromzone=["guest"],
+                tozone=["dmz"],
+                destination=["10.1.1.10"],
+                service=["tcp-8080"],
+                action="allow",
+            ),
+            policies.SecurityRule("deny-all", service=["any"], action="deny"),
+        )
+
+        self.assertEqual(
+            [
+                ("deny-host", "shadowed", ["allow-web"]),
+                ("allow-dup", "redundant", ["allow-web"]),
+                ("deny-all", "generalization", ["allow-web", "other-zone"]),
+            ],
+            ans,
+        )
+
+    def test_negation_and_intrazone(self):
+        ans = analyze(
+            policies.SecurityRule(
+                "not-internal",
+                destination=["10.0.0.0/8"],
+                negate_destination=True,
+                service=["any"],
+                action="allow",
+            ),
+            policies.SecurityRule(
+                "internet", destination=["8.8.8.0/24"], service=["any"], action="allow",
+            ),
+            policies.SecurityRule(
+                "internal",
+                destination=["10.1.0.0/16"],
+                service=["any"],
+                action="allow",
+            ),
+            policies.SecurityRule(
+                "trust", fromzone=["trust"], tozone=["trust"], action="allow"
+            ),
+            policies.SecurityRule(
+                "intra", type="intrazone", fromzone=["trust"], action="deny"
+            ),
+            policies.SecurityRule("inter", type="interzone", action="deny"),
+        )
+
+        self.assertEqual(
+            [
+                ("internet", "redundant", ["not-internal"]),
+                ("intra", "shadowed", ["trust"]),
+            ],
+            ans,
+        )
+
+    def test_matches_pairwise_comparison(self):
+        rand = random.Random(7)
+        rules = []
+        for num in range(150):
+            rules.append(
+                policies.SecurityRule(
+                    "rule{0}".format(num),
+                    fromzone=rand.choice([None, ["a"], ["a", "b"], ["b"]]),
+                    tozone=rand.choice([None, ["c"], ["c", "d"]]),
+                    destination=rand.choice(
+                        [None, ["10.0.0.0/8"], ["10.1.0.0/16"], ["10.1.1.1", "8.8.8.8"]]
+                    ),
+                    negate_destination=rand.random() < 0.1,
+                    application=rand.choice([None, ["ssl"], ["ssl", "dns"]]),
+                    service=rand.choice([["any"], ["tcp-8080"], ["web-ports"], None]),
+                    action=rand.choice(["allow", "deny"]),
+                )
+            )
+        fw, _ = policy_firewall()
+        engine = SecurityPolicyEngine(rules, policymatch.ObjectResolver([fw]))
+        compiled = engine._compiled
+
+        def covers(x, c):
+            for field in ("fromzone", "tozone", "application", "category"):
+                mine, theirs = getattr(c, field), getattr(x, field)
+                if theirs is not None and (mine is None or not mine <= theirs):
+                    return False
+            pairs = (
+                (
+                    policymatch._address_line(c, "destination"),
+                    policymatch._address_line(x, "destination"),
+                ),
+                (policymatch._service_line(c), policymatch._service_line(x)),
+            )
+            return all(all(theirs.covers(*y) for y in mine) for mine, theirs in pairs)
+
+        expected = {}
+        for i, c in enumerate(compiled):
+            earlier = [x.name for x in compiled[:i] if covers(x, c)]
+            if earlier:
+                expected[c.name] = earlier
+        ans = policymatch.RuleAnalyzer(engine).analyze()
+
+        self.assertTrue(expected)
+        self.assertEqual(
+            expected,
+            dict(
+                (x["name"], x["rules"])
+                for x in ans
+                if x["type"] in ("shadowed", "redundant")
+            ),
+        )
+
+
+class TestNatPolicyEngine(unittest.TestCase):
+    def setUp(self):
+        self.fw, _ = policy_firewall()
+        self.fw.add(objects.AddressObject("public-pool", "203.0.113.0/24"))
+        self.fw.add(objects.AddressObject("egress", "198.51.100.1/24"))
+        rulebase = self.fw.add(policies.Rulebase())
+        for rule in (
+            policies.NatRule(
+                "disabled",
+                fromzone=["trust"],
+                tozone=["untrust"],
+                source_translation_type="dynamic-ip-and-port",
+                source_translation_address_type="interface-address",
+                source_translation_ip_address="192.0.2.1/24",
+                disabled=True,
+            ),
+            policies.NatRule(
+                "static",
+                fromzone=["dmz"],
+                tozone=["untrust"],
+                source=["10.1.1.0/24"],
+                source_translation_type="static-ip",
+                source_translation_static_translated_address="public-pool",
+                source_translation_static_bi_directional=True,
+            ),
+            policies.NatRule(
+                "port-forward",
+                fromzone=["untrust"],
+                tozone=["untrust"],
+                destination=["198.51.100.1"],
+                service="tcp-8080",
+                destination_translated_address="web1",
+                destination_translated_port=80,
+            ),
+            policies.NatRule(
+                "outbound",
+                fromzone=["trust"],
+                tozone=["untrust"],
+                to_interface="ethernet1/1",
+                source_translation_type="dynamic-ip-and-port",
+                source_translation_address_type="interface-address",
+                source_translation_interface="ethernet1/1",
+                source_translation_ip_address="egress",
+            ),
+            policies.NatRule(
+                "pool",
+                fromzone=["guest"],
+                source_translation_type="dynamic-ip",
+                source_translation_address_type="translated-address",
+                source_translation_translated_addresses=[
+                    "192.0.2.10-192.0.2.12",
+                    "192.0.2.20",
+                ],
+            ),
+        ):
+            rulebase.add(rule)
+        self.engine = policymatch.NatPolicyEngine.from_rulebases(rulebase)
+
+    def test_static_keeps_offset(self):
+        ans = self.engine.match(
+            "10.1.1.5", "8.8.8.8", 6, port=443, from_zone="dmz", to_zone="untrust"
+        )
+
+        self.assertEqual(
+            {
+                "name": "static",
+                "index": 2,
+                "reverse": False,
+                "source": "203.0.113.5",
+                "destination": "8.8.8.8",
+                "port": 443,
+            },
+            ans,
+        )
+
+    def test_static_bi_directional(self):
+        ans = self.engine.match(
+            "8.8.8.8", "203.0.113.9", 6, port=22, from_zone="untrust", to_zone="untrust"
+        )
+
+        self.assertEqual("static", ans["name"])
+        self.assertTrue(ans["reverse"])
+        self.assertEqual("8.8.8.8", ans["source"])
+        self.assertEqual("10.1.1.9", ans["destination"])
+
+    def test_destination_and_port(self):
+        ans = self.engine.match(
+            "8.8.8.8",
+            "198.51.100.1",
+            6,
+            port=8080,
+            from_zone="untrust",
+            to_zone="untrust",
+        )
+
+        self.assertEqual("port-forward", ans["name"])
+        self.assertEqual("10.1.1.10", ans["destination"])
+        self.assertEqual(80, ans["port"])
+        self.assertIsNone(
+            self.engine.match(
+                "8.8.8.8",
+                "198.51.100.1",
+                6,
+                port=443,
+                from_zone="untrust",
+                to_zone="untrust",
+            )
+        )
+
+    def test_dynamic(self):
+        ans = self.engine.match(
+            "192.168.1.1", "8.8.8.8", 17, from_zone="trust", to_zone="untrust"
+        )
+        self.assertEqual("outbound", ans["name"])
+        self.assertEqual("198.51.100.1", ans["source"])
+        self.assertEqual(["198.51.100.1"], ans["source_pool"])
+
+        ans = self.engine.match("192.168.1.1", "8.8.8.8", 17, from_zone="guest")
+        self.assertEqual("pool", ans["name"])
+        self.assertIsNone(ans["source"])
+        self.assertEqual(["192.0.2.10-192.0.2.12", "192.0.2.20"], ans["source_pool"])
+
+    def test_to_interface(self):
+        flow = {
+            "source": "192.168.1.1",
+            "destination": "8.8.8.8",
+            "protocol": 17,
+            "from_zone": "trust",
+        }
+
+        self.assertIsNone(self.engine.match(to_interface="ethernet1/2", **flow))
+        self.assertEqual(
+            "outbound", self.engine.match(to_interface="ethernet1/1", **flow)["name"]
+        )
+
+    def test_batches(self):
+        flows = [
+            {"source": "10.1.1.5", "destination": "8.8.8.8", "protocol": 6},
+            {
+                "source": "192.168.1.1",
+                "destination": "8.8.8.8",
+                "protocol": 6,
+                "from_zone": "trust",
+            },
+            {"source": "8.8.8.8", "destination": "203.0.113.1", "protocol": 6},
+            {
+                "source": "8.8.8.8",
+                "destination": "8.8.4.4",
+                "protocol": 6,
+                "from_zone": "dmz",
+            },
+        ]
+        expected = [self.engine.match(**x) for x in flows]
+
+        self.assertEqual([2, 4, 2, None], self.engine.match_indexes(flows))
+        self.assertEqual(expected, self.engine.match_many(flows))
+        with mock.patch.object(policymatch, "numpy", None):
+            self.assertEqual([2, 4, 2, None], self.engine.match_indexes(flows))
+            self.assertEqual(expected, self.engine.match_many(flows))
+
+
+def address_index():
+    return policymatch.AddressIndex(
+        [
+            objects.AddressObject("net10", "10.0.0.0/8"),
+            objects.AddressObject("net10-1", "10.1.0.0/16"),
+            objects.AddressObject("host", "10.1.1.1"),
+            objects.AddressObject("host-dup", "10.1.1.1/32"),
+            objects.AddressObject("range", "10.1.1.0-10.1.2.10", type="ip-range"),
+            objects.AddressObject("v6", "2001:db8::/32"),
+            objects.AddressObject("www", "www.example.com", type="fqdn"),
+            objects.AddressObject("broken", "10.1.1.300"),
+            objects.AddressGroup("inner", static_value=["host", "v6"]),
+            objects.AddressGroup("outer", static_value=["inner", "net10-1"]),
+            objects.AddressGroup("other", static_value=["www"]),
+        ],
+        fqdn={"www.example.com": ["192.0.2.10", "192.0.2.11"]},
+    )
+
+
+class TestAddressIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = address_index()
+
+    def test_containing(self):
+        self.assertEqual(
+            set(["net10", "net10-1", "host", "host-dup", "range"]),
+            self.index.containing("10.1.1.1"),
+        )
+        self.assertEqual(
+            set(["net10", "net10-1", "range"]), self.index.containing("10.1.1.0/24")
+        )
+        self.assertEqual(
+            set(["net10", "net10-1"]), self.index.containing("10.1.0.0/23")
+        )
+        self.assertEqual(set(["v6"]), self.index.containing("2001:db8:1::1"))
+        self.assertEqual(set(["www"]), self.index.containing("192.0.2.10"))
+        self.assertEqual(set(), self.index.containing("192.168.1.1"))
+
+    def test_overlapping(self):
+        self.assertEqual(
+            set(["net10", "net10-1", "host", "host-dup", "range"]),
+            self.index.overlapping("10.1.0.0/23"),
+        )
+        self.assertEqual(
+            set(["net10", "net10-1", "range"]),
+            self.index.overlapping("10.1.2.0-10.1.2.255"),
+        )
+        self.assertEqual(set(["www"]), self.index.overlapping("192.0.2.0/24"))
+
+    def test_duplicates(self):
+        self.assertEqual([set(["host", "host-dup"])], self.index.duplicates())
+        self.assertEqual(set(["host", "host-dup"]), self.index.duplicates("10.1.1.1"))
+        self.assertEqual(set(), self.index.duplicates("10.1.1.2"))
+
+    def test_groups(self):
+        self.assertEqual(
+            frozenset(["host", "v6", "net10-1"]), self.index.group_members("outer")
+        )
+        self.assertEqual(
+            set(["inner", "outer"]), self.index.groups_containing("10.1.1.1")
+        )
+        self.assertEqual(set(["outer"]), self.index.groups_containing("10.1.9.9"))
+        self.assertEqual(set(["other"]), self.index.groups_containing("192.0.2.11"))
+
+    def test_group_loop(self):
+        self.index.add(objects.AddressGroup("inner", static_value=["outer"]))
+
+        self.assertRaises(err.PanDeviceError, self.index.groups_containing, "10.1.1.1")
+
+    def test_updates(self):
+        self.index.add(objects.AddressObject("host", "10.1.1.2"))
+        self.index.remove("net10")
+        self.index.remove("inner", group=True)
+
+        self.assertEqual(
+            set(["net10-1", "host-dup", "range"]), self.index.containing("10.1.1.1")
+        )
+        self.assertEqual(set(["host"]), self.index.duplicates("10.1.1.2/32"))
+        self.assertEqual([], self.index.duplicates())
+        self.assertEqual(set(["outer"]), self.index.groups_containing("10.1.1.2"))
+
+    def test_fqdn_objects(self):
+        self.assertEqual(set(["www"]), self.index.fqdn_objects("WWW.example.com"))
+        self.assertEqual(set(), self.index.fqdn_objects("example.com"))
+
+    def test_objects_changed_in_place(self):
+        index = policymatch.AddressIndex.from_scopes(group_firewall())
+        self.assertEqual(
+            set(["prod-web", "servers", "all"]), index.groups_containing("10.1.1.1")
+        )
+        www = self.index.addresses["www"]
+        web1 = index.addresses["web1"]
+
+        www.value = "example.com"
+        self.index.add(www)
+        web1.tag = ["db"]
+        index.add(web1)
+
+        self.assertEqual(set(), self.index.fqdn_objects("www.example.com"))
+        self.assertEqual(set(["www"]), self.index.fqdn_objects("example.com"))
+        self.assertEqual(set(), index.groups_containing("10.1.1.1"))
+
+    def test_from_scopes(self):
+        fw = panos.firewall.Firewall("fw1", "user", "passwd", "authkey")
+        shared = panos.firewall.Firewall("fw2", "user", "passwd", "authkey")
+        fw.add(objects.AddressObject("a", "10.0.0.1"))
+        shared.add(objects.AddressObject("a", "10.0.0.2"))
+        shared.add(objects.AddressObject("b", "10.0.0.3"))
+
+        index = policymatch.AddressIndex.from_scopes(fw, shared)
+
+        self.assertEqual(set(["a"]), index.containing("10.0.0.1"))
+        self.assertEqual(set(), index.containing("10.0.0.2"))
+        self.assertEqual(set(["b"]), index.containing("10.0.0.3"))
+
+    def test_matches_brute_force(self):
+        rand = random.Random(7)
+        values = []
+        for num in range(300):
+            start = rand.randint(0, 4095)
+            if rand.random() < 0.5:
+                length = rand.randint(20, 32)
+                value = "10.0.{0}.{1}/{2}".format(start >> 8, start & 255, length)
+                obj = objects.AddressObject("a{0}".format(num), value)
+            else:
+                end = min(start + rand.randint(0, 600), 4095)
+                value = "10.0.{0}.{1}-10.0.{2}.{3}".format(
+                    start >> 8, start & 255, end >> 8, end & 255
+                )
+                obj = objects.AddressObject("a{0}".format(num), value, type="ip-range")
+            values.append(obj)
+        index = policymatch.AddressIndex(values)
+        sets = dict(
+            (x.name, IntervalSet(policymatch.parse_address(x.value, x.type)))
+            for x in values
+        )
+
+        for _ in range(200):
+            first = policymatch.address_key("10.0.0.0") + rand.randint(0, 4095)
+            last = first + rand.randint(0, 300)
+            query = "{0}-{1}".format(
+                policymatch.format_address(first), policymatch.format_address(last)
+            )
+            self.assertEqual(
+                set(k for k, v in sets.items() if v.covers(first, last)),
+                index.containing(query),
+            )
+            self.assertEqual(
+                set(k for k, v in sets.items() if v.overlaps(first, last)),
+                index.overlapping(query),
+            )
+
+
+class TestTagFilter(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(("tag", "web"), policymatch.parse_tag_filter("'web'"))
+        self.assertEqual(
+            ("or", (("and", (("tag", "a"), ("tag", "b c"))), ("tag", "d"))),
+            policymatch.parse_tag_filter("'a' and \"b c\" OR d"),
+        )
+        self.assertEqual(
+            ("and", (("tag", "a"), ("or", (("tag", "b"), ("tag", "c"))))),
+            policymatch.parse_tag_filter("'a' and ('b' or 'c')"),
+        )
+
+    def test_invalid(self):
+        for text in ("", "'a' and", "('a'", "'a' 'b'", "'a", "'a')"):
+            self.assertRaises(ValueError, policymatch.parse_tag_filter, text)
+
+    def test_evaluate(self):
+        tags = {"a": set([1, 2, 3]), "b": set([2, 3]), "c": set([3, 4])}
+        expr = policymatch.parse_tag_filter("'a' and ('b' or 'c') and 'c'")
+
+        self.assertEqual(
+            set([3]), policymatch.evaluate_tag_filter(expr, lambda x: tags.get(x, ()))
+        )
+        self.assertEqual(set(["a", "b", "c"]), policymatch.tag_filter_tags(expr))
+
+
+def group_firewall():
+    fw = panos.firewall.Firewall("fw1", "user", "passwd", "authkey")
+    fw.add(objects.AddressObject("web1", "10.1.1.1", tag=["web", "prod"]))
+    fw.add(objects.AddressObject("web2", "10.1.1.2", tag=["web"]))
+    fw.add(objects.AddressObject("db1", "10.1.2.1", tag=["db", "prod"]))
+    fw.add(objects.AddressGroup("prod-web", dynamic_value="'web' and 'prod'"))
+    fw.add(objects.AddressGroup("servers", static_value=["prod-web", "db1"]))
+    fw.add(objects.AddressGroup("all", static_value=["servers", "web2"]))
+    fw.add(objects.AddressGroup("other", static_value=["web2"]))
+    fw.add(objects.ServiceGroup("web-ports", value=["service-http", "tcp-8080"]))
+    fw.add(objects.ServiceGroup("ports", value=["web-ports", "tcp-22"]))
+    return fw
+
+
+class TestGroupResolver(unittest.TestCase):
+    def setUp(self):
+        self.resolver = policymatch.GroupResolver(
+            [group_firewall()], registered_ip={"10.9.9.9": ["web", "prod"]}
+        )
+
+    def test_members(self):
+        self.assertEqual(
+            frozenset(["web1", "10.9.9.9", "db1", "web2"]),
+            self.resolver.address_members("all"),
+        )
+        self.assertEqual(
+            frozenset(["service-http", "tcp-8080", "tcp-22"]),
+            self.resolver.service_members("ports"),
+        )
+        self.assertEqual(frozenset(), self.resolver.address_members("missing"))
+
+    def test_shared_groups_expand_once(self):
+        self.resolver.address_members("all")
+
+        with mock.patch.object(
+            self.resolver, "_address_group", side_effect=AssertionError
+        ):
+            self.assertEqual(
+                frozenset(["web1", "10.9.9.9", "db1"]),
+                self.resolver.address_members("servers"),
+            )
+
+    def test_loop(self):
+        self.resolver.update(objects.AddressGroup("prod-web", static_value=["all"]))
+
+        self.assertRaises(err.PanDeviceError, self.resolver.address_members, "servers")
+        self.resolver.update(objects.ServiceGroup("web-ports", value=["ports"]))
+        self.assertRaises(err.PanDeviceError, self.resolver.service_members, "ports")
+
+    def test_tag_changes(self):
+        for name in ("all", "other"):
+            self.resolver.address_members(name)
+        self.resolver.service_members("ports")
+
+        self.resolver.update(
+            objects.AddressObject("web2", "10.1.1.2", tag=["web", "prod"])
+        )
+        self.resolver.unregister("10.9.9.9", ["prod"])
+        self.resolver.register("10.8.8.8", "web")
+
+        # Unrelated groups stay cached
+        cached = self.resolver._members
+        self.assertIn(("address", "other"), cached)
+        self.assertIn(("service", "ports"), cached)
+        self.assertNotIn(("address", "all"), cached)
+        self.assertEqual(
+            frozenset(["web1", "web2", "db1"]), self.resolver.address_members("all")
+        )
+
+    def test_object_changed_in_place(self):
+        self.assertEqual(
+            frozenset(["web1", "10.9.9.9"]), self.resolver.address_members("prod-web")
+        )
+        web1 = self.resolver.object("web1", objects.AddressObject)
+
+        web1.tag = ["db"]
+        self.resolver.update(web1)
+
+        self.assertEqual(
+            frozenset(["10.9.9.9"]), self.resolver.address_members("prod-web")
+        )
+        web1.tag = ["web", "prod"]
+        self.resolver.update(web1)
+        self.assertEqual(
+            frozenset(["web1", "10.9.9.9"]), self.resolver.address_members("prod-web")
+        )
+        self.resolver.remove("web1", objects.AddressObject)
+        self.assertEqual(
+            frozenset(["10.9.9.9"]), self.resolver.address_members("prod-web")
+        )
+
+    def test_member_changes(self):
+        self.resolver.address_members("all")
+        self.resolver.address_members("other")
+
+        self.resolver.update(objects.AddressGroup("servers", static_value=["db1"]))
+
+        self.assertIn(("address", "other"), self.resolver._members)
+        self.assertIn(("address", "prod-web"), self.resolver._members)
+        self.assertEqual(
+            frozenset(["db1", "web2"]), self.resolver.address_members("all")
+        )
+
+        self.resolver.remove("db1", objects.AddressObject)
+        self.resolver.remove("prod-web", objects.AddressGroup)
+        self.resolver.update(objects.AddressGroup("db1", static_value=["web1"]))
+
+        self.assertEqual(
+            frozenset(["web1", "web2"]), self.resolver.address_members("all")
+        )
+
+    def test_address_index_dynamic_groups(self):
+        index = policymatch.AddressIndex.from_scopes(group_firewall())
+
+        self.assertEqual(
+            set(["prod-web", "servers", "all"]), index.groups_containing("10.1.1.1")
+        )
+        index.add(objects.AddressObject("web1", "10.1.1.1", tag=["web"]))
+        self.assertEqual(set(["servers", "all"]), index.groups_containing("10.1.2.1"))
+        self.assertEqual(set(), index.groups_containing("10.1.1.1"))
+
+
+def user_groups():
+    return [
+        objects.DynamicUserGroup("risky", filter="'malware' or 'phished'"),
+        objects.DynamicUserGroup("remote-eng", filter="'eng' and 'vpn'"),
+        objects.DynamicUserGroup("broken", filter="'eng' and"),
+    ]
+
+
+class TestDynamicUserGroupEvaluator(unittest.TestCase):
+    def setUp(self):
+        self.evaluator = policymatch.DynamicUserGroupEvaluator(
+            user_groups(),
+            user_tags={
+                "alice": ["eng", "vpn"],
+                "bob": ["eng", "phished"],
+                "carol": ["vpn"],
+            },
+        )
+
+    def test_membership(self):
+        self.assertEqual(
+            {
+                "risky": frozenset(["bob"]),
+                "remote-eng": frozenset(["alice"]),
+                "broken": frozenset(),
+            },
+            self.evaluator.membership(),
+        )
+        self.assertEqual(set(["risky"]), self.evaluator.groups_for_user("bob"))
+        self.assertEqual(set(), self.evaluator.groups_for_user("dave"))
+
+    def test_tag_changes(self):
+        self.evaluator.tag_user("carol", ["eng", "malware"])
+        self.evaluator.untag_user("alice", ["vpn"])
+        self.evaluator.untag_user("bob")
+
+        self.assertEqual(frozenset(["carol"]), self.evaluator.members("risky"))
+        self.assertEqual(frozenset(["carol"]), self.evaluator.members("remote-eng"))
+        self.assertEqual(set(), self.evaluator.groups_for_user("alice"))
+
+    def test_group_changes(self):
+        self.evaluator.add(objects.DynamicUserGroup("risky", filter="'vpn'"))
+        self.evaluator.remove("remote-eng")
+        self.evaluator.tag_user("dave", "vpn")
+
+        self.assertEqual(
+            frozenset(["alice", "carol", "dave"]), self.evaluator.members("risky")
+        )
+        self.assertEqual(set(["risky"]), self.evaluator.groups_for_user("alice"))
+        self.assertEqual(frozenset(), self.evaluator.members("remote-eng"))
+
+    def test_matches_each_user(self):
+        rand = random.Random(5)
+        tags = ["t{0}".format(x) for x in range(8)]
+        groups = [
+            objects.DynamicUserGroup(
+                "g{0}".format(num),
+                filter="'{0}' and ('{1}' or '{2}')".format(*rand.sample(tags, 3)),
+            )
+            for num in range(20)
+        ]
+        evaluator = policymatch.DynamicUserGroupEvaluator(groups)
+        user_tags = {}
+        for _ in range(500):
+            user = "user{0}".format(rand.randrange(50))
+            tag = rand.choice(tags)
+            if rand.random() < 0.6:
+                evaluator.tag_user(user, [tag])
+                user_tags.setdefault(user, set()).add(tag)
+            else:
+                evaluator.untag_user(user, [tag])
+                user_tags.get(user, set()).discard(tag)
+
+        fresh = policymatch.DynamicUserGroupEvaluator(
+            groups, user_tags=dict((k, list(v)) for k, v in user_tags.items())
+        )
+        self.assertEqual(fresh.membership(), evaluator.membership())
+        for group in groups:
+            expr = policymatch.parse_tag_filter(group.filter)
+            self.assertEqual(
+                frozenset(
+                    k
+                    for k, v in user_tags.items()
+                    if policymatch._tag_filter_holds(expr, v)
+                ),
+                evaluator.members(group.name),
+            )
+
+    def test_watch_userid(self):
+        fw = panos.firewall.Firewall("fw1", "user", "passwd", "authkey")
+        fw._set_version_and_version_info("9.1.0")
+        fw._xapi_private = mock.Mock()
+        for group in user_groups():
+            fw.add(group)
+        evaluator = policymatch.DynamicUserGroupEvaluator.from_scopes(fw)
+        evaluator.watch(fw.userid)
+
+        fw.userid.batch_start()
+        fw.userid.tag_user("alice", ["eng", "vpn"])
+        fw.userid.tag_user("bob", ["malware"])
+        self.assertEqual(frozenset(), evaluator.members("risky"))
+        fw.userid.batch_end()
+        fw.userid.untag_user("alice")
+
+        self.assertEqual(frozenset(["bob"]), evaluator.members("risky"))
+        self.assertEqual(frozenset(), evaluator.members("remote-eng"))
+
+        evaluator.unwatch(fw.userid)
+        fw.userid.tag_user("alice", ["malware"])
+        self.assertEqual(frozenset(["bob"]), evaluator.members("risky"))
+
+
+def url_categories():
+    return [
+        objects.CustomUrlCategory(
+            "partners",
+            url_value=["*.partner.com", "partner.org", "docs.example.com/partners"],
+            type="URL List",
+        ),
+        objects.CustomUrlCategory(
+            "blocked",
+            url_value=["bad.example.com/", "www.^.test", "10.1.1.1"],
+            type="URL List",
+        ),
+        objects.CustomUrlCategory(
+            "risky", url_value=["gambling", "malware"], type="Category Match"
+        ),
+    ]
+
+
+class TestUrlCategoryMatcher(unittest.TestCase):
+    def setUp(self):
+        self.matcher = policymatch.UrlCategoryMatcher(url_categories())
+
+    def assertCategories(self, expected, url):
+        self.assertEqual(set(expected), self.matcher.categories_for(url), url)
+
+    def test_wildcards(self):
+        self.assertCategories(["partners"], "https://www.partner.com/index.html")
+        self.assertCategories(["partners"], "a.b.partner.com")
+        self.assertCategories([], "partner.com")
+        self.assertCategories(["blocked"], "www.site.test/a")
+        self.assertCategories([], "www.a.site.test")
+
+    def test_open_ending(self):
+        self.assertCategories(["partners"], "partner.org")
+        self.assertCategories(["partners"], "http://partner.org.uk/x?y=1")
+        self.assertCategories([], "www.partner.org")
+
+    def test_paths(self):
+        self.assertCategories(["blocked"], "bad.example.com")
+        self.assertCategories(["blocked"], "HTTP://user@Bad.Example.com:8080/x")
+        self.assertCategories([], "bad.example.com.au")
+        self.assertCategories(["partners"], "docs.example.com/partners/a")
+        self.assertCategories([], "docs.example.com/")
+        self.assertCategories(["blocked"], "10.1.1.1/login")
+
+    def test_updates(self):
+        self.matcher.remove("partners")
+        self.matcher.add(objects.CustomUrlCategory("new", url_value=["*.test"]))
+
+        self.assertCategories([], "www.partner.com")
+        self.assertCategories(["new", "blocked"], "www.site.test")
+
+    def test_matches_brute_force(self):
+        rand = random.Random(11)
+        labels = ["a", "b", "c", "com", "net"]
+        entries = {}
+        for num in range(40):
+            host = ".".join(
+                rand.choice(labels + ["*", "^"]) for _ in range(rand.randint(1, 3))
+            )
+            entries["cat{0}".format(num)] = host + rand.choice(["", "/", "/p"])
+        matcher = policymatch.UrlCategoryMatcher(
+            objects.CustomUrlCategory(k, url_value=[v]) for k, v in entries.items()
+        )
+
+        def matches(entry, host, path):
+            pattern, slash, prefix = entry.partition("/")
+            parts = pattern.split(".")
+            if not slash:
+                # Also matches hosts that continue to the right
+                return any(
+                    matches_labels(parts, host[:end]) for end in range(1, len(host) + 1)
+                )
+            return matches_labels(parts, host) and path.startswith(slash + prefix)
+
+        def matches_labels(parts, host):
+            if not parts:
+                return not host
+            if parts[0] == "*":
+                return any(
+                    matches_labels(parts[1:], host[x:]) for x in range(1, len(host) + 1)
+                )
+            if not host or parts[0] not in ("^", host[0]):
+                return False
+            return matches_labels(parts[1:], host[1:])
+
+        for _ in range(300):
+            host = [rand.choice(labels) for _ in range(rand.randint(1, 4))]
+            path = rand.choice(["/", "/p", "/px", "/q"])
+            expected = set(k for k, v in entries.items() if matches(v, host, path))
+            self.assertEqual(expected, matcher.categories_for(".".join(host) + path))
+
+    def test_security_engine(self):
+        fw = panos.firewall.Firewall("fw1", "user", "passwd", "authkey")
+        for category in url_categories():
+            fw.add(category)
+        rulebase = fw.add(policies.Rulebase())
+        rulebase.add(
+            policies.SecurityRule("block", category=["blocked"], action="deny")
+        )
+        rulebase.add(
+            policies.SecurityRule(
+                "partners", category=["partners", "business"], action="allow"
+            )
+        )
+        rulebase.add(policies.SecurityRule("default", action="deny"))
+        engine = SecurityPolicyEngine.from_rulebases(rulebase)
+        flow = {"source": "10.1.1.5", "destination": "8.8.8.8", "protocol": 6}
+        flows = [
+            dict(flow, url="https://bad.example.com/"),
+            dict(flow, url="https://www.partner.com/"),
+            dict(flow, url="https://www.other.com/", category="business"),
+            dict(flow, url="https://www.other.com/"),
+            dict(flow, category="blocked"),
+            flow,
+        ]
+
+        self.assertEqual(
+            "block", engine.match(url="bad.example.com", **flow)[0]["name"]
+        )
+        # Without a custom category, the predefined category of a URL is
+        # unknown, so the category isn't checked
+        self.assertEqual([[1], [2], [2], [1], [1], [1]], engine.match_indexes(flows))
+        self.assertEqual(
+            [[x["index"] for x in y] for y in engine.match_many(flows)],
+            engine.match_indexes(flows),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
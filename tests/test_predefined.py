@@ -0,0 +1,354 @@
+# Copyright (c) 2014, Palo Alto Networks
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted, provided that the above
+# copyright notice and this permission notice appear in all copies.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+import panos.firewall
+from panos import objects
+from panos.predefined import ApplicationCatalog, Predefined
+
+APPLICATIONS = [
+    objects.ApplicationObject(
+        "web-browsing",
+        category="general-internet",
+        subcategory="internet-utility",
+        technology="browser-based",
+        risk=4,
+        default_type="port",
+        default_port=["tcp/80"],
+        able_to_transfer_file=True,
+    ),
+    objects.ApplicationObject(
+        "ssh",
+        category="networking",
+        subcategory="encrypted-tunnel",
+        technology="client-server",
+        risk=4,
+        default_type="port",
+        default_port=["tcp/22"],
+        tunnel_other_application=True,
+    ),
+    objects.ApplicationObject(
+        "ping",
+        category="networking",
+        subcategory="ip-protocol",
+        technology="network-protocol",
+        risk=2,
+        default_type="ident-by-icmp-type",
+        default_icmp_type=8,
+    ),
+]
+CONTAINERS = [
+    objects.ApplicationContainer("facebook", applications=["facebook-base"]),
+]
+SERVICES = [
+    objects.ServiceObject("service-http", protocol="tcp", destination_port="80,8080"),
+]
+TAGS = [
+    objects.Tag("Sanctioned", color="color1"),
+]
+
+
+def result(objs):
+    ans = ET.Element("result")
+    for obj in objs:
+        elm = obj.element()
+        if isinstance(obj, objects.ApplicationContainer):
+            ET.SubElement(elm, "functions")
+        ans.append(elm)
+    return ans
+
+
+def predefined_xml(xpath):
+    """Answer predefined gets like a device"""
+    if xpath.endswith(Predefined.SERVICE + "/entry"):
+        return result(SERVICES)
+    elif xpath.endswith(Predefined.TAG + "/entry"):
+        return result(TAGS)
+    return result(APPLICATIONS + CONTAINERS)
+
+
+def predefined_firewall(content_version="8500-7000"):
+    fw = panos.firewall.Firewall("fw1", "user", "passwd", "authkey", serial="Serial")
+    fw.content_version = content_version
+    fw.predefined._get_xml = mock.Mock(side_effect=predefined_xml)
+    return fw
+
+
+class TestPredefinedCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def assertSameObjects(self, expected, actual):
+        self.assertEqual(sorted(x.name for x in expected), sorted(actual))
+        for obj in expected:
+            self.assertEqual(obj.about(), actual[obj.name].about())
+            self.assertEqual(type(obj), type(actual[obj.name]))
+
+    def test_cache_path(self):
+        fw = predefined_firewall()
+        fw.predefined.cache_dir = self.tmpdir
+
+        self.assertEqual(
+            os.path.join(self.tmpdir, "predefined-8500-7000.json"),
+            fw.predefined.cache_path(),
+        )
+
+    def test_content_version_from_system_info(self):
+        fw = predefined_firewall(None)
+        fw.show_system_info = mock.Mock(
+            return_value={"system": {"app-version": "8600-7100"}}
+        )
+
+        self.assertEqual("8600-7100", fw.predefined.content_version())
+        self.assertEqual("8600-7100", fw.content_version)
+
+    def test_refreshall_shares_cache(self):
+        fw1 = predefined_firewall()
+        fw1.predefined.cache_dir = self.tmpdir
+        fw1.predefined.refreshall()
+        self.assertEqual(3, fw1.predefined._get_xml.call_count)
+        self.assertTrue(os.path.isfile(fw1.predefined.cache_path()))
+
+        fw2 = predefined_firewall()
+        fw2.predefined.cache_dir = self.tmpdir
+        fw2.predefined.refreshall()
+
+        self.assertFalse(fw2.predefined._get_xml.called)
+        self.assertSameObjects(APPLICATIONS, fw2.predefined.application_objects)
+        self.assertSameObjects(CONTAINERS, fw2.predefined.application_container_objects)
+        self.assertSameObjects(SERVICES, fw2.predefined.service_objects)
+        self.assertSameObjects(TAGS, fw2.predefined.tag_objects)
+
+    def test_other_content_version_not_used(self):
+        fw1 = predefined_firewall()
+        fw1.predefined.cache_dir = self.tmpdir
+        fw1.predefined.refreshall()
+
+        fw2 = predefined_firewall("8501-7001")
+        fw2.predefined.cache_dir = self.tmpdir
+        fw2.predefined.refreshall()
+
+        self.assertEqual(3, fw2.predefined._get_xml.call_count)
+
+    def test_lazy_load(self):
+        path = os.path.join(self.tmpdir, "cache.json")
+        fw1 = predefined_firewall()
+        fw1.predefined.refreshall()
+        fw1.predefined.save_cache(path)
+
+        fw2 = predefined_firewall()
+        self.assertTrue(fw2.predefined.load_cache(path, lazy=True))
+        self.assertEqual({}, fw2.predefined.application_objects)
+
+        ssh = fw2.predefined.application("ssh")
+        self.assertEqual(APPLICATIONS[1].about(), ssh.about())
+        self.assertEqual(["ssh"], list(fw2.predefined.application_objects))
+        self.assertIsNotNone(fw2.predefined.application("facebook"))
+        self.assertIsNotNone(fw2.predefined.service("service-http"))
+        self.assertIsNotNone(fw2.predefined.tag("Sanctioned"))
+        self.assertFalse(fw2.predefined._get_xml.called)
+
+        # Objects not built yet are still saved.
+        fw2.predefined.save_cache(path)
+        fw3 = predefined_firewall()
+        fw3.predefined.load_cache(path)
+        self.assertSameObjects(APPLICATIONS, fw3.predefined.application_objects)
+
+    def test_missing_or_bad_cache(self):
+        path = os.path.join(self.tmpdir, "cache.json")
+        fw = predefined_firewall()
+
+        self.assertFalse(fw.predefined.load_cache(path))
+        with open(path, "w") as f:
+            f.write("{not json")
+        self.assertFalse(fw.predefined.load_cache(path))
+
+
+def named_xml(xpath):
+    """Answer union lookups of named entries like a device"""
+    names = re.findall(r"@name='([^']*)'", xpath)
+    if xpath.startswith(Predefined.ALL_SERVICE_XPATH + "/"):
+        objs = SERVICES
+    elif xpath.startswith(Predefined.ALL_TAG_XPATH + "/"):
+        objs = TAGS
+    else:
+        objs = APPLICATIONS + CONTAINERS
+    return result([x for x in objs if x.name in names])
+
+
+class TestPredefinedLookups(unittest.TestCase):
+    def setUp(self):
+        self.fw = predefined_firewall()
+        self.get = self.fw.predefined._get_xml
+        self.get.side_effect = named_xml
+
+    def test_applications_one_request(self):
+        ans = self.fw.predefined.applications(["ssh", "ping", "facebook", "nope"])
+
+        self.assertEqual(["facebook", "ping", "ssh"], sorted(x.name for x in ans))
+        self.assertEqual(1, self.get.call_count)
+        self.assertEqual(
+            Predefined.ALL_APPLICATION_XPATH
+            + "/entry[@name='facebook' or @name='nope' or @name='ping' or @name='ssh']",
+            self.get.call_args[0][0],
+        )
+
+    def test_only_misses_are_requested(self):
+        self.fw.predefined.application("ssh")
+        self.get.reset_mock()
+
+        self.fw.predefined.applications(["ssh", "ping"])
+
+        self.assertEqual(
+            Predefined.ALL_APPLICATION_XPATH + "/entry[@name='ping']",
+            self.get.call_args[0][0],
+        )
+
+    def test_nothing_requested_when_known(self):
+        self.fw.predefined.applications(["ssh", "ping"])
+        self.get.reset_mock()
+
+        self.fw.predefined.applications(["ssh", "ping"])
+
+        self.assertFalse(self.get.called)
+
+    def test_chunked(self):
+        self.fw.predefined.LOOKUP_CHUNK_SIZE = 2
+
+        ans = self.fw.predefined.applications(["ssh", "ping", "web-browsing", "a", "b"])
+
+        self.assertEqual(3, len(ans))
+        self.assertEqual(3, self.get.call_count)
+
+    def test_services_and_tags(self):
+        services = self.fw.predefined.services(["service-http", "service-https"])
+        tags = self.fw.predefined.tags(["Sanctioned"])
+
+        self.assertEqual(["service-http"], [x.name for x in services])
+        self.assertEqual(["Sanctioned"], [x.name for x in tags])
+        self.assertEqual(2, self.get.call_count)
+
+    def test_quote_in_name(self):
+        self.assertEqual(
+            "/x/entry[@name='a' or @name=\"it's\"]",
+            self.fw.predefined._names_xpath("/x", ["a", "it's"]),
+        )
+
+    def test_both_quotes_in_name(self):
+        xpath = self.fw.predefined._names_xpath("/x", ['it\'s "a"', "b"])
+
+        self.assertEqual(
+            "/x/entry[@name=concat('it', \"'\", 's \"a\"') or @name='b']", xpath
+        )
+
+
+class TestApplicationCatalog(unittest.TestCase):
+    def setUp(self):
+        self.custom = objects.ApplicationObject(
+            "my-app",
+            category="business-systems",
+            subcategory="database",
+            technology="client-server",
+            risk=4,
+            able_to_transfer_file=True,
+            tag=["Sanctioned"],
+        )
+        self.catalog = ApplicationCatalog(APPLICATIONS + [self.custom])
+
+    def match(self, **kwargs):
+        return self.catalog.match(objects.ApplicationFilter("f", **kwargs))
+
+    def test_values_of_an_attribute_are_ored(self):
+        self.assertEqual(
+            frozenset(["ssh", "ping", "web-browsing"]),
+            self.match(category=["networking", "general-internet"]),
+        )
+
+    def test_attributes_are_anded(self):
+        self.assertEqual(
+            frozenset(["ssh"]), self.match(category=["networking"], risk=["4", "5"])
+        )
+
+    def test_characteristics(self):
+        self.assertEqual(
+            frozenset(["web-browsing", "my-app"]), self.match(transfers_files=True)
+        )
+        self.assertEqual(
+            frozenset(["my-app"]),
+            self.match(transfers_files=True, technology=["client-server"]),
+        )
+        self.assertEqual(
+            frozenset(), self.match(transfers_files=True, tunnels_other_apps=True)
+        )
+        self.assertRaises(ValueError, self.match, is_saas=True)
+
+    def test_tag(self):
+        self.assertEqual(frozenset(["my-app"]), self.match(tag=["Sanctioned"]))
+
+    def test_match_any(self):
+        filters = [
+            objects.ApplicationFilter("f1", subcategory=["ip-protocol"]),
+            {"name": "f2", "technology": ["browser-based"]},
+        ]
+
+        self.assertEqual(
+            frozenset(["ping", "web-browsing"]), self.catalog.match_any(filters)
+        )
+
+    def test_add_and_remove(self):
+        self.assertEqual(frozenset(["ping"]), self.match(risk=["2"]))
+
+        self.catalog.add(
+            objects.ApplicationObject("ping", category="networking", risk=1)
+        )
+        self.assertEqual(frozenset(), self.match(risk=["2"]))
+        self.catalog.remove("ssh")
+        self.assertEqual(frozenset(["ping"]), self.match(category=["networking"]))
+        self.assertEqual(3, len(self.catalog))
+
+    def test_from_predefined_uses_lazy_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, "cache.json")
+        fw = predefined_firewall()
+        fw.predefined.refreshall()
+        fw.predefined.save_cache(path)
+        fw.predefined.load_cache(path, lazy=True)
+        fw.predefined.application("ssh")
+
+        catalog = fw.predefined.application_catalog(custom=[self.custom])
+
+        self.assertEqual(
+            frozenset(["ping", "ssh", "web-browsing", "my-app"]), catalog.names()
+        )
+        self.assertEqual(["ssh"], list(fw.predefined.application_objects))
+        self.assertEqual(
+            frozenset(["ssh"]), catalog.match({"tunnels_other_apps": True})
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -16,10 +16,15 @@ try:
 except ImportError:
     import mock
 import sys
+import threading
+import time
 import unittest
+import xml.etree.ElementTree as ET
 
+import panos.errors as err
 import panos.firewall
 import panos.panorama
+from panos import jobs, userid
 
 
 class TestUserId(unittest.TestCase):
@@ -61,6 +66,788 @@ class TestUserId(unittest.TestCase):
 
         fw._xapi_private.user_id.assert_called_once_with(cmd=expected, vsys=vsys)
 
+    def test_send_is_unchanged(self):
+        fw = userid_firewall()
+        uidmessage = ET.fromstring(
+            "<uid-message><version>2.0</version><type>update</type><payload>"
+            '<login><entry name="user1" ip="10.1.1.1" persistent="1"/></login>'
+            '<login><entry name="user2" ip="10.1.1.2"/></login>'
+            "</payload></uid-message>"
+        )
+        expected = ET.tostring(uidmessage)
+
+        fw.userid.send(uidmessage)
+
+        fw._xapi_private.user_id.assert_called_once_with(cmd=expected, vsys=None)
+
+
+def userid_firewall():
+    fw = panos.firewall.Firewall("fw1", "user", "passwd", "authkey", serial="Serial")
+    fw.xapi
+    fw._xapi_private.user_id = mock.Mock()
+    return fw
+
+
+def sent_payloads(fw):
+    return [
+        ET.fromstring(x[1]["cmd"]).find("payload")
+        for x in fw._xapi_private.user_id.call_args_list
+    ]
+
+
+class TestUserIdBatch(unittest.TestCase):
+    def test_batch_sends_once(self):
+        fw = userid_firewall()
+
+        fw.userid.batch_start()
+        fw.userid.login("user1", "10.1.1.1")
+        fw.userid.register("10.1.1.1", ["a", "b"])
+        fw.userid.tag_user("user1", ["c"])
+        fw.userid.batch_end()
+
+        payloads = sent_payloads(fw)
+        self.assertEqual(1, len(payloads))
+        self.assertEqual(
+            ["login", "register", "register-user"], [x.tag for x in payloads[0]]
+        )
+
+    def test_empty_batch_not_sent(self):
+        fw = userid_firewall()
+
+        fw.userid.batch_start()
+        fw.userid.batch_end()
+
+        self.assertFalse(fw._xapi_private.user_id.called)
+
+    def test_flush_on_max_entries(self):
+        fw = userid_firewall()
+
+        fw.userid.batch_start(max_entries=2)
+        fw.userid.logins(
+            [("user{0}".format(x), "10.1.1.{0}".format(x)) for x in range(5)]
+        )
+        self.assertEqual(2, fw._xapi_private.user_id.call_count)
+        fw.userid.batch_end()
+
+        payloads = sent_payloads(fw)
+        self.assertEqual([2, 2, 1], [len(x.find("login")) for x in payloads])
+
+    def test_flush_on_max_bytes(self):
+        fw = userid_firewall()
+
+        fw.userid.batch_start(max_bytes=500)
+        fw.userid.register(["10.1.1.{0}".format(x) for x in range(100)], "tag")
+        fw.userid.batch_end()
+
+        payloads = sent_payloads(fw)
+        self.assertGreater(len(payloads), 1)
+        self.assertEqual(100, sum(len(x.find("register")) for x in payloads))
+        for payload in payloads[:-1]:
+            self.assertLess(len(ET.tostring(payload)), 1000)
+
+    def test_flush_on_max_age(self):
+        fw = userid_firewall()
+
+        with mock.patch("panos.userid.time.time", return_value=100):
+            fw.userid.batch_start(max_age=10)
+            fw.userid.login("user1", "10.1.1.1")
+        self.assertFalse(fw._xapi_private.user_id.called)
+        with mock.patch("panos.userid.time.time", return_value=111):
+            fw.userid.login("user2", "10.1.1.2")
+
+        self.assertEqual(1, fw._xapi_private.user_id.call_count)
+
+    def test_coalesce_login_logout(self):
+        fw = userid_firewall()
+
+        fw.userid.batch_start()
+        fw.userid.login("user1", "10.1.1.1")
+        fw.userid.login("user2", "10.1.1.2")
+        fw.userid.logout("user1", "10.1.1.1")
+        fw.userid.logout("user3", "10.1.1.3")
+        fw.userid.login("user3", "10.1.1.3", timeout=10)
+        fw.userid.batch_end()
+
+        payload = sent_payloads(fw)[0]
+        self.assertEqual(
+            [("user2", "10.1.1.2"), ("user3", "10.1.1.3")],
+            [(x.get("name"), x.get("ip")) for x in payload.find("login")],
+        )
+        self.assertEqual(
+            [("user1", "10.1.1.1")],
+            [(x.get("name"), x.get("ip")) for x in payload.find("logout")],
+        )
+
+    def test_coalesce_register_unregister(self):
+        fw = userid_firewall()
+
+        fw.userid.batch_start()
+        fw.userid.register("10.1.1.1", ["a", "b"])
+        fw.userid.register("10.1.1.1", "a")
+        fw.userid.unregister("10.1.1.1", "b")
+        fw.userid.batch_end()
+
+        payload = sent_payloads(fw)[0]
+        self.assertEqual(
+            ["a"], [x.text for x in payload.findall("register/entry/tag/member")]
+        )
+        self.assertEqual(
+            ["b"], [x.text for x in payload.findall("unregister/entry/tag/member")]
+        )
+
+    def test_coalesce_user_tags(self):
+        fw = userid_firewall()
+
+        fw.userid.batch_start()
+        fw.userid.tag_user("user1", ["a", "b"])
+        fw.userid.untag_user("user1", ["a"])
+        fw.userid.tag_user("user2", ["c"])
+        fw.userid.untag_user("user2")
+        fw.userid.batch_end()
+
+        payload = sent_payloads(fw)[0]
+        self.assertEqual(
+            ["b"], [x.text for x in payload.findall("register-user/entry/tag/member")]
+        )
+        entries = payload.findall("unregister-user/entry")
+        self.assertEqual(["user1", "user2"], [x.get("user") for x in entries])
+        self.assertIsNone(entries[1].find("tag"))
+
+    def test_no_coalesce(self):
+        fw = userid_firewall()
+
+        fw.userid.batch_start(coalesce=False)
+        fw.userid.login("user1", "10.1.1.1")
+        fw.userid.logout("user1", "10.1.1.1")
+        fw.userid.batch_end()
+
+        payload = sent_payloads(fw)[0]
+        self.assertEqual(["login", "logout"], [x.tag for x in payload])
+
+
+class TestUidMessage(unittest.TestCase):
+    def test_update_replays_operations(self):
+        first = userid.UidMessage()
+        first.login("user1", "10.1.1.1")
+        first.register("10.1.1.1", "a")
+        second = userid.UidMessage()
+        second.logout("user1", "10.1.1.1")
+        second.unregister("10.1.1.1", "a")
+        second.tag_user("user2", "b", 10)
+
+        first.update(second)
+
+        self.assertEqual(3, len(first))
+        payload = first.element().find("payload")
+        self.assertEqual(
+            ["logout", "unregister", "register-user"],
+            [x.tag for x in payload if len(x)],
+        )
+        self.assertEqual(
+            "10", payload.find("register-user/entry/tag/member").get("timeout")
+        )
+
+    def test_empty_message(self):
+        self.assertIsNone(userid.UidMessage().element())
+
+    def test_tag_after_untag_all_is_split(self):
+        message = userid.UidMessage()
+        message.tag_user("bob", "a")
+        message.untag_user("bob")
+        message.tag_user("bob", "b")
+
+        parts = message.split()
+
+        self.assertEqual(2, len(parts))
+        self.assertEqual(2, len(message))
+        first = parts[0].element().find("payload")
+        self.assertEqual(["unregister-user"], [x.tag for x in first if len(x)])
+        self.assertIsNone(first.find("unregister-user/entry/tag"))
+        second = parts[1].element().find("payload")
+        self.assertEqual(["register-user"], [x.tag for x in second])
+        self.assertEqual("b", second.findtext("register-user/entry/tag/member"))
+
+    def test_opposite_operations_are_split_without_coalesce(self):
+        message = userid.UidMessage(coalesce=False)
+        message.login("user1", "10.1.1.1")
+        message.logout("user1", "10.1.1.1")
+        message.login("user1", "10.1.1.1")
+        message.register("10.1.1.1", "a")
+        message.unregister("10.1.1.1", "a")
+        message.register("10.1.1.1", "a")
+
+        parts = [
+            [x.tag for x in part.element().find("payload")] for part in message.split()
+        ]
+
+        self.assertEqual(
+            [["login", "logout"], ["login", "register", "unregister"], ["register"]],
+            parts,
+        )
+        self.assertEqual(6, sum(len(x) for x in message.split()))
+
+    def test_unrelated_operations_are_not_split(self):
+        message = userid.UidMessage(coalesce=False)
+        message.login("user1", "10.1.1.1")
+        message.logout("user2", "10.1.1.2")
+        message.login("user3", "10.1.1.3")
+
+        self.assertEqual(1, len(message.split()))
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError("Timed out waiting")
+        time.sleep(0.01)
+
+
+class TestUserIdDispatcher(unittest.TestCase):
+    def setUp(self):
+        self.fw = userid_firewall()
+        self.xapi = mock.Mock()
+        self.fw.generate_xapi = mock.Mock(return_value=self.xapi)
+
+    def tearDown(self):
+        self.fw.userid.stop_dispatcher(flush=False, timeout=5)
+
+    def payloads(self):
+        return [
+            ET.fromstring(x[1]["cmd"]).find("payload")
+            for x in self.xapi.user_id.call_args_list
+        ]
+
+    def test_operations_are_merged_and_sent_on_stop(self):
+        dispatcher = self.fw.userid.start_dispatcher(interval=60)
+
+        self.fw.userid.login("user1", "10.1.1.1")
+        self.fw.userid.login("user2", "10.1.1.2")
+        self.fw.userid.logout("user1", "10.1.1.1")
+        self.assertEqual(2, dispatcher.queue_depth())
+        self.assertFalse(self.xapi.user_id.called)
+        self.fw.userid.stop_dispatcher(timeout=5)
+
+        payloads = self.payloads()
+        self.assertEqual(1, len(payloads))
+        self.assertEqual(["login", "logout"], [x.tag for x in payloads[0]])
+        self.assertEqual(1, dispatcher.stats["sent_messages"])
+        self.assertEqual(2, dispatcher.stats["sent_entries"])
+        self.assertIsNotNone(dispatcher.average_latency())
+        self.assertEqual(0, dispatcher.queue_depth())
+        self.assertFalse(self.fw._xapi_private.user_id.called)
+
+    def test_split_message_is_sent_in_order(self):
+        self.fw.userid.start_dispatcher(interval=60)
+
+        self.fw.userid.tag_user("bob", "a")
+        self.fw.userid.untag_user("bob")
+        self.fw.userid.tag_user("bob", "b")
+        self.fw.userid.stop_dispatcher(timeout=5)
+
+        payloads = self.payloads()
+        self.assertEqual(
+            [["unregister-user"], ["register-user"]],
+            [[x.tag for x in payload if len(x)] for payload in payloads],
+        )
+
+    def test_sent_when_full(self):
+        dispatcher = self.fw.userid.start_dispatcher(interval=60, max_entries=3)
+
+        self.fw.userid.register("10.1.1.1", ["a", "b", "c"])
+
+        wait_for(lambda: dispatcher.stats["sent_messages"] == 1)
+        self.assertEqual(3, dispatcher.stats["sent_entries"])
+
+    def test_sent_after_interval(self):
+        dispatcher = self.fw.userid.start_dispatcher(interval=0.05)
+
+        self.fw.userid.login("user1", "10.1.1.1")
+
+        wait_for(lambda: dispatcher.stats["sent_messages"] == 1)
+
+    def test_connection_errors_are_retried(self):
+        self.xapi.user_id.side_effect = [err.PanURLError("down"), None]
+        dispatcher = self.fw.userid.start_dispatcher(
+            interval=60, wait=jobs.WaitStrategy(0)
+        )
+
+        self.fw.userid.login("user1", "10.1.1.1")
+        self.fw.userid.stop_dispatcher(timeout=5)
+
+        self.assertEqual(2, self.xapi.user_id.call_count)
+        self.assertEqual(1, dispatcher.stats["retries"])
+        self.assertEqual(1, dispatcher.stats["sent_messages"])
+
+    def test_other_errors_are_counted(self):
+        self.xapi.user_id.side_effect = err.PanDeviceXapiError("bad message")
+        dispatcher = self.fw.userid.start_dispatcher(interval=60)
+
+        self.fw.userid.logins([("user1", "10.1.1.1"), ("user2", "10.1.1.2")])
+        self.fw.userid.stop_dispatcher(timeout=5)
+
+        self.assertEqual(1, self.xapi.user_id.call_count)
+        self.assertEqual(1, dispatcher.stats["failed_messages"])
+        self.assertEqual(2, dispatcher.stats["failed_entries"])
+        self.assertIsInstance(dispatcher.last_error, err.PanDeviceXapiError)
+
+    def test_flush_keeps_latency(self):
+        dispatcher = self.fw.userid.start_dispatcher(interval=60)
+
+        self.fw.userid.login("user1", "10.1.1.1")
+        dispatcher.flush()
+
+        wait_for(lambda: dispatcher.stats["sent_messages"] == 1)
+        self.assertLess(dispatcher.stats["last_latency"], 30)
+        self.assertLess(dispatcher.stats["max_latency"], 30)
+
+    def test_send_is_queued(self):
+        self.fw.userid.start_dispatcher(interval=60)
+        listener = mock.Mock()
+        self.fw.userid.listeners.append(listener)
+
+        self.fw.userid.send(
+            ET.fromstring(
+                "<uid-message><type>update</type><payload><login>"
+                '<entry name="user1" ip="10.1.1.1"/></login></payload>'
+                "</uid-message>"
+            )
+        )
+
+        self.assertEqual(1, self.fw.userid.dispatcher.queue_depth())
+        self.assertEqual(1, listener.apply.call_count)
+        self.assertFalse(self.xapi.user_id.called)
+
+    def test_send_is_queued_unchanged(self):
+        dispatcher = self.fw.userid.start_dispatcher(interval=60)
+        uidmessage = ET.fromstring(
+            "<uid-message><version>2.0</version><type>update</type><payload>"
+            '<login><entry name="user1" ip="10.1.1.1" persistent="1"/></login>'
+            '<login><entry name="user2" ip="10.1.1.2"/></login>'
+            "</payload></uid-message>"
+        )
+        expected = ET.tostring(uidmessage)
+
+        self.fw.userid.logout("user3", "10.1.1.3")
+        self.fw.userid.send(uidmessage)
+        self.assertEqual(3, dispatcher.queue_depth())
+        self.fw.userid.stop_dispatcher(timeout=5)
+
+        calls = self.xapi.user_id.call_args_list
+        self.assertEqual(2, len(calls))
+        self.assertEqual(["logout"], [x.tag for x in self.payloads()[0]])
+        self.assertEqual(expected, calls[1][1]["cmd"])
+        self.assertEqual(3, dispatcher.stats["sent_entries"])
+
+    def test_sends_directly_when_stopped(self):
+        self.fw.userid.start_dispatcher(interval=60)
+        self.fw.userid.stop_dispatcher(timeout=5)
+
+        self.fw.userid.login("user1", "10.1.1.1")
+
+        self.assertEqual(1, self.fw._xapi_private.user_id.call_count)
+
+
+def registered_ip_page(entries):
+    resp = ET.Element("response", {"status": "success"})
+    result = ET.SubElement(resp, "result")
+    for ip, tags in entries:
+        entry = ET.SubElement(result, "entry", {"ip": ip})
+        tag = ET.SubElement(entry, "tag")
+        for name in tags:
+            ET.SubElement(tag, "member").text = name
+    return resp
+
+
+class RegisteredIpTable(object):
+    """Answers paged registered-ip and registered-user queries"""
+
+    def __init__(self, entries, users=None):
+        self.entries = entries
+        self.users = users or {}
+        self.calls = []
+
+    def op(self, cmd=None, vsys=None, cmd_xml=True, **kwargs):
+        root = ET.fromstring(cmd)
+        if root.find("./object/registered-user") is not None:
+            return self.user_op(root.find("./object/registered-user"))
+        elm = root.find("./object/registered-ip")
+        limit = int(elm.find("limit").text)
+        start = int(elm.find("start-point").text)
+        entries = self.entries
+        tag = elm.find("tag/entry")
+        if tag is not None:
+            entries = [
+                (ip, [tag.get("name")])
+                for ip, tags in entries
+                if tag.get("name") in tags
+            ]
+            self.calls.append((tag.get("name"), start))
+        else:
+            self.calls.append(start)
+        return registered_ip_page(entries[start - 1 : start - 1 + limit])
+
+    def user_op(self, elm):
+        user = elm.find("user")
+        if user is not None:
+            self.calls.append(("user", user.text))
+            users = [(user.text, self.users.get(user.text))]
+        else:
+            self.calls.append(("users",))
+            users = sorted(self.users.items())
+        resp = ET.Element("response", {"status": "success"})
+        result = ET.SubElement(resp, "result")
+        for name, tags in users:
+            if tags:
+                entry = ET.SubElement(result, "entry", {"user": name})
+                tag = ET.SubElement(entry, "tag")
+                for t in tags:
+                    ET.SubElement(tag, "member").text = t
+        return resp
+
+
+class TestRegisteredIp(unittest.TestCase):
+    def setUp(self):
+        self.fw = userid_firewall()
+        self.fw._set_version_and_version_info("9.1.0")
+        self.table = RegisteredIpTable(
+            [
+                ("10.1.1.{0}".format(x), ["a", "b"] if x % 2 else ["c"])
+                for x in range(10)
+            ]
+        )
+        self.fw.op = mock.Mock(side_effect=self.table.op)
+        self.fw.generate_xapi = mock.Mock(return_value=self.table)
+
+    def test_get_registered_ip_pages(self):
+        ans = self.fw.userid.get_registered_ip(page_size=4)
+
+        self.assertEqual(10, len(ans))
+        self.assertEqual(["a", "b"], ans["10.1.1.1"])
+        self.assertEqual([1, 5, 9], self.table.calls)
+        self.assertFalse(self.fw.generate_xapi.called)
+
+    def test_iter_prefetches_next_page(self):
+        it = self.fw.userid.iter_registered_ip(page_size=4)
+
+        self.assertEqual(("10.1.1.0", ["c"]), next(it))
+        # The next page was requested before the first one was consumed.
+        wait_for(lambda: len(self.table.calls) == 2)
+        self.assertEqual(10, len(list(it)) + 1)
+        self.assertEqual([1, 5, 9], self.table.calls)
+        self.assertEqual(1, self.fw.op.call_count)
+
+    def test_filters(self):
+        ans = self.fw.userid.get_registered_ip(
+            ["10.1.1.1", "10.1.1.2", "10.1.1.9"], ["a", "c"]
+        )
+
+        self.assertEqual({"10.1.1.1": ["a"], "10.1.1.2": ["c"], "10.1.1.9": ["a"]}, ans)
+
+    def test_prefix_filter(self):
+        self.fw.userid.prefix = "b"
+        self.table.entries = [("10.1.1.1", ["a", "bx"]), ("10.1.1.2", ["a"])]
+
+        ans = self.fw.userid.get_registered_ip()
+
+        self.assertEqual({"10.1.1.1": ["bx"]}, ans)
+
+    def test_prefetch_error_is_raised(self):
+        self.table.op = mock.Mock(side_effect=err.PanURLError("down"))
+        it = self.fw.userid.iter_registered_ip(page_size=10)
+
+        self.assertRaises(err.PanURLError, list, it)
+
+    def test_audit_dry_run(self):
+        requested = dict(("10.1.1.{0}".format(x), ("a", "c")) for x in range(5))
+        requested["10.2.2.2"] = ("d",)
+
+        ans = self.fw.userid.audit_registered_ip(requested, dry_run=True)
+
+        # 10.1.1.5-9 are removed, 10.1.1.1 and 10.1.1.3 lose "b", 10.1.1.0-4
+        # gain "a" or "c", and 10.2.2.2 is new.
+        self.assertEqual(
+            {"register": 6, "unregister": 10, "register_ips": 6, "unregister_ips": 7},
+            ans,
+        )
+        self.assertFalse(self.fw._xapi_private.user_id.called)
+
+    def test_audit_sends_chunks(self):
+        requested = {"10.1.1.1": ["a", "b"], "10.1.1.3": ("a", "b", "x")}
+
+        self.fw.userid.audit_registered_ip(requested, chunk_size=3)
+
+        # 11 unregistrations and 1 registration, 3 per message.
+        payloads = sent_payloads(self.fw)
+        self.assertEqual(4, len(payloads))
+        unregistered = set(
+            (x.get("ip"), m.text)
+            for p in payloads
+            for x in p.findall("unregister/entry")
+            for m in x.findall("tag/member")
+        )
+        registered = set(
+            (x.get("ip"), m.text)
+            for p in payloads
+            for x in p.findall("register/entry")
+            for m in x.findall("tag/member")
+        )
+        self.assertEqual(
+            set(("10.1.1.{0}".format(x), "c") for x in (0, 2, 4, 6, 8))
+            | set(("10.1.1.{0}".format(x), t) for x in (5, 7, 9) for t in "ab"),
+            unregistered,
+        )
+        self.assertEqual(set([("10.1.1.3", "x")]), registered)
+
+    def test_audit_in_sync(self):
+        requested = dict(self.table.entries)
+
+        ans = self.fw.userid.audit_registered_ip(requested)
+
+        self.assertEqual(0, ans["register"] + ans["unregister"])
+        self.assertFalse(self.fw._xapi_private.user_id.called)
+
+    def test_audit_with_prefix(self):
+        self.fw.userid.prefix = "p-"
+        self.table.entries = [("10.1.1.1", ["p-a", "p-b", "other"])]
+
+        self.fw.userid.audit_registered_ip({"10.1.1.1": ["a"]})
+
+        payload = sent_payloads(self.fw)[0]
+        self.assertEqual(
+            ["p-b"], [x.text for x in payload.findall("unregister/entry/tag/member")]
+        )
+        self.assertIsNone(payload.find("register"))
+
+
+class TestUidMessageFromElement(unittest.TestCase):
+    def test_round_trip(self):
+        message = userid.UidMessage()
+        message.login("user1", "10.1.1.1", 60)
+        message.logout("user2", "10.1.1.2")
+        message.register("10.1.1.1", "a", 10)
+        message.unregister("10.1.1.2", "b")
+        message.tag_user("user1", "c")
+        message.untag_user("user2")
+        message.untag_user("user3", "d")
+        message.set_group("group1", ["user1", "user2"])
+        element = message.element()
+
+        parsed = userid.UidMessage.from_element(element)
+
+        self.assertEqual(ET.tostring(element), ET.tostring(parsed.element()))
+        self.assertEqual(len(message), len(parsed))
+
+    def test_unknown_operations(self):
+        element = ET.fromstring(
+            "<uid-message><type>update</type><payload><other/></payload>"
+            "</uid-message>"
+        )
+
+        self.assertIsNone(userid.UidMessage.from_element(element))
+
+
+class TestUserIdMirror(unittest.TestCase):
+    def setUp(self):
+        self.fw = userid_firewall()
+        self.fw._set_version_and_version_info("9.1.0")
+        self.table = RegisteredIpTable(
+            [("10.1.1.1", ["a", "b"]), ("10.1.1.2", ["b"])],
+            {"user1": ["a"], "user2": ["a", "c"]},
+        )
+        self.fw.op = mock.Mock(side_effect=self.table.op)
+        self.fw.generate_xapi = mock.Mock(return_value=self.table)
+        self.mirror = self.fw.userid.start_mirror()
+
+    def test_send_updates_mirror(self):
+        self.fw.userid.send(
+            ET.fromstring(
+                "<uid-message><type>update</type><payload><register>"
+                '<entry ip="10.1.1.9"><tag><member>z</member></tag></entry>'
+                "</register></payload></uid-message>"
+            )
+        )
+
+        self.assertEqual(set(["10.1.1.9"]), self.mirror.ips_for_tag("z"))
+        self.assertEqual(1, self.fw._xapi_private.user_id.call_count)
+
+    def test_refresh(self):
+        self.assertEqual(set(["a", "b"]), self.mirror.tags_for_ip("10.1.1.1"))
+        self.assertEqual(set(["10.1.1.1", "10.1.1.2"]), self.mirror.ips_for_tag("b"))
+        self.assertEqual(set(["user1", "user2"]), self.mirror.users_for_tag("a"))
+        self.assertEqual(set(["a", "c"]), self.mirror.tags_for_user("user2"))
+        self.assertEqual(set(), self.mirror.ips_for_tag("x"))
+
+    def test_operations_update_indexes(self):
+        self.fw.op.reset_mock()
+
+        self.fw.userid.register(["10.1.1.3", "10.1.1.1"], "x")
+        self.fw.userid.unregister("10.1.1.2", "b")
+        self.fw.userid.tag_user("user3", ["a"])
+        self.fw.userid.untag_user("user2")
+
+        self.assertFalse(self.fw.op.called)
+        self.assertEqual(set(["10.1.1.1", "10.1.1.3"]), self.mirror.ips_for_tag("x"))
+        self.assertEqual(set(["10.1.1.1"]), self.mirror.ips_for_tag("b"))
+        self.assertEqual(set(), self.mirror.tags_for_ip("10.1.1.2"))
+        self.assertEqual(set(["user1", "user3"]), self.mirror.users_for_tag("a"))
+        self.assertEqual(set(), self.mirror.users_for_tag("c"))
+        self.assertEqual(
+            {"10.1.1.1": ["a", "b", "x"], "10.1.1.3": ["x"]},
+            self.mirror.registered_ip(),
+        )
+
+    def test_reconcile_reads_only_changes(self):
+        self.fw.userid.register("10.1.1.3", "x")
+        self.fw.userid.tag_user("user3", ["a"])
+        # The device didn't keep the registration.
+        self.table.users["user3"] = ["a"]
+        self.table.calls = []
+
+        self.assertEqual(2, self.mirror.reconcile())
+
+        self.assertEqual([("x", 1), ("user", "user3")], self.table.calls)
+        self.assertEqual(set(), self.mirror.ips_for_tag("x"))
+        self.assertEqual(set(["a"]), self.mirror.tags_for_user("user3"))
+        self.assertEqual(0, self.mirror.dirty())
+        self.assertEqual(0, self.mirror.reconcile())
+
+    def test_failed_reconcile_keeps_changes(self):
+        self.fw.userid.register("10.1.1.3", "x")
+        self.fw.op.side_effect = err.PanURLError("down")
+
+        self.assertRaises(err.PanURLError, self.mirror.reconcile)
+
+        self.assertEqual(1, self.mirror.dirty())
+
+    def test_prefix(self):
+        self.fw.userid.prefix = "p-"
+        self.fw.userid.register("10.1.1.5", "x")
+
+        self.assertEqual(set(["10.1.1.5"]), self.mirror.ips_for_tag("x"))
+        self.assertEqual(set(["p-x"]), self.mirror.tags_for_ip("10.1.1.5"))
+
+
+class TestUserIdFanout(unittest.TestCase):
+    def setUp(self):
+        self.devices = []
+        for x in range(4):
+            fw = panos.firewall.Firewall(
+                "fw{0}".format(x), "user", "passwd", "authkey", vsys="vsys2"
+            )
+            fw.generate_xapi = mock.Mock(return_value=mock.Mock())
+            self.devices.append(fw)
+
+    def calls_to(self, index):
+        return self.devices[index].generate_xapi.return_value.user_id
+
+    def calls(self, device):
+        return device.generate_xapi.return_value.user_id.call_args_list
+
+    def test_serialized_once_sent_to_all(self):
+        fanout = userid.UserIdFanout(
+            self.devices[:3] + [(self.devices[3], "vsys5")], concurrency=2
+        )
+
+        with mock.patch("panos.userid.ET.tostring", wraps=ET.tostring) as tostring:
+            fanout.register("10.1.1.1", "a")
+        self.assertEqual(1, tostring.call_count)
+
+        cmds = set()
+        for device in self.devices:
+            calls = self.calls(device)
+            self.assertEqual(1, len(calls))
+            cmds.add(calls[0][1]["cmd"])
+        self.assertEqual(1, len(cmds))
+        self.assertEqual("vsys2", self.calls(self.devices[0])[0][1]["vsys"])
+        self.assertEqual("vsys5", self.calls(self.devices[3])[0][1]["vsys"])
+        self.assertEqual([1, 1, 1, 1], [x["sent"] for x in fanout.targets])
+
+    def test_workers_are_reused(self):
+        threads = set()
+
+        def user_id(*args, **kwargs):
+            threads.add(threading.current_thread())
+
+        for x in range(4):
+            self.calls_to(x).side_effect = user_id
+        fanout = userid.UserIdFanout(self.devices, concurrency=2)
+
+        for x in range(3):
+            fanout.login("user{0}".format(x), "10.1.1.1")
+        fanout.stop()
+
+        self.assertEqual([3, 3, 3, 3], [x["sent"] for x in fanout.targets])
+        self.assertLessEqual(len(threads), 2)
+        self.assertNotIn(threading.current_thread(), threads)
+        for thread in threads:
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+
+    def test_per_target_failures(self):
+        down = err.PanURLError("down")
+        self.calls_to(1).side_effect = [down, None, down, down]
+        self.calls_to(2).side_effect = err.PanDeviceXapiError("bad")
+        fanout = userid.UserIdFanout(self.devices, retries=1, wait=jobs.WaitStrategy(0))
+
+        fanout.login("user1", "10.1.1.1")
+
+        self.assertEqual([1, 1, 0, 1], [x["sent"] for x in fanout.targets])
+        self.assertEqual([0, 1, 0, 0], [x["retries"] for x in fanout.targets])
+        self.assertEqual(
+            [self.devices[2]], [x["device"] for x in fanout.failed_targets()]
+        )
+
+        fanout.logout("user1", "10.1.1.1")
+
+        self.assertEqual(
+            [self.devices[1], self.devices[2]],
+            [x["device"] for x in fanout.failed_targets()],
+        )
+
+    def test_batched(self):
+        fanout = userid.UserIdFanout(self.devices)
+
+        fanout.batch_start()
+        fanout.login("user1", "10.1.1.1")
+        fanout.register("10.1.1.1", "a")
+        fanout.batch_end()
+
+        for device in self.devices:
+            self.assertEqual(1, len(self.calls(device)))
+
+    def test_background_backpressure(self):
+        fanout = userid.UserIdFanout(self.devices[:1], max_pending=1)
+        xapi = self.devices[0].generate_xapi.return_value
+        release = [False]
+        xapi.user_id.side_effect = lambda **kwargs: wait_for(lambda: release[0])
+        fanout.start()
+        self.addCleanup(fanout.stop, False, 5)
+
+        fanout.login("user1", "10.1.1.1")
+        wait_for(lambda: xapi.user_id.called)
+        fanout.login("user2", "10.1.1.2")
+        self.assertEqual(2, fanout.queue_depth())
+
+        producer = mock.Mock()
+
+        def produce():
+            fanout.login("user3", "10.1.1.3")
+            producer()
+
+        thread = threading.Thread(target=produce)
+        thread.start()
+        time.sleep(0.05)
+        # The queue is full, so the producer waits.
+        self.assertFalse(producer.called)
+
+        release[0] = True
+        thread.join(5)
+        fanout.stop(timeout=5)
+
+        self.assertTrue(producer.called)
+        self.assertEqual(3, xapi.user_id.call_count)
+
 
 if __name__ == "__main__":
     unittest.main()